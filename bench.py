@@ -0,0 +1,201 @@
+"""
+Микробенчмарки этапов модерации из main.py.
+
+    python bench.py                                  # синтетика, правила 10/100/1000/10000
+    python bench.py --sizes 100 5000 --corpus msgs.jsonl
+    python bench.py --save bench_baseline.json       # сохранить базовую линию
+    python bench.py --compare bench_baseline.json    # сравнить, код выхода 1 при регрессии
+
+Корпус: файл .jsonl ({"text": ..., "name": ..., "username": ...}) или .txt (сообщение на строку).
+"""
+import argparse
+import json
+import random
+import string
+import sys
+from io import BytesIO
+from time import perf_counter_ns
+
+from PIL import Image
+
+import main
+
+# ===================== Данные =====================
+
+_RU = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+_EMOJI = ["🔥", "💰", "💋", "🚀", "✅", "😀", "🎁"]
+
+def _word(rnd: random.Random, letters=_RU) -> str:
+    return "".join(rnd.choice(letters) for _ in range(rnd.randint(4, 10)))
+
+def synthetic_corpus(rnd: random.Random, n: int, vocab: list[str]) -> list[dict]:
+    items = []
+    for _ in range(n):
+        words = [rnd.choice(vocab) for _ in range(rnd.randint(3, 40))]
+        if rnd.random() < 0.2:
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(_EMOJI))
+        first = _word(rnd).capitalize()
+        if rnd.random() < 0.1:
+            e = rnd.choice(_EMOJI)
+            first = f"{e} {first} {e}"
+        items.append({
+            "text": " ".join(words),
+            "name": first + (f" | {_word(rnd).capitalize()}" if rnd.random() < 0.5 else ""),
+            "username": _word(rnd, string.ascii_lowercase + "_0123456789") if rnd.random() < 0.7 else "",
+        })
+    items.append({"text": "🔥🔥🔥", "name": "😀", "username": ""})
+    return items
+
+def load_corpus(path: str) -> list[dict]:
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                doc = json.loads(line)
+                items.append({"text": doc.get("text", ""), "name": doc.get("name", ""), "username": doc.get("username", "")})
+            else:
+                items.append({"text": line, "name": "", "username": ""})
+    return items
+
+def synthetic_config(rnd: random.Random, size: int, vocab: list[str]) -> dict:
+    """Конфиг, где в каждом семействе правил по size записей (часть — из словаря корпуса, чтобы были попадания)."""
+    def pick():
+        return rnd.choice(vocab) if rnd.random() < 0.01 else _word(rnd)
+    return {
+        "BANNED_WORDS": [pick() for _ in range(size)],
+        "PERMANENT_BLOCK_PHRASES": [" ".join(pick() for _ in range(3)) for _ in range(size)],
+        "COMBINED_BLOCKS": [[pick(), pick()] for _ in range(size)],
+        "BANNED_SYMBOLS": [rnd.choice(_EMOJI[:2]) + _word(rnd)[:1] for _ in range(size)],
+        "BANNED_NAME_SUBSTRINGS": [_word(rnd) for _ in range(size)],
+        "BANNED_FULL_NAMES": [_word(rnd).capitalize() for _ in range(size)],
+        "BANNED_USERNAME_SUBSTRINGS": [_word(rnd, string.ascii_lowercase) for _ in range(size)],
+    }
+
+def synthetic_avatar(rnd: random.Random) -> bytes:
+    img = Image.new("RGB", (640, 640), (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    img.paste((220, 170, 140), (100, 100, 400, 500))
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+# ===================== Замеры =====================
+
+def measure(fn, args: list, iterations: int) -> dict:
+    """Прогнать fn по args по кругу iterations раз; ops/sec и перцентили одного вызова (мкс)."""
+    for a in args[:min(len(args), 50)]:  # прогрев
+        fn(a)
+    times = []
+    n = len(args)
+    for i in range(iterations):
+        a = args[i % n]
+        t0 = perf_counter_ns()
+        fn(a)
+        times.append(perf_counter_ns() - t0)
+    times.sort()
+    total = sum(times) or 1
+    return {
+        "ops_sec": iterations * 1e9 / total,
+        "p50_us": times[len(times) // 2] / 1000,
+        "p99_us": times[min(len(times) - 1, int(len(times) * 0.99))] / 1000,
+    }
+
+def run(sizes: list[int], corpus: list[dict], iterations: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    vocab = sorted({w for item in corpus for w in item["text"].split()}) or [_word(rnd)]
+    texts = [item["text"] for item in corpus]
+    names = [item["name"] for item in corpus]
+    results = {}
+
+    def add(stage, res):
+        results[stage] = res
+        print(f"{stage:<40} {res['ops_sec']:>12.0f} ops/s   p50 {res['p50_us']:>9.1f} мкс   p99 {res['p99_us']:>9.1f} мкс")
+
+    add("is_only_emojis", measure(main.is_only_emojis, texts, iterations))
+    add("normalize_text", measure(main.normalize_text, texts, iterations))
+    norm = [main.normalize_text(t) for t in texts]
+
+    def lemmatize_cold(t):
+        main.normal_form.cache_clear()
+        return main.lemmatize_text(t)
+    add("lemmatize_text/cold", measure(lemmatize_cold, norm, max(iterations // 10, 10)))
+    add("lemmatize_text/warm", measure(main.lemmatize_text, norm, iterations))
+    add("clean_for_match", measure(main.clean_for_match, texts, iterations))
+    add("has_emoji_edges", measure(main.has_emoji_edges, names, iterations))
+    add("text_simhash", measure(main.text_simhash, texts, iterations))
+    add("MessageFeatures", measure(
+        lambda item: main.MessageFeatures(item["text"], item["name"], None, item["username"]), corpus, iterations))
+
+    proc = [main.lemmatize_text(t) for t in norm]
+    raw_clean = [main.clean_for_match(t) for t in texts]
+    name_norm = [main.normalize_text(n) for n in names]
+    usernames = [main.normalize_text(item["username"]) for item in corpus]
+    for size in sizes:
+        cfg = synthetic_config(rnd, size, vocab)
+        t0 = perf_counter_ns()
+        rules = main.CompiledRules(cfg)
+        compile_us = (perf_counter_ns() - t0) / 1000
+        results[f"compile/{size}"] = {"ops_sec": 1e6 / max(compile_us, 1e-3), "p50_us": compile_us, "p99_us": compile_us}
+        print(f"{'compile/' + str(size):<40} {compile_us / 1000:>12.1f} мс")
+        add(f"words/{size}", measure(rules.words.first, raw_clean, iterations))
+        add(f"phrases/{size}", measure(rules.phrases.first, proc, iterations))
+        add(f"combos/{size}", measure(rules.match_combo, proc, iterations))
+        add(f"name_substrings/{size}", measure(rules.name_substrings.first, name_norm, iterations))
+        add(f"username_substrings/{size}", measure(rules.username_substrings.first, usernames, iterations))
+        add(f"symbols/{size}", measure(rules.symbols.first, names, iterations))
+        add(f"full_names/{size}", measure(lambda n: main.lemmatize_text(n) in rules.full_names, name_norm, iterations))
+
+    images = [Image.open(BytesIO(synthetic_avatar(rnd))).convert("RGB") for _ in range(4)]
+    add("_skin_ratio", measure(main._skin_ratio, images, max(iterations // 20, 10)))
+    blobs = [synthetic_avatar(rnd) for _ in range(4)]
+    add("_analyze_avatar_sync", measure(lambda b: main._analyze_avatar_sync(BytesIO(b)), blobs, max(iterations // 20, 10)))
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Этапы, у которых p50 вырос больше чем на tolerance относительно базовой линии."""
+    regressions = []
+    for stage, base in baseline.items():
+        cur = results.get(stage)
+        if not cur or stage.startswith("compile/"):
+            continue
+        if cur["p50_us"] > base["p50_us"] * (1 + tolerance):
+            regressions.append(f"{stage}: p50 {base['p50_us']:.1f} -> {cur['p50_us']:.1f} мкс")
+    return regressions
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки пайплайна модерации")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="размеры списков правил")
+    parser.add_argument("--corpus", help="записанный корпус: .jsonl или .txt")
+    parser.add_argument("--messages", type=int, default=500, help="размер синтетического корпуса")
+    parser.add_argument("--iterations", type=int, default=2000, help="вызовов на этап")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="сохранить результаты как базовую линию (JSON)")
+    parser.add_argument("--compare", help="сравнить с базовой линией (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимый рост p50 (доля)")
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        vocab = [_word(rnd) for _ in range(3000)]
+        corpus = synthetic_corpus(rnd, args.messages, vocab)
+    results = run(args.sizes, corpus, args.iterations, args.seed)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print("Базовая линия сохранена:", args.save)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("РЕГРЕССИИ:\n" + "\n".join(regressions))
+            return 1
+        print("Регрессий нет.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
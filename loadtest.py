@@ -0,0 +1,527 @@
+"""
+Сквозной нагрузочный тест: вебхук -> хэндлеры -> Bot API и Mongo, без настоящего Telegram.
+
+    python loadtest.py                                   # 100 апдейтов/с, 60 с
+    python loadtest.py --rate 300 --duration 120 --workers 4
+    python loadtest.py --api-latency 0.08 --api-429 0.02 # медленный Bot API и доля ответов 429
+    python loadtest.py --mongo mongodb://127.0.0.1:27017/ --json result.json
+
+В этом процессе поднимается фейковый Bot API (aiohttp): getUserProfilePhotos/getFile/скачивание
+отдают сгенерированные аватарки, deleteMessage/banChatMember и остальные вызовы записываются.
+main.py запускается отдельным процессом с BOT_API_URL/BOT_API_FILE_URL на фейк и тестовым конфигом,
+генератор шлёт в /webhook смесь апдейтов с заданной частотой (открытая модель: задержка считается
+от запланированного момента отправки, а не от фактического).
+
+Mongo (--mongo): auto / mongod — временный mongod из PATH, иначе URI. Без настоящей Mongo прогон
+не запускается: у заглушки другой путь записи, и цифры были бы не про прод.
+Конфиг antispam в этой базе ПЕРЕЗАПИСЫВАЕТСЯ — только одноразовые базы.
+
+Отчёт: принятые апдейты/с, задержка ответа вебхука, сквозная задержка от отправки апдейта до
+deleteMessage/banChatMember (для спама и спам-входов), доля необработанных, вызовы Bot API,
+задержка event loop бота за время прогона (из /metrics; при --workers > 1 — только мастер).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from io import BytesIO
+from time import perf_counter, sleep, time
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+
+BOT_TOKEN = "123456:LOADTEST"
+# id новых аккаунтов спамеров начинаются отсюда
+SPAMMER_BASE_ID = 900_000_000
+
+# Конфиг, который кладём в базу перед стартом бота: под него генерируются спам-тексты и спам-имена
+SEED_CONFIG = {
+    "BANNED_WORDS": ["казино", "ставки", "крипта", "заработок"],
+    "PERMANENT_BLOCK_PHRASES": ["пассивный доход"],
+    "COMBINED_BLOCKS": [],
+    "BANNED_SYMBOLS": [],
+    "BANNED_NAME_SUBSTRINGS": ["казино", "заработок"],
+    "BANNED_FULL_NAMES": [],
+    "BANNED_USERNAME_SUBSTRINGS": ["casino"],
+}
+
+# ===================== Данные =====================
+
+_RU = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+_LAT = "abcdefghijklmnopqrstuvwxyz"
+
+def _word(rnd: random.Random, letters=_RU) -> str:
+    return "".join(rnd.choice(letters) for _ in range(rnd.randint(3, 9)))
+
+def neutral_avatar(rnd: random.Random) -> bytes:
+    """Аватарка без телесных тонов (синие/зелёные плашки) — проверка не должна её банить."""
+    img = Image.new("RGB", (640, 640), (rnd.randint(0, 60), rnd.randint(60, 160), rnd.randint(150, 255)))
+    for _ in range(6):
+        x, y = rnd.randrange(560), rnd.randrange(560)
+        img.paste((rnd.randint(0, 80), rnd.randint(100, 255), rnd.randint(100, 255)), (x, y, x + 80, y + 80))
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+class UpdateGenerator:
+    """
+    Смесь апдейтов: обычные сообщения участников чатов, спам со стоп-словами от новых аккаунтов,
+    сообщения из одних эмодзи, входы обычных и спам-имён.
+    При входе имя не проверяется (только аватарка), поэтому вошедший со спам-именем следующим
+    апдейтом пишет обычное сообщение — бан ожидается на нём.
+    next() -> (вид, сырой апдейт, ожидаемое действие или None); действие — ключ FakeBotApi.actions.
+    """
+    def __init__(self, rnd: random.Random, chats: int, users: int, spam: float, emoji: float,
+                 joins: float, join_spam: float):
+        self.rnd = rnd
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = [10_000_000 + i for i in range(users)]
+        self.weights = [
+            ("spam", spam), ("emoji", emoji),
+            ("join_spam", joins * join_spam), ("join", joins * (1 - join_spam)),
+        ]
+        self.vocab = [_word(rnd) for _ in range(3000)]
+        self.update_id = 0
+        self.message_id = 0
+        self.spammer_id = SPAMMER_BASE_ID
+        self._followups: list[tuple[int, dict]] = []  # (чат, пользователь) вошедших со спам-именем
+
+    def _kind(self) -> str:
+        r = self.rnd.random()
+        for kind, w in self.weights:
+            if r < w:
+                return kind
+            r -= w
+        return "clean"
+
+    def _user(self, uid: int, first_name: str | None = None, username: str | None = None) -> dict:
+        user = {"id": uid, "is_bot": False, "first_name": first_name or _word(self.rnd).capitalize()}
+        if username is not None:
+            user["username"] = username
+        elif self.rnd.random() < 0.7:
+            user["username"] = _word(self.rnd, _LAT) + str(uid % 1000)
+        return user
+
+    def _text(self, lo: int, hi: int) -> str:
+        return " ".join(self.rnd.choice(self.vocab) for _ in range(self.rnd.randint(lo, hi)))
+
+    def next(self) -> tuple[str, dict, tuple | None]:
+        rnd = self.rnd
+        self.update_id += 1
+        self.message_id += 1
+        if self._followups:
+            chat, user = self._followups.pop()
+            msg = {
+                "message_id": self.message_id,
+                "date": int(time()),
+                "chat": {"id": chat, "type": "supergroup", "title": f"load {chat}"},
+                "from": user,
+                "text": self._text(2, 12),
+            }
+            return "join_spam", {"update_id": self.update_id, "message": msg}, ("delete", chat, self.message_id)
+        kind = self._kind()
+        if kind in ("spam", "join_spam"):
+            self.spammer_id += 1
+            uid = self.spammer_id
+            chat = rnd.choice(self.chats)
+        else:
+            uid = rnd.choice(self.users)
+            chat = self.chats[uid % len(self.chats)]  # участник пишет в «свой» чат
+        msg = {
+            "message_id": self.message_id,
+            "date": int(time()),
+            "chat": {"id": chat, "type": "supergroup", "title": f"load {chat}"},
+        }
+        expect = None
+        if kind == "clean":
+            msg["from"] = self._user(uid)
+            msg["text"] = self._text(2, 30)
+        elif kind == "emoji":
+            msg["from"] = self._user(uid)
+            msg["text"] = rnd.choice(["🔥🔥🔥", "😀", "💰💰", "🚀✅"])
+            expect = ("delete", chat, self.message_id)
+        elif kind == "spam":
+            msg["from"] = self._user(uid)
+            bait = rnd.choice(SEED_CONFIG["BANNED_WORDS"] + SEED_CONFIG["PERMANENT_BLOCK_PHRASES"])
+            msg["text"] = f"{self._text(2, 12)} {bait} {self._text(2, 12)}"
+            expect = ("delete", chat, self.message_id)
+        else:
+            if kind == "join_spam":
+                bait = rnd.choice(SEED_CONFIG["BANNED_NAME_SUBSTRINGS"])
+                user = self._user(uid, f"{bait.capitalize()} {_word(rnd).capitalize()}")
+                self._followups.append((chat, user))
+            else:
+                user = self._user(uid)
+            msg["from"] = user
+            msg["new_chat_members"] = [user]
+        return kind, {"update_id": self.update_id, "message": msg}, expect
+
+# ===================== Фейковый Bot API =====================
+
+class FakeBotApi:
+    """
+    Замена api.telegram.org на aiohttp. Все вызовы считаются по методам, первое deleteMessage/banChatMember
+    по каждому ключу запоминается с временем прихода (perf_counter) — по ним генератор считает
+    сквозную задержку. latency — средняя добавочная задержка ответа (с, экспоненциальная),
+    rate429 — доля ответов 429 с retry_after (кроме вызовов старта).
+    """
+    STARTUP_METHODS = {"getMe", "setWebhook", "deleteWebhook", "setMyCommands"}
+
+    def __init__(self, rnd: random.Random, latency: float, rate429: float, retry_after: int, avatar_share: float):
+        self.rnd = rnd
+        self.latency = latency
+        self.rate429 = rate429
+        self.retry_after = retry_after
+        self.avatar_share = avatar_share
+        self.avatars = [neutral_avatar(rnd) for _ in range(16)]
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.actions: dict[tuple, float] = {}
+        self.sent_messages = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/photos/{name}", self.download)
+        return app
+
+    @staticmethod
+    async def _params(request) -> dict:
+        """PTB шлёт параметры формой, нестроковые значения — в JSON."""
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for k, v in (await request.post()).items():
+            try:
+                params[k] = json.loads(v)
+            except (TypeError, ValueError):
+                params[k] = v
+        return params
+
+    def _has_avatar(self, user_id: int) -> bool:
+        return (user_id * 2654435761) % 1000 < self.avatar_share * 1000
+
+    async def handle(self, request):
+        t = perf_counter()
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.rnd.expovariate(1 / self.latency))
+        if method not in self.STARTUP_METHODS and self.rnd.random() < self.rate429:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        return web.json_response({"ok": True, "result": self._result(method, params, t)})
+
+    def _result(self, method: str, params: dict, t: float):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+        if method == "getUserProfilePhotos":
+            uid = int(params["user_id"])
+            if not self._has_avatar(uid):
+                return {"total_count": 0, "photos": []}
+            sizes = [{"file_id": f"ava{uid}_{w}", "file_unique_id": f"uava{uid}_{w}", "width": w, "height": w}
+                     for w in (160, 320, 640)]
+            return {"total_count": 1, "photos": [sizes]}
+        if method == "getFile":
+            fid = params["file_id"]
+            return {"file_id": fid, "file_unique_id": "u" + fid, "file_path": f"photos/{fid}.jpg"}
+        if method == "deleteMessage":
+            self.actions.setdefault(("delete", int(params["chat_id"]), int(params["message_id"])), t)
+        elif method == "banChatMember":
+            self.actions.setdefault(("ban", int(params["chat_id"]), int(params["user_id"])), t)
+        elif method == "sendMessage":
+            self.sent_messages += 1
+            return {"message_id": self.sent_messages, "date": int(time()),
+                    "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params.get("text", "")}
+        return True
+
+    async def download(self, request):
+        self.calls["file_download"] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.rnd.expovariate(1 / self.latency))
+        uid = int(request.match_info["name"][3:].split("_", 1)[0])
+        return web.Response(body=self.avatars[uid % len(self.avatars)], content_type="image/jpeg")
+
+# ===================== Mongo и процесс бота =====================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_mongo(spec: str, tmp: str) -> tuple[str, subprocess.Popen | None]:
+    """(URI, процесс mongod, если запускали его сами)."""
+    if spec not in ("auto", "mongod"):
+        return spec, None
+    if not shutil.which("mongod"):
+        raise SystemExit("mongod не найден в PATH — укажите --mongo URI одноразовой базы")
+    port = free_port()
+    dbpath = os.path.join(tmp, "db")
+    os.makedirs(dbpath)
+    proc = subprocess.Popen(["mongod", "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return f"mongodb://127.0.0.1:{port}/", proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            sleep(0.1)
+    proc.kill()
+    raise SystemExit("mongod не запустился")
+
+def serve_bot():
+    """Процесс бота: кладём тестовый конфиг, дальше — обычный main()."""
+    import main
+
+    async def run():
+        await main.config_col.replace_one({"_id": "main"}, {**SEED_CONFIG, "version": 1}, upsert=True)
+        await main.main()
+    asyncio.run(run())
+
+# ===================== Прогон =====================
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+    at = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {"n": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": values[-1]}
+
+def fmt_ms(p: dict) -> str:
+    if not p["n"]:
+        return "нет данных"
+    return f"p50 {p['p50'] * 1000:.1f}  p90 {p['p90'] * 1000:.1f}  p99 {p['p99'] * 1000:.1f}  max {p['max'] * 1000:.1f} мс  (n={p['n']})"
+
+def parse_histogram(text: str, name: str) -> tuple[dict, float, float]:
+    """Бакеты (le -> накопленное число), сумма и число наблюдений гистограммы без меток из /metrics."""
+    buckets, total, count = {}, 0.0, 0.0
+    for line in text.splitlines():
+        if line.startswith(name + "_bucket{"):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float(le)] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(name + "_sum "):
+            total = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(name + "_count "):
+            count = float(line.rsplit(" ", 1)[1])
+    return buckets, total, count
+
+def histogram_delta(before: str, after: str, name: str) -> dict:
+    """Квантили (по верхней границе бакета) и среднее за интервал между двумя снимками /metrics."""
+    b0, s0, c0 = parse_histogram(before, name)
+    b1, s1, c1 = parse_histogram(after, name)
+    n = c1 - c0
+    if n <= 0:
+        return {"n": 0}
+    cum = sorted((le, v - b0.get(le, 0)) for le, v in b1.items())
+    q = lambda p: next(le for le, v in cum if v >= p * n)
+    return {"n": int(n), "mean": (s1 - s0) / n, "p50": q(0.5), "p90": q(0.9), "p99": q(0.99)}
+
+async def wait_ready(session, url: str, proc: subprocess.Popen, timeout: float = 180):
+    t = perf_counter()
+    while perf_counter() - t < timeout:
+        if proc.poll() is not None:
+            raise SystemExit(f"Бот завершился с кодом {proc.returncode}, см. лог")
+        try:
+            async with session.get(url + "/ready") as r:
+                if r.status == 200:
+                    return perf_counter() - t
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.3)
+    raise SystemExit("Бот не стал ready")
+
+async def generate(session, url: str, gen: UpdateGenerator, rate: float, duration: float, connections: int) -> dict:
+    """
+    Открытая модель: i-й апдейт запланирован на t0 + i/rate и отправляется не более чем
+    в connections параллельных POST (как max_connections у вебхука Telegram).
+    """
+    sem = asyncio.Semaphore(connections)
+    statuses = Counter()
+    response_times, late = [], []
+    expected = []  # (вид, ожидаемое действие, запланированное время)
+    tasks = set()
+
+    async def post(data, scheduled):
+        try:
+            async with session.post(url + "/webhook", json=data) as r:
+                await r.read()
+                statuses[r.status] += 1
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] += 1
+        finally:
+            sem.release()
+        response_times.append(perf_counter() - scheduled)
+
+    t0 = perf_counter()
+    total = int(rate * duration)
+    for i in range(total):
+        scheduled = t0 + i / rate
+        delay = scheduled - perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind, data, expect = gen.next()
+        await sem.acquire()
+        late.append(max(perf_counter() - scheduled, 0.0))
+        if expect:
+            expected.append((kind, expect, scheduled))
+        task = asyncio.get_running_loop().create_task(post(data, scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    return {"sent": total, "elapsed": perf_counter() - t0, "statuses": statuses,
+            "response": percentiles(response_times), "late": percentiles(late), "expected": expected}
+
+async def run(args) -> dict:
+    rnd = random.Random(args.seed)
+    api = FakeBotApi(rnd, args.api_latency, args.api_429, args.retry_after, args.avatars)
+    api_runner = web.AppRunner(api.app())
+    await api_runner.setup()
+    api_port = free_port()
+    await web.TCPSite(api_runner, "127.0.0.1", api_port).start()
+
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    mongo_uri, mongod = start_mongo(args.mongo, tmp)
+    bot_port = free_port()
+    bot_url = f"http://127.0.0.1:{bot_port}"
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "PORT": str(bot_port),
+        "WEBHOOK_URL": bot_url,
+        "BOT_API_URL": f"http://127.0.0.1:{api_port}/bot",
+        "BOT_API_FILE_URL": f"http://127.0.0.1:{api_port}/file/bot",
+        "WORKERS": str(args.workers),
+        "MONGODB_URI": mongo_uri,
+        "PYTHONUNBUFFERED": "1",
+    })
+    log = open(args.bot_log, "w", encoding="utf-8")
+    bot = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve-bot"], env=env,
+                           stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+    print(f"Bot API: 127.0.0.1:{api_port}  бот: {bot_url}  Mongo: {mongo_uri}  лог: {args.bot_log}")
+    try:
+        conn = aiohttp.TCPConnector(limit=args.connections)
+        async with aiohttp.ClientSession(connector=conn) as session:
+            startup = await wait_ready(session, bot_url, bot)
+            print(f"Бот готов за {startup:.1f} с, шлём {args.rate:g} апдейтов/с {args.duration:g} с...")
+            async with session.get(bot_url + "/metrics") as r:
+                metrics_before = await r.text()
+            gen = UpdateGenerator(rnd, args.chats, args.users, args.spam, args.emoji, args.joins, args.join_spam)
+            res = await generate(session, bot_url, gen, args.rate, args.duration, args.connections)
+            async with session.get(bot_url + "/metrics") as r:
+                metrics_after = await r.text()
+            # ждём хвост: фоновые удаления/баны, пачки рейд-режима
+            deadline = perf_counter() + args.drain
+            while perf_counter() < deadline and any(e[1] not in api.actions for e in res["expected"]):
+                await asyncio.sleep(0.2)
+            async with session.get(bot_url + "/stats") as r:
+                stats = await r.json()
+    finally:
+        if bot.poll() is None:
+            bot.send_signal(signal.SIGTERM)
+            try:
+                bot.wait(30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        log.close()
+        if mongod is not None:
+            mongod.terminate()
+            mongod.wait(30)
+        shutil.rmtree(tmp, ignore_errors=True)
+        await api_runner.cleanup()
+
+    e2e, missed = {}, Counter()
+    for kind, key, scheduled in res["expected"]:
+        t = api.actions.get(key)
+        if t is None:
+            missed[kind] += 1
+        else:
+            e2e.setdefault(kind, []).append(t - scheduled)
+    accepted = res["statuses"].get(200, 0)
+    return {
+        "startup_seconds": startup,
+        "sent": res["sent"],
+        "accepted": accepted,
+        "accepted_per_sec": accepted / res["elapsed"],
+        "statuses": {str(k): v for k, v in res["statuses"].items()},
+        "webhook_response": res["response"],
+        "generator_late": res["late"],
+        "end_to_end": {kind: percentiles(v) for kind, v in e2e.items()},
+        "end_to_end_all": percentiles([x for v in e2e.values() for x in v]),
+        "missed": dict(missed),
+        "bot_api_calls": dict(api.calls),
+        "bot_api_429": dict(api.throttled),
+        "event_loop_lag": histogram_delta(metrics_before, metrics_after, "event_loop_lag_seconds"),
+        "bot_stats": stats,
+    }
+
+def report(r: dict):
+    print(f"\nОтправлено {r['sent']}, принято {r['accepted']} ({r['accepted_per_sec']:.1f}/с), ответы: {r['statuses']}")
+    print(f"{'ответ вебхука':<22}", fmt_ms(r["webhook_response"]))
+    late = r["generator_late"]
+    if late["n"] and late["p99"] > 0.05:
+        print(f"{'отставание генератора':<22}", fmt_ms(late), " — упёрлись в --connections или в сам генератор")
+    print(f"{'сквозная, всё':<22}", fmt_ms(r["end_to_end_all"]))
+    for kind, p in sorted(r["end_to_end"].items()):
+        print(f"{'  ' + kind:<22}", fmt_ms(p))
+    if r["missed"]:
+        print("не дождались действия:", r["missed"])
+    lag = r["event_loop_lag"]
+    if lag["n"]:
+        print(f"{'лаг event loop':<22} среднее {lag['mean'] * 1000:.1f} мс, p50 ≤ {lag['p50'] * 1000:g}  "
+              f"p90 ≤ {lag['p90'] * 1000:g}  p99 ≤ {lag['p99'] * 1000:g} мс  (n={lag['n']})")
+    print("Bot API:", dict(sorted(r["bot_api_calls"].items())), "429:", r["bot_api_429"] or 0)
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота с фейковым Bot API")
+    parser.add_argument("--rate", type=float, default=100, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=60, help="длительность прогона (с)")
+    parser.add_argument("--drain", type=float, default=15, help="сколько ждать отложенных действий после прогона (с)")
+    parser.add_argument("--connections", type=int, default=40, help="параллельных POST в /webhook (max_connections)")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--users", type=int, default=5000, help="обычных участников на все чаты")
+    parser.add_argument("--spam", type=float, default=0.05, help="доля спам-сообщений")
+    parser.add_argument("--emoji", type=float, default=0.01, help="доля сообщений из одних эмодзи")
+    parser.add_argument("--joins", type=float, default=0.02, help="доля входов в чат")
+    parser.add_argument("--join-spam", type=float, default=0.5, help="доля спам-имён среди входов")
+    parser.add_argument("--avatars", type=float, default=0.7, help="доля пользователей с аватаркой")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="средняя задержка ответа Bot API (с)")
+    parser.add_argument("--api-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429 (с)")
+    parser.add_argument("--mongo", default="auto", help="auto | mongod | URI одноразовой базы")
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS для бота")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot-log", default="loadtest-bot.log", help="куда писать вывод бота")
+    parser.add_argument("--json", help="сохранить результаты (JSON)")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print("Результаты сохранены:", args.json)
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve-bot"]:
+        serve_bot()
+    else:
+        sys.exit(cli())
@@ -1,18 +1,36 @@
+from time import time as now_ts, monotonic, perf_counter
+T_PROCESS_START = perf_counter()  # отсчёт холодного старта (до тяжёлых импортов)
+
 import inspect
+from abc import ABC, abstractmethod
 from collections import namedtuple
 import os
 import asyncio
 import re
 import hashlib
+import signal
+import random
+import sys
+import zlib
+import argparse
+import json
+import sqlite3
+import queue
+import multiprocessing
+from collections import deque, OrderedDict, Counter
+from functools import lru_cache, partial
 import emoji
+import imagehash
 import regex
 import nest_asyncio
-from time import time as now_ts
+import threading
+from bisect import bisect_left
 from datetime import datetime, timedelta
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from aiohttp import web
-from PIL import Image
+from PIL import Image, ImageChops
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import (
@@ -24,21 +42,44 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
 )
-from telegram import BotCommand
+from telegram import Bot, BotCommand
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError, TelegramError
+from telegram.request import HTTPXRequest
 
-import pymorphy2
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
 
 # ===================== Константы / глобалки =====================
 
-# Чаты, где проверка аватарки отключена
-EXCLUDE_NSFW_CHAT_IDS = {-1001497970298}
+# Настройки чатов по умолчанию; поверх них — документы chat_config (/chatcfg).
+# Здесь чаты, где проверка аватарки отключена
+DEFAULT_CHAT_OVERLAYS = {-1001497970298: {"disabled": ["avatar"]}}
+# Семейства правил, выключенные во всех чатах, пока их не включат через /chatcfg enable.
+# flood (флуд одного пользователя и волна одинаковых сообщений) банит по частоте, а не по содержанию —
+# включается осознанно, в конкретном чате. Обнаружение рейдов (raid) включено по умолчанию
+DEFAULT_DISABLED_FAMILIES = frozenset(f for f in os.getenv("DEFAULT_DISABLED_FAMILIES", "flood").split(",") if f)
 
-# Кэш результата skin-ratio для аватарок: user_id -> (ts, ratio)
-AVATAR_CACHE: dict[int, tuple[float, float]] = {}
+# Через сколько заново спрашивать у Telegram текущую аватарку пользователя
 AVATAR_NSFW_TTL = 24 * 3600  # 24h
-
-PHRASE_HASH_MAP: dict[str, str] = {}
+# Предел записей в памяти для каждого уровня кэша аватарок
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE", "50000"))
+# Через сколько секунд после ошибки проверки аватарки пробовать снова (до этого — без неё)
+AVATAR_RETRY_INTERVAL = float(os.getenv("AVATAR_RETRY_INTERVAL", "60"))
+# Сколько хранить вердикт по file_unique_id в Mongo
+AVATAR_VERDICT_TTL = 90 * 24 * 3600
+# Сколько аватарок одновременно скачиваем с серверов Telegram
+AVATAR_DOWNLOAD_CONCURRENCY = int(os.getenv("AVATAR_DOWNLOAD_CONCURRENCY", "4"))
+# Максимальное расстояние Хэмминга между pHash, при котором аватарка считается известной спам-аватаркой
+AVATAR_HASH_DISTANCE = int(os.getenv("AVATAR_HASH_DISTANCE", "6"))
+# Сколько дней помнить хэш спам-аватарки (каждый бан за похожую продлевает срок), 0 — бессрочно
+SPAM_AVATAR_TTL_DAYS = int(os.getenv("SPAM_AVATAR_TTL_DAYS", "90"))
+# Доля "кожи" на аватарке: с hard — бан, с soft — предупреждение админу (чат может переопределить)
+AVATAR_HARD_RATIO = float(os.getenv("AVATAR_HARD_RATIO", "0.58"))
+AVATAR_SOFT_RATIO = float(os.getenv("AVATAR_SOFT_RATIO", "0.42"))
+
+# Декодирование и анализ аватарок — в отдельных потоках, чтобы не блокировать event loop
+AVATAR_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("AVATAR_WORKERS", "2")), thread_name_prefix="avatar")
 
 ArgSpec = namedtuple("ArgSpec", "args varargs keywords defaults")
 def fix_getargspec(func):
@@ -46,17 +87,272 @@ def fix_getargspec(func):
     return ArgSpec(args=spec.args, varargs=spec.varargs, keywords=spec.varkw, defaults=spec.defaults)
 inspect.getargspec = fix_getargspec
 
-morph = pymorphy2.MorphAnalyzer()
 nest_asyncio.apply()
 
+# Словари pymorphy2 грузятся ~секунду и сотни МБ — создаём анализатор при первом обращении
+# (при старте сервиса — в фоне, уже после открытия порта)
+_MORPH = None
+_MORPH_LOCK = threading.Lock()
+
+def get_morph():
+    global _MORPH
+    if _MORPH is None:
+        with _MORPH_LOCK:
+            if _MORPH is None:
+                import pymorphy2
+                _MORPH = pymorphy2.MorphAnalyzer()
+    return _MORPH
+
+# ===================== Метрики =====================
+
+class Metrics:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus.
+    Счётчики и гистограммы — словари по (имя, метки); метки передаются кортежем пар,
+    в горячем пути это константы, так что запись стоит пару операций со словарём.
+    Значения, которые и так считаются где-то ещё (кэши, очереди), отдаются через callback.
+    """
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._hists: dict[tuple[str, tuple], list] = {}  # [по бакетам..., +Inf, sum]
+        self._callbacks: list[tuple[str, str, object]] = []  # (имя, тип, fn -> {метки: значение})
+        self._help: dict[str, tuple[str, str]] = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        key = (name, labels)
+        h = self._hists.get(key)
+        if h is None:
+            h = self._hists[key] = [0] * (len(self.BUCKETS) + 2)
+        h[bisect_left(self.BUCKETS, value)] += 1
+        h[-1] += value
+
+    def lap(self, name: str, since: float, labels: tuple = ()) -> float:
+        """Записать время с since в гистограмму и вернуть текущий perf_counter() для следующего этапа."""
+        t = perf_counter()
+        self.observe(name, t - since, labels)
+        return t
+
+    def callback(self, name: str, kind: str, fn):
+        self._callbacks.append((name, kind, fn))
+
+    @staticmethod
+    def _fmt_labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = self._help.get(name, (kind, ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), h in sorted(self._hists.items()):
+            header(name, "histogram")
+            acc = 0
+            for bound, n in zip(self.BUCKETS, h):
+                acc += n
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{self._fmt_labels(labels, le)} {acc}")
+            acc += h[len(self.BUCKETS)]
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._fmt_labels(labels, le)} {acc}")
+            lines.append(f"{name}_sum{self._fmt_labels(labels)} {h[-1]}")
+            lines.append(f"{name}_count{self._fmt_labels(labels)} {acc}")
+        for name, kind, fn in self._callbacks:
+            try:
+                values = fn()
+            except Exception as e:
+                print(f"metrics callback {name} error:", e)
+                continue
+            header(name, kind)
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("moderation_stage_seconds", "histogram", "Время этапов проверки сообщения/входа")
+METRICS.describe("moderation_seconds", "histogram", "Полное время обработки сообщения/входа хэндлером")
+METRICS.describe("moderation_verdicts_total", "counter", "Вердикты по сообщениям в разрезе сработавшего правила")
+METRICS.describe("moderation_path_total", "counter", "Сообщения по пути проверки: полная или только текст (доверенные)")
+METRICS.describe("new_member_verdicts_total", "counter", "Вердикты по аватаркам новых участников")
+METRICS.describe("mongo_command_seconds", "histogram", "Длительность команд Mongo")
+METRICS.describe("mongo_command_errors_total", "counter", "Ошибки команд Mongo")
+METRICS.describe("bot_api_seconds", "histogram", "Длительность вызовов Bot API")
+METRICS.describe("bot_api_errors_total", "counter", "Ошибки вызовов Bot API (HTTP >= 400 и исключения)")
+METRICS.describe("event_loop_lag_seconds", "histogram", "Задержка event loop относительно ожидаемого пробуждения")
+METRICS.describe("startup_updates_dropped_total", "counter", "Апдейты, принятые во время прогрева, но не переданные в обработку")
+
+class MongoMetrics(monitoring.CommandListener):
+    """Время и ошибки всех команд Mongo через command monitoring драйвера."""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        METRICS.observe("mongo_command_seconds", event.duration_micros / 1e6, (("command", event.command_name),))
+
+    def failed(self, event):
+        METRICS.observe("mongo_command_seconds", event.duration_micros / 1e6, (("command", event.command_name),))
+        METRICS.inc("mongo_command_errors_total", (("command", event.command_name),))
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, который пишет время и ошибки каждого вызова Bot API (включая скачивание файлов)."""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = "file_download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        labels = (("method", endpoint),)
+        t = perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            METRICS.lap("bot_api_seconds", t, labels)
+            METRICS.inc("bot_api_errors_total", labels)
+            raise
+        METRICS.lap("bot_api_seconds", t, labels)
+        if code >= 400:
+            METRICS.inc("bot_api_errors_total", labels)
+        return code, payload
+
+async def monitor_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        METRICS.observe("event_loop_lag_seconds", max(loop.time() - t - interval, 0.0))
+
+# Монитор лага живёт до остановки — держим его отдельно от _BACKGROUND_TASKS, которые дожидаемся при выходе
+LAG_MONITOR: asyncio.Task | None = None
+
+# ===================== Mongo =====================
+
 MONGO_URI = os.getenv("MONGODB_URI")
-client = MongoClient(MONGO_URI)
+client = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoMetrics()])
 db = client["antispam"]
 config_col = db["config"]
 banned_col = db["banned_messages"]
+avatar_col = db["avatar_verdicts"]
+term_stats_col = db["term_stats"]
+spam_avatars_col = db["spam_avatars"]
+reputation_col = db["reputation"]
+spam_simhash_col = db["spam_simhash"]
+state_col = db["state"]
+clean_sample_col = db["clean_sample"]
+chat_config_col = db["chat_config"]
 
 ADMIN_CHAT_ID = 296920330
 
+# Как часто опрашивать version конфига, если change streams недоступны (сек)
+CONFIG_POLL_INTERVAL = int(os.getenv("CONFIG_POLL_INTERVAL", "30"))
+
+# Write-behind для banned_messages: размер пачки, период сброса (сек), предел очереди
+BANNED_FLUSH_SIZE = int(os.getenv("BANNED_FLUSH_SIZE", "100"))
+BANNED_FLUSH_INTERVAL = float(os.getenv("BANNED_FLUSH_INTERVAL", "5"))
+BANNED_QUEUE_MAX = int(os.getenv("BANNED_QUEUE_MAX", "10000"))
+# Сколько дней хранить забаненные сообщения после последнего повтора (0 — бессрочно)
+BANNED_TTL_DAYS = int(os.getenv("BANNED_TTL_DAYS", "365"))
+
+# Очередь апдейтов вебхука: число воркеров, предел очереди на воркер,
+# сколько ждать места в полной очереди (сек), прежде чем ответить Telegram 503
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "500"))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "1"))
+# Сколько апдейтов держать в памяти, пока сервис прогревается после холодного старта
+STARTUP_QUEUE_MAX = int(os.getenv("STARTUP_QUEUE_MAX", "2000"))
+
+# Многопроцессный режим: число процессов-воркеров (1 — всё в одном процессе, как раньше),
+# предел очереди апдейтов на воркер, как часто воркеры подтягивают хэши спама, найденные соседями (сек)
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "1000"))
+SPAM_HASH_REFRESH_INTERVAL = float(os.getenv("SPAM_HASH_REFRESH_INTERVAL", "60"))
+
+# Общее состояние воркеров: memory | mongo | sqlite (файл STATE_SQLITE_PATH на одной машине);
+# сколько живёт сессия выбора фраз /analyzeone (сек)
+STATE_STORE = os.getenv("STATE_STORE", "memory")
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "state.sqlite3")
+ANALYZEONE_SESSION_TTL = float(os.getenv("ANALYZEONE_SESSION_TTL", str(24 * 3600)))
+
+# Свой сервер Bot API (локальный telegram-bot-api или фейк из loadtest.py): базовые URL методов
+# и скачивания файлов, к ним дописывается токен; пусто — api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL") or "https://api.telegram.org/bot"
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL") or "https://api.telegram.org/file/bot"
+
+# Исходящие вызовы Bot API: запросов/сек всего и в один чат, число попыток,
+# как часто отправлять админу сводку банов (сек)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "5"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "10"))
+
+# Счётчики слов для /analyze: период сброса (сек), предел несброшенных ключей,
+# сколько дней хранить, доля обычных сообщений в базовой выборке для lift
+TERM_STATS_FLUSH_INTERVAL = float(os.getenv("TERM_STATS_FLUSH_INTERVAL", "30"))
+TERM_STATS_MAX_PENDING = int(os.getenv("TERM_STATS_MAX_PENDING", "200000"))
+TERM_STATS_TTL_DAYS = int(os.getenv("TERM_STATS_TTL_DAYS", "180"))
+CLEAN_SAMPLE_RATE = float(os.getenv("CLEAN_SAMPLE_RATE", "0.02"))
+# Тексты из этой выборки сохраняются в clean_sample для /evaluate — сколько дней их хранить
+CLEAN_SAMPLE_TTL_DAYS = int(os.getenv("CLEAN_SAMPLE_TTL_DAYS", "30"))
+
+# Офлайн-оценка правил (/evaluate, python main.py evaluate): процессов в пуле,
+# максимум сообщений из каждого корпуса, текстов в одной пачке для процесса
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", str(min(4, os.cpu_count() or 1))))
+EVAL_MAX_MESSAGES = int(os.getenv("EVAL_MAX_MESSAGES", "50000"))
+EVAL_CHUNK = int(os.getenv("EVAL_CHUNK", "500"))
+
+# Репутация: сколько чистых сообщений и какой стаж (сек) нужны для доверия,
+# сколько записей держать в памяти, сохранять ли в Mongo и как часто
+TRUST_MIN_MESSAGES = int(os.getenv("TRUST_MIN_MESSAGES", "20"))
+TRUST_MIN_AGE = float(os.getenv("TRUST_MIN_AGE", str(24 * 3600)))
+REPUTATION_MAX = int(os.getenv("REPUTATION_MAX", "100000"))
+REPUTATION_PERSIST = os.getenv("REPUTATION_PERSIST", "0") == "1"
+REPUTATION_FLUSH_INTERVAL = float(os.getenv("REPUTATION_FLUSH_INTERVAL", "60"))
+
+# Флуд: сколько сообщений одного пользователя за FLOOD_WINDOW сек — бан;
+# повторы: одинаковый текст (не короче FLOOD_REPEAT_MIN_CHARS) от REPEAT_THRESHOLD разных новичков за RAID_WINDOW сек;
+# рейд: RAID_JOIN_THRESHOLD входов за RAID_WINDOW сек, длится RAID_DURATION сек, баны пачкой раз в
+# RAID_BAN_FLUSH_INTERVAL сек; предел ключей в каждой таблице счётчиков
+FLOOD_WINDOW = float(os.getenv("FLOOD_WINDOW", "10"))
+FLOOD_USER_MESSAGES = int(os.getenv("FLOOD_USER_MESSAGES", "10"))
+FLOOD_REPEAT_MIN_CHARS = int(os.getenv("FLOOD_REPEAT_MIN_CHARS", "20"))
+REPEAT_THRESHOLD = int(os.getenv("REPEAT_THRESHOLD", "3"))
+RAID_WINDOW = float(os.getenv("RAID_WINDOW", "60"))
+RAID_JOIN_THRESHOLD = int(os.getenv("RAID_JOIN_THRESHOLD", "10"))
+RAID_DURATION = float(os.getenv("RAID_DURATION", "600"))
+RAID_BAN_FLUSH_INTERVAL = float(os.getenv("RAID_BAN_FLUSH_INTERVAL", "2"))
+FLOOD_MAX_KEYS = int(os.getenv("FLOOD_MAX_KEYS", "100000"))
+
+# Поиск почти-дубликатов спама: максимум отличающихся бит SimHash, минимум слов в тексте,
+# сколько дней хранить хэши
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", "6"))
+SIMHASH_MIN_TOKENS = int(os.getenv("SIMHASH_MIN_TOKENS", "8"))
+SIMHASH_TTL_DAYS = int(os.getenv("SIMHASH_TTL_DAYS", "180"))
+
+# Размер LRU-кэша вердиктов по имени/username
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "50000"))
+
+# Размер LRU-кэша слово -> нормальная форма перед pymorphy2
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", "100000"))
+
 menu_keyboard = ReplyKeyboardMarkup(
     [["/addspam", "/spamlist"], ["/analyze", "/analyzeone"]],
     resize_keyboard=True,
@@ -75,6 +371,13 @@ def is_spam_like(phrase: str, banned_words: list[str], stop_phrases: list[str])
             return True
     return False
 
+# Имя начинается и заканчивается одним и тем же графемным кластером (обычно эмодзи)
+_EMOJI_EDGE_RE = regex.compile(r"^(?P<emoji>\X)\s?.+\s?(?P=emoji)$", flags=regex.UNICODE)
+
+def has_emoji_edges(name: str) -> bool:
+    match = _EMOJI_EDGE_RE.match(name)
+    return bool(match and len(match.group("emoji")) > 0)
+
 def is_only_emojis(text: str) -> bool:
     stripped = (text or "").strip()
     if not stripped:
@@ -84,24 +387,147 @@ def is_only_emojis(text: str) -> bool:
 def get_tyumen_time():
     return (datetime.utcnow() + timedelta(hours=5)).strftime("%Y-%m-%d %H:%M:%S")
 
+# Латиница/цифры, похожие на кириллицу; таблица для str.translate собирается один раз
+_HOMOGLYPHS = str.maketrans({'a':'а','c':'с','e':'е','o':'о','p':'р','y':'у','x':'х','3':'з','0':'о'})
+
 def normalize_text(text: str) -> str:
-    mapping = {'a':'а','c':'с','e':'е','o':'о','p':'р','y':'у','x':'х','3':'з','0':'о'}
-    return "".join(mapping.get(ch, ch) for ch in (text or "").lower())
+    return (text or "").lower().translate(_HOMOGLYPHS)
 
-def lemmatize_text(text: str) -> str:
-    return " ".join(morph.parse(w)[0].normal_form for w in (text or "").split())
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def normal_form(word: str) -> str:
+    """Нормальная форма слова; hits/misses — normal_form.cache_info()."""
+    return get_morph().parse(word)[0].normal_form
 
-async def send_admin_notification(bot, text: str):
-    try:
-        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
-    except Exception as e:
-        print("Ошибка отправки админу:", e)
+def lemmatize_text(text: str) -> str:
+    return " ".join(normal_form(w) for w in (text or "").split())
+
+class LRUCache:
+    """Ограниченный LRU-кэш с необязательным TTL записей."""
+    __slots__ = ("maxsize", "ttl", "hits", "misses", "_data")
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (ts, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if self.ttl is not None and now_ts() - item[0] >= self.ttl:
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (now_ts(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def items(self) -> list:
+        """Снимок [(ключ, значение)] от давних к свежим, без просроченных; порядок LRU и счётчики не меняются."""
+        if self.ttl is None:
+            return [(key, value) for key, (_, value) in self._data.items()]
+        cutoff = now_ts() - self.ttl
+        return [(key, value) for key, (ts, value) in self._data.items() if ts > cutoff]
+
+    def __len__(self):
+        return len(self._data)
+
+class HammingIndex:
+    """
+    Индекс 64-битных хэшей для поиска по расстоянию Хэмминга (multi-index hashing).
+    Хэш режется на max_distance+1 блоков: у хэшей на расстоянии <= max_distance
+    хотя бы один блок совпадает точно, поэтому кандидатов берём из словарей блоков,
+    а не перебираем весь набор.
+    """
+    def __init__(self, max_distance: int, bits: int = 64):
+        self.max_distance = max_distance
+        n = max_distance + 1
+        self._blocks: list[tuple[int, int]] = []  # (сдвиг, маска)
+        shift = 0
+        for i in range(n):
+            width = bits // n + (1 if i < bits % n else 0)
+            self._blocks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables: list[dict[int, list[int]]] = [{} for _ in self._blocks]
+        self._items: set[int] = set()
+
+    def add(self, h: int):
+        if h in self._items:
+            return
+        self._items.add(h)
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            table.setdefault((h >> shift) & mask, []).append(h)
 
-def load_config():
-    doc = config_col.find_one({"_id": "main"})
-    if doc:
-        doc.pop("_id", None)
-        return doc
+    def discard(self, h: int):
+        if h not in self._items:
+            return
+        self._items.discard(h)
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            bucket = table[(h >> shift) & mask]
+            bucket.remove(h)
+            if not bucket:
+                del table[(h >> shift) & mask]
+
+    def near(self, h: int) -> list[int]:
+        """Все хэши в пределах max_distance."""
+        found = set()
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            for c in table.get((h >> shift) & mask, ()):
+                if (h ^ c).bit_count() <= self.max_distance:
+                    found.add(c)
+        return sorted(found)
+
+    def find(self, h: int) -> tuple[int, int] | None:
+        """Ближайший хэш в пределах max_distance: (расстояние, хэш) или None."""
+        if h in self._items:
+            return 0, h
+        best = None
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            for c in table.get((h >> shift) & mask, ()):
+                d = (h ^ c).bit_count()
+                if d <= self.max_distance and (best is None or d < best[0]):
+                    best = (d, c)
+        return best
+
+    def __contains__(self, h: int):
+        return h in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+# Фоновые задачи "выстрелил и забыл": держим ссылки, чтобы их не собрал GC
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+def _background_done(task: asyncio.Task):
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        print("background task error:", task.exception())
+
+_CLEAN_FOR_MATCH_RE = re.compile(r'[^a-zA-Zа-яА-Я0-9]')
+
+def clean_for_match(s: str) -> str:
+    return _CLEAN_FOR_MATCH_RE.sub('', (s or '').lower())
+
+def default_config():
     return {
         "BANNED_FULL_NAMES": [],
         "PERMANENT_BLOCK_PHRASES": [],
@@ -112,84 +538,1747 @@ def load_config():
         "BANNED_USERNAME_SUBSTRINGS": [],
     }
 
-def save_config(cfg):
-    config_col.replace_one({"_id": "main"}, {**cfg, "_id": "main"}, upsert=True)
+def config_from_doc(doc) -> dict:
+    if not doc:
+        return default_config()
+    doc = dict(doc)
+    doc.pop("_id", None)
+    doc.pop("version", None)
+    return doc
+
+async def load_config():
+    return config_from_doc(await config_col.find_one({"_id": "main"}))
 
-def add_banned_message(text: str):
-    banned_col.insert_one({"text": text, "time": datetime.utcnow()})
+async def save_config(cfg):
+    cfg = {k: v for k, v in cfg.items() if k not in ("_id", "version")}
+    await config_col.update_one({"_id": "main"}, {"$set": cfg, "$inc": {"version": 1}}, upsert=True)
+    await CONFIG.invalidate()
+    bump_config_generation()
 
-def analyze_banned_messages(cfg, min_count=2):
-    all_msgs = [doc.get("text", "") for doc in banned_col.find()]
-    words = []
-    for msg in all_msgs:
-        words += re.findall(r'\b[\w\d\-\_]+\b', (msg or "").lower())
+async def ensure_ttl_index(col, field: str, seconds: int | None):
+    """
+    Индекс по field с TTL seconds (None — обычный индекс без TTL).
+    create_index с другим expireAfterSeconds на существующем индексе падает с IndexOptionsConflict,
+    поэтому смену TTL из env применяем через collMod, а включение/выключение TTL — пересозданием.
+    """
+    current = None
+    for index in (await col.index_information()).values():
+        if index["key"] == [(field, 1)]:
+            current = index
+            break
+    if current is None:
+        if seconds is None:
+            await col.create_index(field)
+        else:
+            await col.create_index(field, expireAfterSeconds=seconds)
+        return
+    ttl = current.get("expireAfterSeconds")
+    if ttl == seconds:
+        return
+    if ttl is not None and seconds is not None:
+        await col.database.command("collMod", col.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+    else:
+        await col.drop_index([(field, 1)])
+        if seconds is None:
+            await col.create_index(field)
+        else:
+            await col.create_index(field, expireAfterSeconds=seconds)
+    print(f"TTL индекса {col.name}.{field}: {ttl} -> {seconds}")
+
+class BatchWriter:
+    """
+    Write-behind буфер вставок: копит документы и пишет их insert_many
+    по достижении batch_size или раз в interval секунд.
+    Очередь ограничена max_queue — лишние документы отбрасываются и считаются в dropped.
+    Пачка, не записанная из-за сети/сервера, возвращается в начало очереди (retried);
+    ошибки отдельных документов повтором не лечатся и считаются в failed.
+    """
+    def __init__(self, col, batch_size: int, interval: float, max_queue: int):
+        self.col = col
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self._buf: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def put(self, doc: dict) -> bool:
+        if len(self._buf) >= self.max_queue:
+            self.dropped += 1
+            return False
+        self._buf.append(doc)
+        if len(self._buf) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._buf),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _write(self, batch: list):
+        await self.col.insert_many(batch, ordered=False)
+
+    def _requeue(self, batch: list):
+        """Вернуть пачку в начало очереди; что не влезает в max_queue — в dropped (самые свежие)."""
+        room = max(self.max_queue - len(self._buf), 0)
+        if len(batch) > room:
+            self.dropped += len(batch) - room
+            batch = batch[:room]
+        self._buf.extendleft(reversed(batch))
+
+    async def flush(self) -> bool:
+        """Записать очередь; False — запись не удалась и пачка ждёт следующего flush."""
+        while self._buf:
+            batch = [self._buf.popleft() for _ in range(min(self.batch_size, len(self._buf)))]
+            try:
+                await self._write(batch)
+                self.written += len(batch)
+            except BulkWriteError as e:
+                # остальные документы пачки записаны; дубликат _id — документ уже есть (повтор после сбоя)
+                errors = e.details.get("writeErrors", [])
+                bad = sum(1 for err in errors if err.get("code") != 11000)
+                self.written += len(batch) - bad
+                self.failed += bad
+                if bad:
+                    print(f"{type(self).__name__}({self.col.name}): {bad} документов отклонено:", errors[0].get("errmsg"))
+            except Exception as e:
+                self._requeue(batch)
+                self.retried += 1
+                print(f"{type(self).__name__}({self.col.name}) write error, повторю позже:", e)
+                return False
+        return True
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if not await self.flush():
+            self.dropped += len(self._buf)
+            print(f"{type(self).__name__}({self.col.name}): при остановке не записано {len(self._buf)} документов")
+            self._buf.clear()
+
+class BannedCorpus(BatchWriter):
+    """
+    Корпус забаненных сообщений. Одинаковый после нормализации спам — один документ:
+    _id — хэш текста, hits — сколько раз встретился, first_time/time — первый и последний раз,
+    chat_id / user_id / rule — последнего случая, days — {день: {правило: банов}} для статистики за окно.
+    Повторы копятся в памяти (не больше max_pending разных текстов) и при сбросе превращаются
+    в $inc-апсерты, которые пишет очередь BatchWriter — с теми же повтором и учётом ошибок.
+    По time — TTL-индекс (retention), по (rule, time) — выборка правила за окно без полного скана.
+    """
+    def __init__(self, col, batch_size: int, interval: float, max_pending: int):
+        super().__init__(col, batch_size, interval, max_pending)
+        self._pending: dict[str, dict] = {}
+
+    @staticmethod
+    def content_id(text: str) -> str:
+        return hashlib.sha1(" ".join(normalize_text(text).split()).encode()).hexdigest()
+
+    def put(self, text: str, chat_id: int | None = None, user_id: int | None = None, rule: str | None = None) -> bool:
+        key = self.content_id(text)
+        item = self._pending.get(key)
+        if item is None:
+            if len(self._pending) >= self.max_queue:
+                self.dropped += 1
+                return False
+            item = self._pending[key] = {"text": text, "first_time": datetime.utcnow(), "hits": 0, "days": Counter()}
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+        now = datetime.utcnow()
+        item["days"][f"days.{now:%Y-%m-%d}.{rule or 'unknown'}"] += 1
+        item.update(hits=item["hits"] + 1, time=now, chat_id=chat_id, user_id=user_id, rule=rule)
+        return True
+
+    def stats(self) -> dict:
+        return {**super().stats(), "queued": len(self._buf) + len(self._pending)}
+
+    async def _write(self, batch: list):
+        await self.col.bulk_write(batch, ordered=False)
+
+    async def flush(self) -> bool:
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            ops = [
+                UpdateOne(
+                    {"_id": key},
+                    {
+                        "$inc": {"hits": item["hits"], **item["days"]},
+                        "$set": {k: item[k] for k in ("time", "chat_id", "user_id", "rule")},
+                        "$setOnInsert": {"text": item["text"], "first_time": item["first_time"]},
+                    },
+                    upsert=True,
+                )
+                for key, item in pending.items()
+            ]
+            # очередь могла не разойтись из-за сбоя Mongo: сверх max_queue — в dropped, как в put
+            room = max(self.max_queue - len(self._buf), 0)
+            self.dropped += max(len(ops) - room, 0)
+            self._buf.extend(ops[:room])
+        return await super().flush()
+
+    async def ensure_indexes(self):
+        await ensure_ttl_index(self.col, "time", BANNED_TTL_DAYS * 24 * 3600 if BANNED_TTL_DAYS > 0 else None)
+        await self.col.create_index([("rule", 1), ("time", -1)])
+
+    async def rule_stats(self, days: int) -> list[tuple[str, int, int]]:
+        """
+        [(правило, разных текстов, всего банов)] за последние days дней.
+        Считается по дневным счётчикам days, а не по hits/rule документа: те накоплены за всё время
+        и относятся к последнему бану. Документы без days (записанные до счётчиков) считаем
+        по-старому — целиком, если последний бан попал в окно: точнее для них не получится.
+        """
+        since = datetime.utcnow() - timedelta(days=days)
+        pipeline = [
+            # по индексу time: документ с баном в окне забанен последний раз не раньше начала окна
+            {"$match": {"time": {"$gte": since}, "days": {"$exists": True}}},
+            {"$project": {"day": {"$objectToArray": "$days"}}},
+            {"$unwind": "$day"},
+            {"$match": {"day.k": {"$gte": f"{since:%Y-%m-%d}"}}},
+            {"$project": {"rule": {"$objectToArray": "$day.v"}}},
+            {"$unwind": "$rule"},
+            {"$group": {"_id": {"rule": "$rule.k", "text": "$_id"}, "hits": {"$sum": "$rule.v"}}},
+            {"$group": {"_id": "$_id.rule", "texts": {"$sum": 1}, "hits": {"$sum": "$hits"}}},
+        ]
+        legacy = [
+            {"$match": {"time": {"$gte": since}, "days": {"$exists": False}}},
+            {"$group": {"_id": {"$ifNull": ["$rule", "unknown"]}, "texts": {"$sum": 1},
+                        "hits": {"$sum": {"$ifNull": ["$hits", 1]}}}},
+        ]
+        totals: dict[str, list[int]] = {}
+        for p in (pipeline, legacy):
+            async for doc in self.col.aggregate(p):
+                row = totals.setdefault(doc["_id"], [0, 0])
+                row[0] += doc["texts"]
+                row[1] += doc["hits"]
+        return sorted(((rule, texts, hits) for rule, (texts, hits) in totals.items()), key=lambda r: -r[2])
+
+BANNED_WRITER = BannedCorpus(banned_col, BANNED_FLUSH_SIZE, BANNED_FLUSH_INTERVAL, BANNED_QUEUE_MAX)
+CLEAN_WRITER = BatchWriter(clean_sample_col, BANNED_FLUSH_SIZE, BANNED_FLUSH_INTERVAL, BANNED_QUEUE_MAX)
+
+_WORD_RE = re.compile(r'\b[\w\d\-\_]+\b')
+
+class TermStats:
+    """
+    Инкрементальные счётчики слов и биграмм по дням для /analyze.
+    corpus "spam" — тексты забаненных сообщений, "clean" — выборка обычных сообщений
+    (база для lift). Счётчики копятся в памяти и раз в interval секунд уходят
+    в term_stats пачкой $inc-апсертов. Термин "" — число сообщений за день.
+    """
+    MAX_TERM_LEN = 64
+
+    def __init__(self, col, interval: float, max_pending: int):
+        self.col = col
+        self.interval = interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: dict[tuple[str, datetime, str], int] = {}
+        self._task = None
+
+    @staticmethod
+    def terms(text: str) -> Counter:
+        words = _WORD_RE.findall((text or "").lower())
+        counts = Counter(w for w in words if len(w) >= 4)
+        for a, b in zip(words, words[1:]):
+            if len(a) >= 4 or len(b) >= 4:
+                counts[f"{a} {b}"] += 1
+        return counts
+
+    def add(self, corpus: str, text: str, when: datetime | None = None, weight: int = 1):
+        day = (when or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+        counts = self.terms(text)
+        counts[""] = 1
+        for term, n in counts.items():
+            self._inc((corpus, day, term[:self.MAX_TERM_LEN]), n * weight)
+
+    def _inc(self, key: tuple[str, datetime, str], n: int):
+        if key not in self._pending and len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending[key] = self._pending.get(key, 0) + n
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i in range(0, len(items), 1000):
+            chunk = items[i:i + 1000]
+            ops = [
+                UpdateOne(
+                    {"_id": f"{corpus}:{day:%Y-%m-%d}:{term}"},
+                    {"$inc": {"n": n}, "$setOnInsert": {"corpus": corpus, "day": day, "term": term}},
+                    upsert=True,
+                )
+                for (corpus, day, term), n in chunk
+            ]
+            try:
+                await self.col.bulk_write(ops, ordered=False)
+            except Exception as e:
+                # $inc не идемпотентен, поэтому повторяем только незаписанное: эта пачка и следующие
+                # возвращаются в _pending и складываются с тем, что пришло за время записи
+                print("TermStats flush error:", e)
+                for key, n in items[i:]:
+                    self._inc(key, n)
+                return
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _window_counts(self, corpus: str, since: datetime, terms: list[str] | None = None) -> dict[str, int]:
+        match = {"corpus": corpus, "day": {"$gte": since}}
+        if terms is not None:
+            match["term"] = {"$in": terms}
+        pipeline = [{"$match": match}, {"$group": {"_id": "$term", "n": {"$sum": "$n"}}}]
+        return {doc["_id"]: doc["n"] async for doc in self.col.aggregate(pipeline)}
+
+    async def top(self, days: int, stop_words: set[str], min_count: int = 2, limit: int = 50):
+        """
+        Частые термины спама за последние days дней: [(термин, count, lift)].
+        lift — во сколько раз термин чаще в спаме, чем в обычных сообщениях;
+        без базовой выборки lift = None и сортировка по count.
+        """
+        since = (datetime.utcnow() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        spam = await self._window_counts("spam", since)
+        spam_total = spam.pop("", 0)
+        candidates = {
+            t: n for t, n in spam.items()
+            if n >= min_count and not any(w in stop_words for w in t.split())
+        }
+        clean = await self._window_counts("clean", since, list(candidates) + [""])
+        clean_total = clean.pop("", 0)
+        rows = []
+        for t, n in candidates.items():
+            lift = None
+            if clean_total:
+                lift = (n / max(spam_total, 1)) / ((clean.get(t, 0) + 1) / (clean_total + 1))
+            rows.append((t, n, lift))
+        rows.sort(key=lambda r: (r[2] or 0, r[1]), reverse=True)
+        return rows[:limit]
+
+    async def rebuild_spam(self, source_col) -> int:
+        """
+        Пересчитать счётчики спама по всей коллекции забаненных сообщений.
+        Несброшенные счётчики спама выбрасываем: их тексты уже в source_col
+        (вызывающий сначала сбрасывает BANNED_WRITER), иначе они посчитались бы дважды.
+        """
+        self._pending = {k: n for k, n in self._pending.items() if k[0] != "spam"}
+        await self.col.delete_many({"corpus": "spam"})
+        count = 0
+        async for doc in source_col.find({}, {"text": 1, "time": 1, "hits": 1}):
+            # одинаковые тексты хранятся одним документом с hits
+            self.add("spam", doc.get("text") or "", doc.get("time"), doc.get("hits", 1))
+            count += 1
+            if len(self._pending) >= self.max_pending // 2:
+                await self.flush()
+        await self.flush()
+        return count
+
+TERM_STATS = TermStats(term_stats_col, TERM_STATS_FLUSH_INTERVAL, TERM_STATS_MAX_PENDING)
+
+def add_banned_message(text: str, chat_id: int | None = None, user_id: int | None = None, rule: str | None = None):
+    BANNED_WRITER.put(text, chat_id, user_id, rule)
+    TERM_STATS.add("spam", text)
+    # в индекс почти-дубликатов — только тексты, забаненные за содержание: при бане за имя
+    # текст может быть обычным вопросом, и его повтор другим человеком не спам
+    if rule in SIMHASH_RULES:
+        remember_spam_text(text)
+
+def sample_clean_message(text: str):
+    if text and random.random() < CLEAN_SAMPLE_RATE:
+        TERM_STATS.add("clean", text)
+        CLEAN_WRITER.put({"text": text, "time": datetime.utcnow()})
+
+async def analyze_banned_messages(cfg, min_count=2, days=30):
     stop_words = set(map(str.lower, cfg.get("BANNED_WORDS", [])))
-    freq = {}
-    for w in words:
-        if w in stop_words or len(w) < 4:
-            continue
-        freq[w] = freq.get(w, 0) + 1
-    return [w for w, c in freq.items() if c >= min_count]
+    return await TERM_STATS.top(days, stop_words, min_count)
+
+# ===================== Признаки сообщения =====================
+
+class MessageFeatures:
+    """
+    Всё, что правилам нужно от текста сообщения и имени автора, посчитанное один раз на апдейт.
+    Семейства правил только читают поля и ничего не нормализуют заново.
+    Текстовые поля считаются сразу — их проверяют и у доверенных. Поля имени (identity) — при первом
+    обращении: доверенному автору они не нужны. Слова для SimHash тоже ленивые, но нужны всякому
+    сообщению, на котором не сработало ни одно правило (near_duplicate проверяется и у доверенных).
+    Заданное поле больше не меняется.
+    """
+    __slots__ = (
+        "text", "normalized", "cleaned", "tokens", "lemmas", "proc_text", "words",
+        "first_name", "last_name", "username", "display_name", "emoji_edges",
+        "name_normalized", "name_lemmas", "username_normalized",
+    )
+
+    def __init__(self, text: str = "", first_name: str | None = None, last_name: str | None = None,
+                 username: str | None = None):
+        init = object.__setattr__
+        text = text or ""
+        normalized = normalize_text(text)
+        tokens = tuple(normalized.split())
+        lemmas = tuple(normal_form(w) for w in tokens)
+        init(self, "text", text)
+        init(self, "normalized", normalized)
+        init(self, "cleaned", clean_for_match(text))       # семейство word
+        init(self, "tokens", tokens)
+        init(self, "lemmas", lemmas)
+        init(self, "proc_text", " ".join(lemmas))          # семейства phrase и combo
+        init(self, "first_name", first_name)
+        init(self, "last_name", last_name)
+        init(self, "username", username)
+
+    def _init_words(self):
+        object.__setattr__(self, "words", tuple(_WORD_RE.findall(self.normalized)))  # SimHash
+
+    def _init_identity(self):
+        init = object.__setattr__
+        first_name, last_name = self.first_name, self.last_name
+        shown = display_name(first_name, last_name)
+        name_normalized = normalize_text(shown)
+        init(self, "display_name", shown)
+        init(self, "emoji_edges", has_emoji_edges((first_name or "") + (f" {last_name}" if last_name else "")))
+        init(self, "name_normalized", name_normalized)
+        init(self, "name_lemmas", lemmatize_text(name_normalized) if name_normalized else "")
+        init(self, "username_normalized", normalize_text(self.username))
+
+    def __getattr__(self, name):
+        # вызывается, только если слот ещё пуст: досчитываем ленивую группу полей
+        fill = _LAZY_FEATURES.get(name)
+        if fill is None:
+            raise AttributeError(name)
+        fill(self)
+        return object.__getattribute__(self, name)
+
+    @classmethod
+    def of(cls, text: str, user) -> "MessageFeatures":
+        if user is None:
+            return cls(text)
+        return cls(text, user.first_name, user.last_name, user.username)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MessageFeatures не изменяется после создания")
+
+_LAZY_FEATURES = {"words": MessageFeatures._init_words}
+_LAZY_FEATURES.update(dict.fromkeys(
+    ("display_name", "emoji_edges", "name_normalized", "name_lemmas", "username_normalized"),
+    MessageFeatures._init_identity,
+))
+
+# ===================== Компилированные правила =====================
+
+class AhoCorasick:
+    """
+    Автомат Ахо-Корасик по набору подстрок.
+    Поиск — один проход по тексту, время не зависит от числа шаблонов.
+    """
+    __slots__ = ("patterns", "_goto", "_fail", "_out", "_all_out", "_empty", "_empties")
+
+    def __init__(self, patterns):
+        self.patterns: list[str] = list(patterns)
+        self._goto: list[dict[str, int]] = [{}]
+        self._out: list[int] = [-1]
+        self._all_out: list[tuple[int, ...]] = [()]
+        self._empty = -1
+        self._empties: tuple[int, ...] = ()
+        for idx, p in enumerate(self.patterns):
+            if not p:
+                # "" in text == True для любого текста
+                if self._empty < 0:
+                    self._empty = idx
+                self._empties += (idx,)
+                continue
+            node = 0
+            for ch in p:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._out.append(-1)
+                    self._all_out.append(())
+                node = nxt
+            if self._out[node] < 0:
+                self._out[node] = idx
+            self._all_out[node] += (idx,)
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, nxt in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                fn = self._goto[f].get(ch, 0)
+                self._fail[nxt] = fn if fn != nxt else 0
+                if self._out[nxt] < 0:
+                    self._out[nxt] = self._out[self._fail[nxt]]
+                self._all_out[nxt] += self._all_out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def first(self, text: str) -> int:
+        """Индекс первого найденного шаблона или -1."""
+        if self._empty >= 0:
+            return self._empty
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] >= 0:
+                return out[node]
+        return -1
+
+    def find_all(self, text: str) -> set[int]:
+        """Индексы всех шаблонов, встречающихся в тексте."""
+        found = set(self._empties)
+        goto, fail, all_out = self._goto, self._fail, self._all_out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if all_out[node]:
+                found.update(all_out[node])
+        return found
+
+class CompiledRules:
+    """
+    Правила конфига, заранее нормализованные и собранные в автоматы по семействам.
+    Собирается один раз на версию конфига, а не на каждое сообщение.
+    """
+    def __init__(self, cfg: dict):
+        self.name_substrings = AhoCorasick(normalize_text(s) for s in cfg.get("BANNED_NAME_SUBSTRINGS", []))
+        self.username_substrings = AhoCorasick(normalize_text(s) for s in cfg.get("BANNED_USERNAME_SUBSTRINGS", []))
+        self.symbols = AhoCorasick(cfg.get("BANNED_SYMBOLS", []))
+        self.words = AhoCorasick(clean_for_match(w) for w in cfg.get("BANNED_WORDS", []))
+        self.phrases = AhoCorasick(lemmatize_text(normalize_text(p)) for p in cfg.get("PERMANENT_BLOCK_PHRASES", []))
+        self.full_names = {lemmatize_text(normalize_text(n)) for n in cfg.get("BANNED_FULL_NAMES", [])}
+        self.combos = [
+            [lemmatize_text(normalize_text(w)) for w in combo]
+            for combo in cfg.get("COMBINED_BLOCKS", [])
+        ]
+        # Инвертированный индекс комбинаций: лемма -> id комбинаций, где она нужна.
+        # Проверка сообщения — один проход автомата по тексту и подсчёт попаданий по комбинациям.
+        combo_words = sorted({w for combo in self.combos for w in combo})
+        word_ids = {w: i for i, w in enumerate(combo_words)}
+        self.combo_words = AhoCorasick(combo_words)
+        self.combo_index: list[list[int]] = [[] for _ in combo_words]
+        self.combo_need = [len(set(combo)) for combo in self.combos]
+        # пустая комбинация срабатывает на любом тексте, как и all([])
+        self.combo_always = next((cid for cid, need in enumerate(self.combo_need) if need == 0), -1)
+        for cid, combo in enumerate(self.combos):
+            for w in set(combo):
+                self.combo_index[word_ids[w]].append(cid)
+
+    def match_combo(self, proc_text: str) -> int:
+        """id первой комбинации, все слова которой есть в тексте, или -1."""
+        if self.combo_always >= 0:
+            return self.combo_always
+        if not self.combo_words:
+            return -1
+        hits: dict[int, int] = {}
+        for wid in self.combo_words.find_all(proc_text):
+            for cid in self.combo_index[wid]:
+                hits[cid] = hits.get(cid, 0) + 1
+                if hits[cid] == self.combo_need[cid]:
+                    return cid
+        return -1
+
+# Текстовые семейства правил в порядке проверки: (имя, проверка -> индекс шаблона в конфиге или -1).
+# Общие для delete_spam_message и офлайн-оценки (/evaluate), чтобы логика не расходилась.
+TEXT_RULES = (
+    ("word", lambda f, rules: rules.words.first(f.cleaned)),
+    ("phrase", lambda f, rules: rules.phrases.first(f.proc_text)),
+    ("combo", lambda f, rules: rules.match_combo(f.proc_text)),
+)
+
+# Правила по содержанию текста: только их баны пополняют SimHash-индекс спам-текстов
+SIMHASH_RULES = frozenset(name for name, _ in TEXT_RULES) | {"near_duplicate"}
+
+def text_rule(f: MessageFeatures, rules: CompiledRules, disabled: frozenset = frozenset()) -> str | None:
+    """Первое сработавшее текстовое семейство (кроме отключённых в чате) или None."""
+    for name, check in TEXT_RULES:
+        if name not in disabled and check(f, rules) >= 0:
+            return name
+    return None
+
+class ConfigSnapshot:
+    """
+    Снимок конфига в памяти процесса. Горячий путь читает только его и не ходит в Mongo.
+    version — локальный счётчик, растёт при каждом реальном изменении конфига.
+    Обновляется через change stream, а если он недоступен (не replica set) — опросом поля version.
+    Новые автоматы собираются в потоке; пока они не готовы, обработчики видят прежний снимок целиком.
+    """
+    def __init__(self, col):
+        self.col = col
+        self.cfg = default_config()
+        self.version = 0
+        self.db_version = None
+        self._rules: CompiledRules | None = None
+        self._seq = 0  # номер последней перезагрузки: результат устаревшей сборки выбрасываем
+        self._task = None
+
+    @property
+    def rules(self) -> CompiledRules:
+        if self._rules is None:
+            self._rules = CompiledRules(self.cfg)
+        return self._rules
+
+    def _apply(self, doc):
+        """Поставить конфиг сразу, автоматы соберутся при первом обращении (старт, тесты)."""
+        self._seq += 1
+        cfg = config_from_doc(doc)
+        self.db_version = (doc or {}).get("version", 0)
+        if cfg == self.cfg and self.version:
+            return
+        self.cfg = cfg
+        self._rules = None
+        self.version += 1
+
+    async def _reload(self, doc):
+        """
+        Собрать автоматы нового конфига в потоке и только потом подменить cfg, правила и version разом.
+        Если за время сборки пришла более свежая перезагрузка, результат выбрасываем.
+        """
+        self._seq += 1
+        seq = self._seq
+        cfg = config_from_doc(doc)
+        db_version = (doc or {}).get("version", 0)
+        if cfg == self.cfg and self.version:
+            self.db_version = db_version
+            return
+        try:
+            rules = await asyncio.get_running_loop().run_in_executor(None, CompiledRules, cfg)
+        except Exception as e:
+            # db_version не трогаем — опрос попробует ещё раз, а пока работаем на прежнем снимке
+            print("config: не удалось собрать правила, оставляю прежние:", e)
+            return
+        if seq != self._seq:
+            return
+        self.cfg, self._rules, self.db_version = cfg, rules, db_version
+        self.version += 1
+
+    async def load(self):
+        """Прочитать конфиг при старте: словари ещё грузятся, автоматы соберёт precompile()."""
+        self._apply(await self.col.find_one({"_id": "main"}))
+
+    async def invalidate(self):
+        """Перечитать конфиг немедленно (после save_config); до готовности новых правил действуют старые."""
+        await self._reload(await self.col.find_one({"_id": "main"}))
+
+    async def precompile(self):
+        """
+        Собрать автоматы в потоке, не блокируя event loop (лемматизация фраз правил — самое долгое).
+        Если конфиг за это время сменился, результат выбрасываем — соберётся при первом обращении.
+        """
+        cfg = self.cfg
+        rules = await asyncio.get_running_loop().run_in_executor(None, CompiledRules, cfg)
+        if self.cfg is cfg and self._rules is None:
+            self._rules = rules
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self):
+        try:
+            pipeline = [{"$match": {"documentKey._id": "main"}}]
+            async with self.col.watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    await self._reload(change.get("fullDocument"))
+        except Exception as e:
+            print("config change stream недоступен, опрашиваю version:", e)
+        while True:
+            await asyncio.sleep(CONFIG_POLL_INTERVAL)
+            try:
+                doc = await self.col.find_one({"_id": "main"}, {"version": 1})
+                if (doc or {}).get("version", 0) != self.db_version:
+                    await self._reload(await self.col.find_one({"_id": "main"}))
+            except Exception as e:
+                print("config poll error:", e)
 
-# ===================== Аватары: skin-ratio =====================
+CONFIG = ConfigSnapshot(config_col)
 
-async def _fetch_biggest_avatar(user_id: int, bot):
+# ===================== Настройки чатов =====================
+
+# Семейства правил, которые можно отключить в чате
+RULE_FAMILIES = ("emoji_only", "flood", "raid", "avatar", "identity", "word", "phrase", "combo", "near_duplicate")
+
+# Правила, срабатывание которых говорит о настройках одного чата, а не о спаме вообще:
+# такие баны не попадают в общий корпус, SimHash-индекс и индекс аватарок
+CHAT_LOCAL_RULES = frozenset({"chat_word", "chat_phrase"})
+
+def valid_avatar_thresholds(hard: float, soft: float) -> bool:
+    # NaN не проходит ни одно сравнение, бесконечность — верхнюю границу
+    return 0.0 <= soft <= hard <= 1.0
+
+class ChatOverlay:
+    """
+    Надстройка чата над общим конфигом: свои слова и фразы, отключённые семейства правил,
+    пороги аватарки. Общие автоматы (CONFIG.rules) не копируются — собирается только дельта чата.
+    version — отпечаток документа (одинаковый во всех воркерах и между перезапусками), 0 — настроек нет.
+    """
+    __slots__ = ("doc", "version", "words", "phrases", "disabled", "avatar_hard", "avatar_soft")
+
+    def __init__(self, doc: dict):
+        self.doc = doc
+        self.version = zlib.crc32(json.dumps(doc, sort_keys=True, default=str).encode()) if doc else 0
+        self.words = AhoCorasick(clean_for_match(w) for w in doc.get("words", []))
+        self.phrases = AhoCorasick(lemmatize_text(normalize_text(p)) for p in doc.get("phrases", []))
+        self.disabled = (DEFAULT_DISABLED_FAMILIES - frozenset(doc.get("enabled", []))) | frozenset(doc.get("disabled", []))
+        self.avatar_hard = float(doc.get("avatar_hard", AVATAR_HARD_RATIO))
+        self.avatar_soft = float(doc.get("avatar_soft", AVATAR_SOFT_RATIO))
+        if not valid_avatar_thresholds(self.avatar_hard, self.avatar_soft):
+            print(f"chat_config: некорректные пороги аватарки {self.avatar_hard}/{self.avatar_soft}, беру общие")
+            self.avatar_hard, self.avatar_soft = AVATAR_HARD_RATIO, AVATAR_SOFT_RATIO
+
+    def enabled(self, family: str) -> bool:
+        return family not in self.disabled
+
+    def text_rule(self, f: MessageFeatures) -> str | None:
+        """Слова и фразы самого чата (отключение общих семейств на них не влияет)."""
+        if self.words and self.words.first(f.cleaned) >= 0:
+            return "chat_word"
+        if self.phrases and self.phrases.first(f.proc_text) >= 0:
+            return "chat_phrase"
+        return None
+
+class ChatOverlays:
+    """
+    chat_id -> ChatOverlay: DEFAULT_CHAT_OVERLAYS, поверх — документы chat_config.
+    Коллекция маленькая, перечитывается целиком раз в CONFIG_POLL_INTERVAL (и сразу после /chatcfg);
+    пересобираются только чаты, у которых что-то поменялось.
+    """
+    def __init__(self, col, defaults: dict[int, dict]):
+        self.col = col
+        self.defaults = defaults
+        self._overlays: dict[int, ChatOverlay] = {}
+        self._empty = ChatOverlay({})
+        self._task = None
+        self._apply({})
+
+    def get(self, chat_id: int) -> ChatOverlay:
+        return self._overlays.get(chat_id, self._empty)
+
+    def __len__(self):
+        return len(self._overlays)
+
+    def _apply(self, docs: dict[int, dict]):
+        overlays = {}
+        for chat_id in set(self.defaults) | set(docs):
+            doc = {**self.defaults.get(chat_id, {}), **docs.get(chat_id, {})}
+            old = self._overlays.get(chat_id)
+            overlays[chat_id] = old if old is not None and old.doc == doc else ChatOverlay(doc)
+        self._overlays = overlays
+
+    async def refresh(self):
+        docs = {}
+        async for doc in self.col.find({}, {"version": 0}):
+            docs[doc.pop("_id")] = doc
+        self._apply(docs)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CONFIG_POLL_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print("chat_config refresh error:", e)
+
+CHAT_OVERLAYS = ChatOverlays(chat_config_col, DEFAULT_CHAT_OVERLAYS)
+
+# ===================== Аватары: skin-ratio и хэши =====================
+
+AvatarVerdict = namedtuple("AvatarVerdict", "ratio phash")
+NO_AVATAR = AvatarVerdict(0.0, None)
+
+def verdict_to_state(verdict: AvatarVerdict) -> list:
+    """Для STATE: pHash — беззнаковые 64 бита и в int64 BSON не влезает, храним hex, как в spam_avatars."""
+    return [verdict.ratio, format(verdict.phash, "016x") if verdict.phash is not None else None]
+
+def verdict_from_state(value) -> AvatarVerdict:
+    ratio, phash = value
+    return AvatarVerdict(ratio, int(phash, 16) if isinstance(phash, str) else phash)
+
+# Двухуровневый кэш: user_id -> вердикт (TTL, чтобы заметить смену аватарки)
+# и file_unique_id -> вердикт (содержимое файла неизменно), второй уровень продублирован в Mongo.
+AVATAR_CACHE = LRUCache(AVATAR_CACHE_SIZE, AVATAR_NSFW_TTL)
+AVATAR_FILE_CACHE = LRUCache(AVATAR_CACHE_SIZE)
+
+class AvatarCheckFailed(Exception):
+    """Аватарку проверить не удалось (сеть, Telegram, битый файл) — это не то же, что «аватарки нет»."""
+
+# user_id -> недавняя ошибка проверки: ошибки не кэшируются как вердикт, но и не повторяются
+# на каждом сообщении, пока Telegram недоступен
+AVATAR_FAILURES = LRUCache(AVATAR_CACHE_SIZE, AVATAR_RETRY_INTERVAL)
+
+# Проверки аватарки, которые сейчас в работе: user_id -> общая задача для всех ждущих
+_AVATAR_INFLIGHT: dict[int, asyncio.Task] = {}
+_AVATAR_DOWNLOADS = asyncio.Semaphore(AVATAR_DOWNLOAD_CONCURRENCY)
+
+# pHash аватарок, за которые уже банили по самой аватарке; грузится из spam_avatars при старте
+SPAM_AVATARS = HammingIndex(AVATAR_HASH_DISTANCE)
+
+async def _fetch_biggest_photo(user_id: int, bot):
     photos = await bot.get_user_profile_photos(user_id, limit=1)
     if not photos or photos.total_count == 0:
         return None
-    file_id = photos.photos[0][-1].file_id  # самый крупный размер
-    f = await bot.get_file(file_id)
-    buf = BytesIO()
-    await f.download_to_memory(out=buf)
+    return photos.photos[0][-1]  # самый крупный размер
+
+async def _download_photo(photo, bot) -> BytesIO:
+    async with _AVATAR_DOWNLOADS:
+        f = await bot.get_file(photo.file_id)
+        buf = BytesIO()
+        await f.download_to_memory(out=buf)
     buf.seek(0)
     return buf
 
+async def _load_avatar_verdict(file_unique_id: str):
+    try:
+        doc = await avatar_col.find_one({"_id": file_unique_id})
+    except Exception as e:
+        print("avatar verdict load error:", e)
+        return None
+    if not doc:
+        return None
+    phash = doc.get("phash")
+    return AvatarVerdict(doc.get("ratio", 0.0), int(phash, 16) if phash else None)
+
+async def _store_avatar_verdict(file_unique_id: str, verdict: AvatarVerdict):
+    fields = {"ratio": verdict.ratio, "time": datetime.utcnow()}
+    if verdict.phash is not None:
+        fields["phash"] = format(verdict.phash, "016x")
+    try:
+        await avatar_col.update_one({"_id": file_unique_id}, {"$set": fields}, upsert=True)
+    except Exception as e:
+        print("avatar verdict store error:", e)
+
+async def ensure_indexes():
+    await ensure_ttl_index(avatar_col, "time", AVATAR_VERDICT_TTL)
+    await term_stats_col.create_index([("corpus", 1), ("day", 1), ("term", 1)])
+    await ensure_ttl_index(term_stats_col, "day", TERM_STATS_TTL_DAYS * 24 * 3600)
+    await ensure_ttl_index(spam_simhash_col, "time", SIMHASH_TTL_DAYS * 24 * 3600)
+    await ensure_ttl_index(clean_sample_col, "time", CLEAN_SAMPLE_TTL_DAYS * 24 * 3600)
+    await ensure_ttl_index(spam_avatars_col, "time", SPAM_AVATAR_TTL_DAYS * 24 * 3600 if SPAM_AVATAR_TTL_DAYS > 0 else None)
+    await BANNED_WRITER.ensure_indexes()
+    if isinstance(STATE, MongoStateStore):
+        await STATE.ensure_indexes()
+
+async def load_spam_avatars(verbose: bool = True):
+    """
+    Индекс собирается заново и подменяет старый: истёкшие по TTL и удалённые через /forgetavatar
+    хэши пропадают и из памяти (в воркерах — при периодическом обновлении).
+    """
+    global SPAM_AVATARS
+    index = HammingIndex(AVATAR_HASH_DISTANCE)
+    async for doc in spam_avatars_col.find({}, {"_id": 1}):
+        index.add(int(doc["_id"], 16))
+    SPAM_AVATARS = index
+    if verbose:
+        print(f"Загружено хэшей спам-аватарок: {len(SPAM_AVATARS)}")
+
+def remember_spam_avatar(phash: int | None, user_id: int):
+    """
+    Запомнить хэш аватарки, за которую забанили (в памяти сразу, в Mongo — в фоне).
+    Только для банов по самой аватарке: у забаненного за текст или имя картинка может быть
+    обычной, и по ней начали бы банить всех с похожей.
+    Как и у текстов, хэш рядом с уже известным не добавляем — индекс не расползается,
+    а у известного продлеваем time, чтобы активная рассылка не выпала по TTL.
+    """
+    if phash is None:
+        return
+    near = SPAM_AVATARS.find(phash)
+    if near is not None:
+        spawn(spam_avatars_col.update_one({"_id": format(near[1], "016x")}, {"$set": {"time": datetime.utcnow()}}))
+        return
+    SPAM_AVATARS.add(phash)
+    spawn(spam_avatars_col.update_one(
+        {"_id": format(phash, "016x")},
+        {"$setOnInsert": {"user_id": user_id, "time": datetime.utcnow()}},
+        upsert=True,
+    ))
+
+# Таблицы для point(): 255 — пиксель попадает в диапазон кожи по каналу, иначе 0
+_SKIN_CB_LUT = [255 if 80 <= v <= 135 else 0 for v in range(256)]
+_SKIN_CR_LUT = [255 if 135 <= v <= 180 else 0 for v in range(256)]
+
 def _skin_ratio(img: Image.Image) -> float:
     small = img.resize((256, 256)).convert("YCbCr")
-    pixels = small.getdata()
-    total = len(pixels)
-    skin = 0
-    for (y, cb, cr) in pixels:
-        if 80 <= cb <= 135 and 135 <= cr <= 180:
-            skin += 1
-    return skin / max(total, 1)
+    _, cb, cr = small.split()
+    mask = ImageChops.multiply(cb.point(_SKIN_CB_LUT), cr.point(_SKIN_CR_LUT))
+    skin = mask.histogram()[255]
+    return skin / max(small.width * small.height, 1)
 
-async def avatar_skin_ratio(user_id: int, bot) -> float:
+def _analyze_avatar_sync(bio: BytesIO) -> AvatarVerdict:
+    # Полное декодирование: draft-режим JPEG меняет пиксели после resize, а с ними долю кожи у порогов
+    img = Image.open(bio).convert("RGB")
+    return AvatarVerdict(_skin_ratio(img), int(str(imagehash.phash(img)), 16))
+
+async def avatar_check(user_id: int, bot) -> AvatarVerdict:
     """
-    Возвращает долю 'кожи' на аватарке (0..1). Любые ошибки -> 0.0
-    Результат кэшируется на 24 часа.
+    Возвращает (доля 'кожи' на аватарке 0..1, pHash или None); (0.0, None) — аватарки нет.
+    Если проверить не удалось — AvatarCheckFailed; такой результат не кэшируется как вердикт,
+    повтор — не раньше чем через AVATAR_RETRY_INTERVAL.
+    Привязка к user_id кэшируется на 24 часа, сам вердикт — по file_unique_id
+    (в памяти и в Mongo), так что неизменённая аватарка повторно не скачивается.
+    Параллельные вызовы для одного user_id ждут одну общую проверку.
     """
-    ts = now_ts()
     cached = AVATAR_CACHE.get(user_id)
-    if cached and (ts - cached[0] < AVATAR_NSFW_TTL):
-        return cached[1]
+    if cached is not None:
+        return cached
+    if AVATAR_FAILURES.get(user_id) is not None:
+        raise AvatarCheckFailed("недавняя ошибка проверки, повтор позже")
+    task = _AVATAR_INFLIGHT.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(_avatar_check_uncached(user_id, bot))
+        _AVATAR_INFLIGHT[user_id] = task
+        task.add_done_callback(lambda _: _AVATAR_INFLIGHT.pop(user_id, None))
+    # shield: отмена одного из ждущих не должна отменять общую проверку
+    return await asyncio.shield(task)
+
+async def _avatar_check_uncached(user_id: int, bot) -> AvatarVerdict:
+    key = f"avatar:{user_id}"
     try:
-        bio = await _fetch_biggest_avatar(user_id, bot)
-        if not bio:
-            AVATAR_CACHE[user_id] = (ts, 0.0)
-            return 0.0
-        img = Image.open(bio).convert("RGB")
-        ratio = _skin_ratio(img)
-        AVATAR_CACHE[user_id] = (ts, ratio)
-        return ratio
+        if STATE.shared:
+            shared = await STATE.get(key)
+            if shared is not None:
+                verdict = verdict_from_state(shared)
+                AVATAR_CACHE.set(user_id, verdict)
+                return verdict
+        photo = await _fetch_biggest_photo(user_id, bot)
+        if not photo:
+            AVATAR_CACHE.set(user_id, NO_AVATAR)
+            return NO_AVATAR
+        uid = photo.file_unique_id
+        verdict = AVATAR_FILE_CACHE.get(uid)
+        if verdict is None:
+            verdict = await _load_avatar_verdict(uid)
+        if verdict is None:
+            bio = await _download_photo(photo, bot)
+            loop = asyncio.get_running_loop()
+            verdict = await loop.run_in_executor(AVATAR_POOL, _analyze_avatar_sync, bio)
+            await _store_avatar_verdict(uid, verdict)
+        AVATAR_FILE_CACHE.set(uid, verdict)
+        AVATAR_CACHE.set(user_id, verdict)
+        if STATE.shared:
+            spawn(STATE.set(key, verdict_to_state(verdict), AVATAR_NSFW_TTL))
+        return verdict
     except Exception as e:
-        print("avatar_skin_ratio error:", e)
-        AVATAR_CACHE[user_id] = (ts, 0.0)
-        return 0.0
+        AVATAR_FAILURES.set(user_id, True)
+        raise AvatarCheckFailed(f"{type(e).__name__}: {e}") from e
 
-def avatar_decision(ratio: float) -> str:
+def avatar_decision(verdict: AvatarVerdict, hard: float = AVATAR_HARD_RATIO, soft: float = AVATAR_SOFT_RATIO) -> str:
     """
-    'hard' | 'soft' | 'ok'
-    Пороги можно подстроить под свою группу.
+    'known' | 'hard' | 'soft' | 'ok'
+    'known' — аватарка похожа на ту, за которую уже банили.
+    Пороги подстраиваются под группу через /chatcfg avatar.
     """
-    HARD = 0.58
-    SOFT = 0.42
-    if ratio >= HARD:
+    if verdict.phash is not None and SPAM_AVATARS.find(verdict.phash) is not None:
+        return "known"
+    if verdict.ratio >= hard:
         return "hard"
-    if ratio >= SOFT:
+    if verdict.ratio >= soft:
         return "soft"
     return "ok"
 
+def avatar_reason(verdict: AvatarVerdict, decision: str) -> str:
+    reason = "известная спам-аватарка" if decision == "known" else f"skin_ratio={verdict.ratio:.2f}"
+    if verdict.phash is not None and decision in ("known", "hard"):
+        # чтобы ошибочный бан можно было откатить: /forgetavatar <pHash>
+        reason += f", pHash {verdict.phash:016x}"
+    return reason
+
+# ===================== Похожие спам-тексты =====================
+
+# SimHash текстов забаненных сообщений; грузится из spam_simhash при старте
+SPAM_TEXTS = HammingIndex(SIMHASH_MAX_DISTANCE)
+
+@lru_cache(maxsize=65536)
+def _shingle_bits(shingle: str) -> str:
+    """64-битный хэш шингла строкой из '0'/'1' (3-граммы сильно повторяются, поэтому кэшируем)."""
+    return format(int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big"), "064b")
+
+def text_simhash(text: str) -> int | None:
+    return words_simhash(_WORD_RE.findall(normalize_text(text)))
+
+def words_simhash(words) -> int | None:
+    """
+    64-битный SimHash по символьным 3-граммам нормализованного текста
+    (на коротких сообщениях словесные шинглы слишком чувствительны к замене одного слова).
+    Для коротких текстов (меньше SIMHASH_MIN_TOKENS слов) — None: они слишком легко совпадают.
+    """
+    if len(words) < SIMHASH_MIN_TOKENS:
+        return None
+    joined = " ".join(words)
+    bits = [_shingle_bits(joined[i:i + 3]) for i in range(len(joined) - 2)]
+    half = len(bits) / 2
+    # по каждому разряду — большинство голосов шинглов (подсчёт по столбцам идёт в C через zip)
+    return int("".join("1" if col.count("1") > half else "0" for col in zip(*bits)), 2)
+
+def is_near_duplicate(f: MessageFeatures) -> bool:
+    h = words_simhash(f.words)
+    return h is not None and SPAM_TEXTS.find(h) is not None
+
+def remember_spam_text(text: str):
+    """
+    Новый хэш добавляем, только если в индексе нет близкого: иначе каждый бан за почти-дубликат
+    сдвигал бы индекс от исходного текста (дрейф) и раздувал его. У найденного близкого
+    продлеваем time — активная рассылка не выпадает по TTL.
+    """
+    h = text_simhash(text)
+    if h is None:
+        return
+    near = SPAM_TEXTS.find(h)
+    if near is not None:
+        spawn(spam_simhash_col.update_one(
+            {"_id": format(near[1], "016x")}, {"$set": {"time": datetime.utcnow()}}, upsert=True,
+        ))
+        return
+    SPAM_TEXTS.add(h)
+    spawn(spam_simhash_col.update_one(
+        {"_id": format(h, "016x")},
+        {"$setOnInsert": {"time": datetime.utcnow()}},
+        upsert=True,
+    ))
+
+async def load_spam_texts(verbose: bool = True):
+    async for doc in spam_simhash_col.find({}, {"_id": 1}):
+        SPAM_TEXTS.add(int(doc["_id"], 16))
+    if verbose:
+        print(f"Загружено SimHash спам-текстов: {len(SPAM_TEXTS)}")
+
+# ===================== Общее состояние =====================
+
+class StateStore(ABC):
+    """
+    Ключ-значение с TTL для состояния, которое должны видеть все процессы-воркеры
+    (сессии /analyzeone, привязка user_id -> вердикт аватарки).
+    Значения — всё, что сериализуется в JSON (и в BSON: целые — не больше int64).
+    shared=False — состояние живёт в одном процессе.
+    """
+    shared = True
+
+    @abstractmethod
+    async def get(self, key: str):
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value, ttl: float):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    async def close(self):
+        pass
+
+class MemoryStateStore(StateStore):
+    """В памяти процесса — режим по умолчанию и однопроцессный запуск."""
+    shared = False
+
+    def __init__(self, maxsize: int = 100000):
+        self._data = LRUCache(maxsize)
+
+    async def get(self, key: str):
+        item = self._data.get(key)
+        if item is None or item[0] < now_ts():
+            return None
+        return item[1]
+
+    async def set(self, key: str, value, ttl: float):
+        self._data.set(key, (now_ts() + ttl, value))
+
+    async def delete(self, key: str):
+        self._data.pop(key)
+
+class MongoStateStore(StateStore):
+    """Коллекция state: _id — ключ, expires — TTL-индекс (Mongo сам чистит просроченное)."""
+    def __init__(self, col):
+        self.col = col
+
+    async def ensure_indexes(self):
+        await ensure_ttl_index(self.col, "expires", 0)
+
+    async def get(self, key: str):
+        doc = await self.col.find_one({"_id": key, "expires": {"$gt": datetime.utcnow()}})
+        return doc["value"] if doc else None
+
+    async def set(self, key: str, value, ttl: float):
+        expires = datetime.utcnow() + timedelta(seconds=ttl)
+        await self.col.replace_one({"_id": key}, {"value": value, "expires": expires}, upsert=True)
+
+    async def delete(self, key: str):
+        await self.col.delete_one({"_id": key})
+
+class SqliteStateStore(StateStore):
+    """
+    Локальная замена общего хранилища для воркеров на одной машине (файл sqlite в режиме WAL).
+    Запросы короткие, но синхронные — выполняем их в потоке.
+    """
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS state (k TEXT PRIMARY KEY, v TEXT NOT NULL, expires REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def _run(self, sql: str, args: tuple):
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    async def get(self, key: str):
+        row = await asyncio.to_thread(self._run, "SELECT v FROM state WHERE k = ? AND expires > ?", (key, now_ts()))
+        return json.loads(row[0]) if row else None
+
+    async def set(self, key: str, value, ttl: float):
+        await asyncio.to_thread(
+            self._run, "INSERT OR REPLACE INTO state (k, v, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now_ts() + ttl),
+        )
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._run, "DELETE FROM state WHERE k = ?", (key,))
+
+    async def close(self):
+        await asyncio.to_thread(self._run, "DELETE FROM state WHERE expires <= ?", (now_ts(),))
+        self._db.close()
+
+def make_state_store(kind: str) -> StateStore:
+    if kind == "mongo":
+        return MongoStateStore(state_col)
+    if kind == "sqlite":
+        return SqliteStateStore(STATE_SQLITE_PATH)
+    if kind != "memory":
+        print(f"Неизвестный STATE_STORE={kind!r}, использую memory")
+    return MemoryStateStore()
+
+STATE = make_state_store(STATE_STORE)
+
+# ===================== Исходящие действия =====================
+
+class TokenBucket:
+    """Token bucket с резервированием: take() сразу списывает токен и говорит, сколько подождать."""
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.ts = monotonic()
+
+    def take(self) -> float:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class OutboundScheduler:
+    """
+    Все исходящие действия модерации идут через него: общий и по-чатовый token bucket,
+    пауза по RetryAfter от Telegram, повторы при сетевых ошибках (удаление и бан идемпотентны).
+    Удаление и бан выполняются параллельно и в фоне. Уведомления админу копятся
+    и уходят сводкой раз в digest_interval секунд.
+    """
+    MAX_MESSAGE_LEN = 4000
+
+    def __init__(self, global_rate: float, chat_rate: float, max_attempts: int, digest_interval: float):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.digest_interval = digest_interval
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._global = TokenBucket(global_rate)
+        self._chats = LRUCache(10000)  # chat_id -> TokenBucket
+        self._paused_until = LRUCache(10000)  # chat_id -> monotonic(), до которого Telegram просил подождать
+        self._digest: list[str] = []
+        self._task = None
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.get_running_loop().create_task(self._digest_loop())
+
+    async def _acquire(self, chat_id: int):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate)
+            self._chats.set(chat_id, bucket)
+        paused = self._paused_until.get(chat_id, 0.0) - monotonic()
+        wait = max(bucket.take(), self._global.take(), paused)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def call(self, chat_id: int, method: str, /, **kwargs):
+        """Вызов метода бота с лимитами чата chat_id и повторами. Ошибки не пробрасываются — None."""
+        for attempt in range(self.max_attempts):
+            await self._acquire(chat_id)
+            try:
+                result = await getattr(self.bot, method)(**kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self._paused_until.set(chat_id, monotonic() + float(e.retry_after))
+                self.retried += 1
+            except (BadRequest, Forbidden) as e:
+                # сообщение уже удалено, пользователь уже забанен, нет прав — повторять бессмысленно
+                self.failed += 1
+                print(f"{method} в {chat_id}:", e)
+                return None
+            except NetworkError:
+                self.retried += 1
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as e:
+                self.failed += 1
+                print(f"{method} в {chat_id}:", e)
+                return None
+        self.failed += 1
+        print(f"{method} в {chat_id}: не удалось за {self.max_attempts} попыток")
+        return None
+
+    def delete(self, chat_id: int, message_id: int):
+        spawn(self.call(chat_id, "delete_message", chat_id=chat_id, message_id=message_id))
+
+    def punish(self, chat_id: int, user_id: int, message_id: int | None = None):
+        """Удалить сообщение (если есть) и забанить автора."""
+        if message_id is not None:
+            self.delete(chat_id, message_id)
+        spawn(self.call(chat_id, "ban_chat_member", chat_id=chat_id, user_id=user_id))
+
+    def notify_admin(self, text: str):
+        self._digest.append(text)
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            await self.flush_digest()
+
+    async def flush_digest(self):
+        if not self._digest:
+            return
+        items, self._digest = self._digest, []
+        chunks, cur = [], ""
+        for item in items:
+            item = item[:self.MAX_MESSAGE_LEN]
+            if cur and len(cur) + len(item) + 2 > self.MAX_MESSAGE_LEN:
+                chunks.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{item}" if cur else item
+        chunks.append(cur)
+        for chunk in chunks:
+            await self.call(ADMIN_CHAT_ID, "send_message", chat_id=ADMIN_CHAT_ID, text=chunk)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush_digest()
+
+# Глобальный лимит делим между процессами: у каждого воркера свой bucket, а чат целиком живёт в одном воркере
+OUTBOUND = OutboundScheduler(OUTBOUND_GLOBAL_RATE / max(WORKERS, 1), OUTBOUND_CHAT_RATE, OUTBOUND_MAX_ATTEMPTS, ADMIN_DIGEST_INTERVAL)
+
+# ===================== Репутация =====================
+
+class Reputation:
+    """Компактная запись о пользователе в чате."""
+    __slots__ = ("count", "first_seen", "last_seen", "cfg_version", "fingerprint", "full_checked", "dirty")
+
+    def __init__(self, first_seen: float):
+        self.count = 0
+        self.first_seen = first_seen
+        self.last_seen = first_seen
+        self.cfg_version = -1
+        self.fingerprint = 0
+        self.full_checked = 0.0  # когда последний раз прошла полная проверка (с аватаркой)
+        self.dirty = True
+
+class ReputationStore:
+    """
+    Репутация по (chat_id, user_id): число чистых сообщений, первое появление,
+    версия конфига и отпечаток имени на момент последней полной проверки.
+    Доверенный пользователь проходит только текстовые правила, пока не сменились имя/username,
+    версия конфига и не истёк AVATAR_NSFW_TTL с последней проверки аватарки.
+    Память ограничена LRU; при persist записи сбрасываются в Mongo и подгружаются при старте.
+    """
+    def __init__(self, col, maxsize: int, persist: bool, interval: float):
+        self.col = col
+        self.persist = persist
+        self.interval = interval
+        self._data = LRUCache(maxsize)
+        self._task = None
+
+    def is_trusted(self, chat_id: int, user_id: int, fingerprint: int, cfg_version: int) -> bool:
+        rec = self._data.get((chat_id, user_id))
+        if rec is None:
+            return False
+        ts = now_ts()
+        return (
+            rec.count >= TRUST_MIN_MESSAGES
+            and ts - rec.first_seen >= TRUST_MIN_AGE
+            and rec.fingerprint == fingerprint
+            and rec.cfg_version == cfg_version
+            and ts - rec.full_checked < AVATAR_NSFW_TTL
+        )
+
+    def is_established(self, chat_id: int, user_id: int) -> bool:
+        """Пишет в чате без банов дольше TRUST_MIN_AGE — не новичок, даже если ещё не доверенный."""
+        rec = self._data.get((chat_id, user_id))
+        return rec is not None and now_ts() - rec.first_seen >= TRUST_MIN_AGE
+
+    def record_clean(self, chat_id: int, user_id: int, fingerprint: int, cfg_version: int, full_check: bool):
+        key = (chat_id, user_id)
+        ts = now_ts()
+        rec = self._data.get(key)
+        if rec is None:
+            rec = Reputation(ts)
+            self._data.set(key, rec)
+        rec.count += 1
+        rec.last_seen = ts
+        if full_check:
+            rec.fingerprint = fingerprint
+            rec.cfg_version = cfg_version
+            rec.full_checked = ts
+        rec.dirty = True
+
+    def forget(self, chat_id: int, user_id: int):
+        self._data.pop((chat_id, user_id))
+        if self.persist:
+            spawn(self.col.delete_one({"_id": f"{chat_id}:{user_id}"}))
+
+    def __len__(self):
+        return len(self._data)
+
+    async def load(self):
+        if not self.persist:
+            return
+        cursor = self.col.find().sort("last_seen", -1).limit(self._data.maxsize)
+        docs = [doc async for doc in cursor]
+        for doc in reversed(docs):  # самые свежие — в конец LRU
+            rec = Reputation(doc["first_seen"])
+            rec.count = doc["count"]
+            rec.last_seen = doc["last_seen"]
+            rec.fingerprint = doc.get("fingerprint", 0)
+            rec.full_checked = doc.get("full_checked", 0.0)
+            # версия конфига локальна для процесса — после перезапуска нужна новая полная проверка
+            rec.dirty = False
+            self._data.set((doc["chat_id"], doc["user_id"]), rec)
+        print(f"Загружено записей репутации: {len(docs)}")
+
+    def start(self):
+        if self.persist:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.persist:
+            return
+        ops = []
+        for (chat_id, user_id), rec in self._data.items():
+            if not rec.dirty:
+                continue
+            rec.dirty = False
+            ops.append(UpdateOne(
+                {"_id": f"{chat_id}:{user_id}"},
+                {"$set": {
+                    "chat_id": chat_id, "user_id": user_id, "count": rec.count,
+                    "first_seen": rec.first_seen, "last_seen": rec.last_seen,
+                    "fingerprint": rec.fingerprint, "full_checked": rec.full_checked,
+                }},
+                upsert=True,
+            ))
+        try:
+            for i in range(0, len(ops), 1000):
+                await self.col.bulk_write(ops[i:i + 1000], ordered=False)
+        except Exception as e:
+            print("ReputationStore flush error:", e)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+REPUTATION = ReputationStore(reputation_col, REPUTATION_MAX, REPUTATION_PERSIST, REPUTATION_FLUSH_INTERVAL)
+
+# ===================== Флуд и рейды =====================
+
+class SlidingCounter:
+    """
+    Число событий за последние window секунд: кольцо из n корзин фиксированного размера.
+    add/count — O(n) в худшем случае при долгом простое, т.е. O(1) на событие; память не растёт.
+    """
+    __slots__ = ("width", "buckets", "head", "head_slot", "total")
+
+    def __init__(self, window: float, n: int = 6):
+        self.width = window / n
+        self.buckets = [0] * n
+        self.head = 0
+        self.head_slot = 0  # номер интервала времени, которому соответствует buckets[head]
+        self.total = 0
+
+    def _advance(self, now: float):
+        slot = int(now / self.width)
+        gap = slot - self.head_slot
+        if gap <= 0:
+            return
+        n = len(self.buckets)
+        if gap >= n:
+            for i in range(n):
+                self.buckets[i] = 0
+            self.total = 0
+        else:
+            for _ in range(gap):
+                self.head = (self.head + 1) % n
+                self.total -= self.buckets[self.head]
+                self.buckets[self.head] = 0
+        self.head_slot = slot
+
+    def add(self, now: float, k: int = 1) -> int:
+        self._advance(now)
+        self.buckets[self.head] += k
+        self.total += k
+        return self.total
+
+    def count(self, now: float) -> int:
+        self._advance(now)
+        return self.total
+
+class FloodGuard:
+    """
+    Скользящие счётчики входов (по чату), сообщений (по пользователю в чате) и отправителей
+    одного текста (по чату; считаются только новички — постоянные участники волну не начинают
+    и за неё не банятся). Все таблицы — LRU с общим пределом FLOOD_MAX_KEYS, так что
+    память ограничена при любом потоке. Много входов или волна одинаковых сообщений включает
+    в чате режим рейда на RAID_DURATION: дорогие проверки (аватарки) пропускаются,
+    баны копятся и уходят пачкой раз в RAID_BAN_FLUSH_INTERVAL с одной сводкой админу.
+    """
+    def __init__(self, max_keys: int):
+        self.joins = LRUCache(max_keys)          # chat_id -> SlidingCounter
+        self.messages = LRUCache(max_keys)       # (chat_id, user_id) -> SlidingCounter
+        self.repeats = LRUCache(max_keys)        # (chat_id, hash текста) -> {user_id: monotonic()}
+        self.raid_until = LRUCache(max_keys)     # chat_id -> monotonic()
+        self.raid_joiners = LRUCache(max_keys, ttl=RAID_DURATION)  # (chat_id, user_id) -> True
+        self.raids = 0
+        self.banned = 0
+        self._bans: dict[int, dict[int, str]] = {}  # chat_id -> {user_id: правило}
+        self._task = None
+
+    @staticmethod
+    def _counter(table: LRUCache, key, window: float) -> SlidingCounter:
+        c = table.get(key)
+        if c is None:
+            c = SlidingCounter(window)
+            table.set(key, c)
+        return c
+
+    def in_raid(self, chat_id: int, now: float | None = None) -> bool:
+        return self.raid_until.get(chat_id, 0.0) > (now if now is not None else monotonic())
+
+    def _start_raid(self, chat_id: int, now: float, reason: str):
+        if not self.in_raid(chat_id, now):
+            self.raids += 1
+            OUTBOUND.notify_admin(
+                f"🚨 Рейд в чате {chat_id}: {reason}. На {RAID_DURATION:.0f} с проверка аватарок "
+                f"отключена, баны пачками."
+            )
+        self.raid_until.set(chat_id, now + RAID_DURATION)
+
+    def on_join(self, chat_id: int, user_id: int) -> bool:
+        """Учесть вход; True — чат в режиме рейда."""
+        now = monotonic()
+        joins = self._counter(self.joins, chat_id, RAID_WINDOW).add(now)
+        if joins >= RAID_JOIN_THRESHOLD:
+            self._start_raid(chat_id, now, f"{joins} входов за {RAID_WINDOW:.0f} с")
+        if self.in_raid(chat_id, now):
+            self.raid_joiners.set((chat_id, user_id), True)
+            return True
+        return False
+
+    def _senders(self, key, user_id: int, now: float) -> int:
+        """Сколько разных пользователей прислали текст за RAID_WINDOW, включая этого."""
+        senders = self.repeats.get(key)
+        if senders is None:
+            senders = {}
+            self.repeats.set(key, senders)
+        # порядок вставки = порядок по времени, просроченные — в начале
+        senders.pop(user_id, None)
+        senders[user_id] = now
+        for uid, ts in list(senders.items()):
+            if now - ts <= RAID_WINDOW:
+                break
+            del senders[uid]
+        return len(senders)
+
+    def on_message(self, chat_id: int, user_id: int, f: MessageFeatures, newcomer: bool,
+                   flood: bool = True, raid: bool = True) -> str | None:
+        """
+        Учесть сообщение; 'flood' | 'repeat' | 'raid' — за что банить, иначе None.
+        newcomer — автор не доверенный и не постоянный участник: только такие считаются в волне повторов.
+        flood — семейство flood в чате: баны за флуд и волну повторов; raid — семейство raid:
+        волна повторов включает режим рейда, вошедшие в рейд банятся за повтор.
+        """
+        now = monotonic()
+        if flood and self._counter(self.messages, (chat_id, user_id), FLOOD_WINDOW).add(now) >= FLOOD_USER_MESSAGES:
+            return "flood"
+        if (flood or raid) and newcomer and len(f.normalized) >= FLOOD_REPEAT_MIN_CHARS:
+            n = self._senders((chat_id, hash(f.normalized)), user_id, now)
+            if n >= REPEAT_THRESHOLD:
+                if raid:
+                    self._start_raid(chat_id, now, f"{n} новичков с одинаковым сообщением за {RAID_WINDOW:.0f} с")
+                if flood:
+                    return "repeat"
+            # во время рейда вошедшим в него хватает второго отправителя того же текста
+            if raid and n >= 2 and self.in_raid(chat_id, now) and self.raid_joiners.get((chat_id, user_id)):
+                return "raid"
+        return None
+
+    def queue_ban(self, chat_id: int, user_id: int, message_id: int | None, rule: str):
+        """Сообщение удаляем сразу, бан — в следующей пачке."""
+        if message_id is not None:
+            OUTBOUND.delete(chat_id, message_id)
+        self._bans.setdefault(chat_id, {})[user_id] = rule
+
+    def stats(self) -> dict:
+        now = monotonic()
+        return {
+            "keys": len(self.joins) + len(self.messages) + len(self.repeats) + len(self.raid_joiners),
+            "raids_active": sum(1 for _, until in self.raid_until.items() if until > now),
+            "raids_total": self.raids,
+            "bans_pending": sum(len(b) for b in self._bans.values()),
+            "banned": self.banned,
+        }
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RAID_BAN_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        bans, self._bans = self._bans, {}
+        for chat_id, users in bans.items():
+            for user_id in users:
+                OUTBOUND.punish(chat_id, user_id)
+            self.banned += len(users)
+            by_rule = Counter(users.values())
+            OUTBOUND.notify_admin(
+                f"Пачка банов в чате {chat_id}: {len(users)} ("
+                + ", ".join(f"{rule} {n}" for rule, n in by_rule.most_common()) + ")"
+            )
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+
+FLOOD = FloodGuard(FLOOD_MAX_KEYS)
+
+# ===================== Офлайн-оценка правил =====================
+
+# Для разбора попаданий: все шаблоны семейства, найденные в тексте (комбинация — только первая)
+_EVAL_FIND_ALL = {
+    "word": lambda f, rules: rules.words.find_all(f.cleaned),
+    "phrase": lambda f, rules: rules.phrases.find_all(f.proc_text),
+}
+
+# Состояние процесса пула оценки: правила собираются один раз в initializer
+_EVAL_RULES: CompiledRules | None = None
+
+def _eval_init(cfg: dict):
+    global _EVAL_RULES
+    _EVAL_RULES = CompiledRules(cfg)
+
+def _eval_chunk(items: list[tuple[str, str]]) -> dict:
+    """
+    Прогнать пачку (корпус, текст) через текстовые правила так же, как delete_spam_message.
+    Каждое семейство проверяется на каждом тексте (а не до первого срабатывания),
+    время считается по тому же first(), что и в проде.
+    """
+    rules = _EVAL_RULES
+    res = {"total": Counter(), "caught": Counter(), "hits": Counter(), "patterns": Counter(),
+           "seconds": Counter(), "examples": {}}
+    for corpus, text in items:
+        res["total"][corpus] += 1
+        t = perf_counter()
+        f = MessageFeatures(text)
+        res["seconds"]["features"] += perf_counter() - t
+        caught = False
+        for name, check in TEXT_RULES:
+            t = perf_counter()
+            idx = check(f, rules)
+            res["seconds"][name] += perf_counter() - t
+            if idx < 0:
+                continue
+            caught = True
+            res["hits"][(name, corpus)] += 1
+            found = _EVAL_FIND_ALL[name](f, rules) if name in _EVAL_FIND_ALL else {idx}
+            for i in found:
+                res["patterns"][(name, i, corpus)] += 1
+                if corpus == "clean":
+                    res["examples"].setdefault((name, i), text[:200])
+        if caught:
+            res["caught"][corpus] += 1
+    return res
+
+async def load_eval_corpus(days: int, with_clean: bool, limit: int) -> list[tuple[str, str]]:
+    since = datetime.utcnow() - timedelta(days=days)
+    sources = [("spam", banned_col)] + ([("clean", clean_sample_col)] if with_clean else [])
+    items = []
+    for corpus, col in sources:
+        cursor = col.find({"time": {"$gte": since}}, {"text": 1}).sort("time", -1).limit(limit)
+        items += [(corpus, doc["text"]) async for doc in cursor if doc.get("text")]
+    return items
+
+async def evaluate_rules(cfg: dict, items: list[tuple[str, str]], workers: int = EVAL_WORKERS) -> dict:
+    """
+    Оценка набора правил cfg на корпусе: пачки по EVAL_CHUNK текстов параллельно в пуле процессов
+    (workers <= 1 — в одном потоке рядом с event loop). Результаты пачек складываются.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = [items[i:i + EVAL_CHUNK] for i in range(0, len(items), EVAL_CHUNK)]
+    if workers <= 1 or len(chunks) <= 1:
+        def run_local():
+            _eval_init(cfg)
+            return [_eval_chunk(c) for c in chunks]
+        parts = await loop.run_in_executor(None, run_local)
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        pool = ProcessPoolExecutor(min(workers, len(chunks)), mp_context=ctx,
+                                   initializer=_eval_init, initargs=(cfg,))
+        try:
+            parts = await asyncio.gather(*(loop.run_in_executor(pool, _eval_chunk, c) for c in chunks))
+        finally:
+            # shutdown ждёт выхода процессов — не на event loop (/evaluate запускается в работающем боте)
+            await loop.run_in_executor(None, partial(pool.shutdown, cancel_futures=True))
+    result = {"total": Counter(), "caught": Counter(), "hits": Counter(), "patterns": Counter(),
+              "seconds": Counter(), "examples": {}}
+    for part in parts:
+        for key in ("total", "caught", "hits", "patterns", "seconds"):
+            result[key].update(part[key])
+        for k, v in part["examples"].items():
+            result["examples"].setdefault(k, v)
+    return result
+
+def _pattern_label(cfg: dict, name: str, idx: int) -> str:
+    key = {"word": "BANNED_WORDS", "phrase": "PERMANENT_BLOCK_PHRASES", "combo": "COMBINED_BLOCKS"}[name]
+    p = cfg.get(key, [])[idx]
+    return " + ".join(p) if isinstance(p, list) else p
+
+def format_evaluation(result: dict, cfg: dict, candidates: list[tuple[str, int]] = (), top: int = 10) -> str:
+    """Текстовый отчёт; candidates — (семейство, индекс в cfg) правил, которые хотим добавить."""
+    total, caught, hits, patterns = result["total"], result["caught"], result["hits"], result["patterns"]
+    n_spam, n_clean = total["spam"], total["clean"]
+    n_all = max(n_spam + n_clean, 1)
+
+    def share(a, b):
+        return f"{a}/{b} ({a / b:.0%})" if b else f"{a}/0"
+
+    lines = [f"Корпус: спам {n_spam}, чистые {n_clean}"]
+    lines.append(f"Поймано: спам {share(caught['spam'], n_spam)}, чистые {share(caught['clean'], n_clean)}")
+    lines.append("\nСемейства (спам / чистые, мкс на сообщение):")
+    lines.append(f"  features: {result['seconds']['features'] / n_all * 1e6:.1f} мкс")
+    for name, _ in TEXT_RULES:
+        lines.append(
+            f"  {name}: {hits[(name, 'spam')]} / {hits[(name, 'clean')]}, "
+            f"{result['seconds'][name] / n_all * 1e6:.1f} мкс"
+        )
+    if candidates:
+        lines.append("\nКандидаты (спам / чистые):")
+        for name, idx in candidates:
+            lines.append(
+                f"  {name} «{_pattern_label(cfg, name, idx)}»: "
+                f"{patterns[(name, idx, 'spam')]} / {patterns[(name, idx, 'clean')]}"
+            )
+    false_pos = sorted(
+        ((n, name, idx) for (name, idx, corpus), n in patterns.items() if corpus == "clean"),
+        reverse=True,
+    )[:top]
+    if false_pos:
+        lines.append("\nВозможные ложные срабатывания:")
+        for n, name, idx in false_pos:
+            example = result["examples"].get((name, idx), "")
+            lines.append(f"  {name} «{_pattern_label(cfg, name, idx)}» — {n}: {example[:80]}")
+    unused = []
+    for name, key in (("word", "BANNED_WORDS"), ("phrase", "PERMANENT_BLOCK_PHRASES"), ("combo", "COMBINED_BLOCKS")):
+        idle = sum(1 for i in range(len(cfg.get(key, []))) if not patterns[(name, i, "spam")])
+        unused.append(f"{name} {idle}")
+    lines.append("\nНе сработали ни разу на спаме: " + ", ".join(unused))
+    return "\n".join(lines)
+
+def with_candidates(cfg: dict, words: list[str] = (), phrases: list[str] = ()) -> tuple[dict, list[tuple[str, int]]]:
+    """Копия конфига с добавленными словами/фразами и их (семейство, индекс) для отчёта."""
+    cfg = {k: list(v) if isinstance(v, list) else v for k, v in cfg.items()}
+    candidates = []
+    for family, key, values in (("word", "BANNED_WORDS", words), ("phrase", "PERMANENT_BLOCK_PHRASES", phrases)):
+        for v in values:
+            v = v.strip()
+            if v:
+                candidates.append((family, len(cfg.setdefault(key, []))))
+                cfg[key].append(v)
+    return cfg, candidates
+
+async def evaluate_cli(argv: list[str]):
+    """python main.py evaluate [--days N] [--clean] [--word W ...] [--phrase P ...] [--workers N]"""
+    parser = argparse.ArgumentParser(prog="main.py evaluate", description="Оценка правил на истории сообщений")
+    parser.add_argument("--days", type=int, default=30, help="за сколько дней брать сообщения")
+    parser.add_argument("--clean", action="store_true", help="добавить выборку чистых сообщений (clean_sample)")
+    parser.add_argument("--word", action="append", default=[], help="слово-кандидат в BANNED_WORDS")
+    parser.add_argument("--phrase", action="append", default=[], help="фраза-кандидат в PERMANENT_BLOCK_PHRASES")
+    parser.add_argument("--workers", type=int, default=EVAL_WORKERS, help="процессов в пуле")
+    parser.add_argument("--limit", type=int, default=EVAL_MAX_MESSAGES, help="максимум сообщений на корпус")
+    args = parser.parse_args(argv)
+
+    cfg, candidates = with_candidates(await load_config(), args.word, args.phrase)
+    items = await load_eval_corpus(args.days, args.clean, args.limit)
+    t = perf_counter()
+    result = await evaluate_rules(cfg, items, args.workers)
+    print(format_evaluation(result, cfg, candidates))
+    print(f"\nОценка заняла {perf_counter() - t:.1f} с, процессов: {args.workers}")
+
 # ===================== Хэндлеры команд =====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -204,7 +2293,7 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/addspam — добавить спам-слово/фразу\n"
         "/spamlist — показать текущий стоп-лист\n"
         "/analyzeone — анализировать сообщение\n"
-        "/analyze — анализ часто встречающихся слов\n"
+        "/analyze [дней] — анализ часто встречающихся слов\n"
     )
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -212,7 +2301,7 @@ async def spamlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_CHAT_ID:
         await update.message.reply_text("Нет доступа.")
         return
-    cfg = load_config()
+    cfg = await load_config()
     text = (
         "<b>BANNED_WORDS</b>:\n" + "\n".join(cfg.get("BANNED_WORDS", [])) + "\n\n"
         "<b>BANNED_FULL_NAMES</b>:\n" + "\n".join(cfg.get("BANNED_FULL_NAMES", [])) + "\n\n"
@@ -227,12 +2316,142 @@ async def analyze_banned(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_CHAT_ID:
         await update.message.reply_text("Нет доступа.")
         return
-    cfg = load_config()
-    candidates = analyze_banned_messages(cfg)
+    args = context.args or []
+    if args and args[0] == "rules":
+        days = int(args[1]) if len(args) > 1 and args[1].isdigit() else 30
+        rows = await BANNED_WRITER.rule_stats(days)
+        if not rows:
+            await update.message.reply_text(f"За {days} дн. банов по сообщениям нет.")
+            return
+        lines = [f"{rule} — {hits} (разных текстов {texts})" for rule, texts, hits in rows]
+        await update.message.reply_text(f"Баны по правилам за {days} дн.:\n" + "\n".join(lines))
+        return
+    if args and args[0] == "rebuild":
+        await update.message.reply_text("Пересчитываю счётчики по всем забаненным сообщениям...")
+        await BANNED_WRITER.flush()
+        count = await TERM_STATS.rebuild_spam(banned_col)
+        await update.message.reply_text(f"Готово, обработано сообщений: {count}")
+        return
+    days = int(args[0]) if args and args[0].isdigit() else 30
+    cfg = await load_config()
+    candidates = await analyze_banned_messages(cfg, days=days)
     if not candidates:
         await update.message.reply_text("Нет новых часто встречающихся слов.")
         return
-    await update.message.reply_text("Часто встречающиеся новые слова:\n" + "\n".join(candidates))
+    lines = [
+        f"{t} — {n}" + (f" (lift {lift:.1f})" if lift is not None else "")
+        for t, n, lift in candidates
+    ]
+    await update.message.reply_text(f"Часто встречающиеся новые слова за {days} дн.:\n" + "\n".join(lines))
+
+# --- /evaluate [дни] [слово, фраза из нескольких слов, ...]: как сработали бы правила на истории ---
+async def evaluate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("Нет доступа.")
+        return
+    args = list(context.args or [])
+    days = int(args.pop(0)) if args and args[0].isdigit() else 30
+    # однословные кандидаты проверяем как BANNED_WORDS, многословные — как фразы
+    parts = [p.strip() for p in " ".join(args).split(",") if p.strip()]
+    words = [p for p in parts if " " not in p]
+    phrases = [p for p in parts if " " in p]
+    cfg, candidates = with_candidates(await load_config(), words, phrases)
+    await update.message.reply_text(f"Считаю по истории за {days} дн...")
+    items = await load_eval_corpus(days, True, EVAL_MAX_MESSAGES)
+    result = await evaluate_rules(cfg, items)
+    report = format_evaluation(result, cfg, candidates)
+    await update.message.reply_text(report[:4000])
+
+# --- /chatcfg [chat_id] — настройки чата поверх общего конфига ---
+CHATCFG_USAGE = (
+    "/chatcfg [chat_id] — показать настройки чата (в группе chat_id можно не указывать)\n"
+    "/chatcfg [chat_id] words add|del слово, слово\n"
+    "/chatcfg [chat_id] phrases add|del фраза, фраза\n"
+    "/chatcfg [chat_id] disable|enable " + "|".join(RULE_FAMILIES) + "\n"
+    "/chatcfg [chat_id] avatar <hard> <soft>  (0 ≤ soft ≤ hard ≤ 1)\n"
+    "/chatcfg [chat_id] reset"
+)
+
+def format_chat_overlay(chat_id: int, ov: ChatOverlay) -> str:
+    return (
+        f"Чат {chat_id}:\n"
+        f"Слова: {', '.join(ov.doc.get('words', [])) or '—'}\n"
+        f"Фразы: {', '.join(ov.doc.get('phrases', [])) or '—'}\n"
+        f"Отключено: {', '.join(sorted(ov.disabled)) or '—'}\n"
+        f"Аватарка: hard {ov.avatar_hard:.2f}, soft {ov.avatar_soft:.2f}"
+    )
+
+async def chatcfg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("Нет доступа.")
+        return
+    args = list(context.args or [])
+    chat_id = update.effective_chat.id
+    if args and re.fullmatch(r"-?\d+", args[0]):
+        chat_id = int(args.pop(0))
+    doc = CHAT_OVERLAYS.get(chat_id).doc
+    if not args:
+        await update.message.reply_text(format_chat_overlay(chat_id, CHAT_OVERLAYS.get(chat_id)))
+        return
+
+    cmd, fields = args[0], None
+    if cmd in ("words", "phrases") and len(args) >= 3 and args[1] in ("add", "del"):
+        items = [p.strip() for p in " ".join(args[2:]).split(",") if p.strip()]
+        cur = list(doc.get(cmd, []))
+        if args[1] == "add":
+            cur += [i for i in items if i not in cur]
+        else:
+            cur = [i for i in cur if i not in items]
+        fields = {cmd: cur}
+    elif cmd in ("disable", "enable") and len(args) == 2 and args[1] in RULE_FAMILIES:
+        # enabled нужен для семейств, выключенных по умолчанию (DEFAULT_DISABLED_FAMILIES)
+        disabled, enabled = set(doc.get("disabled", [])), set(doc.get("enabled", []))
+        if cmd == "disable":
+            disabled.add(args[1])
+            enabled.discard(args[1])
+        else:
+            disabled.discard(args[1])
+            enabled.add(args[1])
+        fields = {"disabled": sorted(disabled), "enabled": sorted(enabled)}
+    elif cmd == "avatar" and len(args) == 3:
+        try:
+            hard, soft = float(args[1]), float(args[2])
+        except ValueError:
+            hard = soft = float("nan")
+        if valid_avatar_thresholds(hard, soft):
+            fields = {"avatar_hard": hard, "avatar_soft": soft}
+    elif cmd == "reset":
+        await chat_config_col.delete_one({"_id": chat_id})
+        await CHAT_OVERLAYS.refresh()
+        bump_config_generation()
+        await update.message.reply_text("Сброшено.\n" + format_chat_overlay(chat_id, CHAT_OVERLAYS.get(chat_id)))
+        return
+    if fields is None:
+        await update.message.reply_text(CHATCFG_USAGE)
+        return
+
+    await chat_config_col.update_one({"_id": chat_id}, {"$set": fields, "$inc": {"version": 1}}, upsert=True)
+    await CHAT_OVERLAYS.refresh()
+    bump_config_generation()
+    await update.message.reply_text("Сохранено.\n" + format_chat_overlay(chat_id, CHAT_OVERLAYS.get(chat_id)))
+
+# --- /forgetavatar <pHash>: убрать спам-аватарку (и похожие в пределах AVATAR_HASH_DISTANCE) ---
+async def forget_avatar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("Нет доступа.")
+        return
+    args = context.args or []
+    if len(args) != 1 or not re.fullmatch(r"[0-9a-fA-F]{1,16}", args[0]):
+        await update.message.reply_text("Использование: /forgetavatar <pHash из уведомления о бане>")
+        return
+    hashes = SPAM_AVATARS.near(int(args[0], 16))
+    if not hashes:
+        await update.message.reply_text("Такой спам-аватарки нет.")
+        return
+    for h in hashes:
+        SPAM_AVATARS.discard(h)
+    await spam_avatars_col.delete_many({"_id": {"$in": [format(h, "016x") for h in hashes]}})
+    await update.message.reply_text(f"Удалено хэшей: {len(hashes)}\n" + "\n".join(f"{h:016x}" for h in hashes))
 
 # --- /analyzeone: множественный выбор фраз с хэшами ---
 async def analyzeone(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -245,7 +2464,7 @@ async def analyzeone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = " ".join(context.args)
-    cfg = load_config()
+    cfg = await load_config()
     stop_phrases = cfg.get("PERMANENT_BLOCK_PHRASES", [])
 
     parts = re.split(r"[.,;:\-!?]", text)
@@ -258,37 +2477,48 @@ async def analyzeone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     keyboard = []
-    PHRASE_HASH_MAP.clear()
+    phrases = {}
     for c in candidates:
         sh = hashlib.sha1(c.encode()).hexdigest()[:8]
-        PHRASE_HASH_MAP[sh] = c
+        phrases[sh] = c
         keyboard.append([InlineKeyboardButton(text=f"☐ {c}", callback_data=f"toggle_{sh}_0")])
     keyboard.append([InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_phrases")])
 
-    await update.message.reply_text(
+    reply = await update.message.reply_text(
         "Выбери фразы для добавления в стоп-лист (можно несколько):",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    context.user_data["selected_phrases"] = set()
+    # Сессия выбора привязана к сообщению с кнопками — параллельные /analyzeone не мешают друг другу
+    await STATE.set(_analyzeone_key(reply), {"phrases": phrases, "selected": []}, ANALYZEONE_SESSION_TTL)
+
+def _analyzeone_key(message) -> str:
+    return f"analyzeone:{message.chat.id}:{message.message_id}"
 
 async def select_phrase_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data or ""
+    key = _analyzeone_key(query.message)
+    session = await STATE.get(key)
+    if session is None:
+        await query.answer("Сессия устарела, запусти /analyzeone заново.")
+        return
+    phrases = session["phrases"]
 
     if data.startswith("toggle_"):
         parts = data.split("_")
         sh = parts[1]
         selected_flag = parts[2] == "1"
 
-        selected = context.user_data.get("selected_phrases", set())
+        selected = set(session["selected"])
         if not selected_flag:
             selected.add(sh)
         else:
             selected.discard(sh)
-        context.user_data["selected_phrases"] = selected
+        session["selected"] = sorted(selected)
+        await STATE.set(key, session, ANALYZEONE_SESSION_TTL)
 
         keyboard = []
-        for k, phrase in PHRASE_HASH_MAP.items():
+        for k, phrase in phrases.items():
             checked = "☑️" if k in selected else "☐"
             cb_sel = "1" if k in selected else "0"
             keyboard.append([InlineKeyboardButton(text=f"{checked} {phrase}", callback_data=f"toggle_{k}_{cb_sel}")])
@@ -297,182 +2527,201 @@ async def select_phrase_callback(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     if data == "confirm_phrases":
-        selected = context.user_data.get("selected_phrases", set())
+        selected = session["selected"]
         if not selected:
             await query.answer("Ничего не выбрано.")
             return
-        cfg = load_config()
-        to_add = [PHRASE_HASH_MAP[s] for s in selected if s in PHRASE_HASH_MAP]
+        cfg = await load_config()
+        to_add = [phrases[s] for s in selected if s in phrases]
         for phrase in to_add:
             if phrase not in cfg.get("PERMANENT_BLOCK_PHRASES", []):
                 cfg.setdefault("PERMANENT_BLOCK_PHRASES", []).append(phrase)
-        save_config(cfg)
+        await save_config(cfg)
         await query.edit_message_text("Фразы добавлены:\n" + "\n".join(to_add))
-        context.user_data["selected_phrases"] = set()
+        await STATE.delete(key)
         return
 
 # ===================== Хэндлеры антиспама =====================
 
+# Вариационные селекторы и ZWJ: убираем из имени перед сравнением
+_VARIATION_RE = re.compile(r'[\uFE00-\uFE0F\u200D]')
+
+def display_name(first_name: str | None, last_name: str | None) -> str:
+    full_name = (first_name or "") + (f" | {last_name}" if last_name else "")
+    return _VARIATION_RE.sub('', full_name)
+
+def identity_fingerprint(user, chat_version: int = 0) -> int:
+    """
+    Стабильный (между перезапусками) отпечаток имени и username.
+    chat_version — версия настроек чата: их смена, как и смена имени, требует новой полной проверки.
+    """
+    return zlib.crc32("\x00".join((user.first_name or "", user.last_name or "", user.username or "")).encode(), chat_version)
+
+def identity_rule(f: MessageFeatures, rules: CompiledRules) -> str | None:
+    """Проверки, зависящие только от имени и username: название сработавшего правила или None."""
+    # Ник с одинаковыми эмодзи по краям
+    if f.emoji_edges:
+        return "emoji_edge"
+    if "💋" in f.display_name:
+        return "kiss_emoji"
+    if rules.name_substrings.first(f.name_normalized) >= 0:
+        return "name_substring"
+    if rules.full_names and f.name_lemmas in rules.full_names:
+        return "full_name"
+    if f.username and rules.username_substrings.first(f.username_normalized) >= 0:
+        return "username_substring"
+    if rules.symbols.first(f.display_name) >= 0:
+        return "symbol"
+    return None
+
+# (first_name, last_name, username, версия конфига) -> сработавшее правило или "" (чисто)
+IDENTITY_CACHE = LRUCache(IDENTITY_CACHE_SIZE)
+
+def cached_identity_rule(f: MessageFeatures) -> str | None:
+    key = (f.first_name, f.last_name, f.username, CONFIG.version)
+    rule = IDENTITY_CACHE.get(key)
+    if rule is None:
+        rule = identity_rule(f, CONFIG.rules) or ""
+        IDENTITY_CACHE.set(key, rule)
+    return rule or None
+
 async def delete_spam_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message or update.channel_post
     if not msg:
         return
-
-    # 0) Сообщение только из эмодзи — удаляем
-    if msg.text and is_only_emojis(msg.text):
-        try:
-            await context.bot.delete_message(chat_id=msg.chat.id, message_id=msg.message_id)
-        except Exception:
-            pass
-        return
-
+    t_start = t = perf_counter()
     user = msg.from_user
     text = msg.text or ""
-    cfg = load_config()
-    proc_text = lemmatize_text(normalize_text(text))
+    ov = CHAT_OVERLAYS.get(msg.chat.id)
 
-    # 1) Проверка аватара (кроме исключённых чатов)
-    if msg.chat and msg.chat.id not in EXCLUDE_NSFW_CHAT_IDS:
-        try:
-            ratio = await avatar_skin_ratio(user.id, context.bot)
-            decision = avatar_decision(ratio)
-            if decision == "hard":
-                try:
-                    await context.bot.delete_message(chat_id=msg.chat.id, message_id=msg.message_id)
-                except Exception:
-                    pass
-                try:
-                    await context.bot.ban_chat_member(chat_id=msg.chat.id, user_id=user.id)
-                except Exception:
-                    pass
-                await send_admin_notification(
-                    context.bot,
-                    f"БАН по аватарке (skin_ratio={ratio:.2f}): @{user.username or user.first_name} ({user.id})"
-                )
-                return
-            elif decision == "soft":
-                await send_admin_notification(
-                    context.bot,
-                    f"ПРЕДУПРЕЖДЕНИЕ по аватарке (skin_ratio={ratio:.2f}): @{user.username or user.first_name} ({user.id})"
-                )
-        except Exception as e:
-            print("avatar check in message failed:", e)
-
-    # 2) Ник с одинаковыми эмодзи по краям -> бан
-    name = (user.first_name or "") + (f" {user.last_name}" if user.last_name else "")
-    match = regex.match(r"^(?P<emoji>\X)\s?.+\s?(?P=emoji)$", name, flags=regex.UNICODE)
-    if match and len(match.group("emoji")) > 0:
-        try:
-            await context.bot.delete_message(chat_id=msg.chat.id, message_id=msg.message_id)
-        except Exception:
-            pass
-        try:
-            await context.bot.ban_chat_member(chat_id=msg.chat.id, user_id=user.id)
-        except Exception:
-            pass
+    # 0) Сообщение только из эмодзи — удаляем, ничего больше не считая
+    if ov.enabled("emoji_only") and is_only_emojis(text):
+        OUTBOUND.delete(msg.chat.id, msg.message_id)
+        METRICS.inc("moderation_verdicts_total", (("rule", "emoji_only"),))
         return
 
-    # 3) Остальные правила из конфига
-    full_name = (user.first_name or "") + (f" | {user.last_name}" if user.last_name else "")
-    clean_name = re.sub(r'[\uFE00-\uFE0F\u200D]', '', full_name)
-    name_lower = normalize_text(clean_name)
-
-    ban = False
-
-    if "💋" in clean_name:
-        ban = True
-
-    if not ban:
-        for substr in cfg.get("BANNED_NAME_SUBSTRINGS", []):
-            if normalize_text(substr) in name_lower:
-                ban = True
-                break
-
-    if not ban:
-        norm_name = lemmatize_text(name_lower)
-        banned_norms = [lemmatize_text(normalize_text(n)) for n in cfg.get("BANNED_FULL_NAMES", [])]
-        if norm_name in banned_norms:
-            ban = True
-
-    if not ban and user.username:
-        username_lower = normalize_text(user.username)
-        for substr in cfg.get("BANNED_USERNAME_SUBSTRINGS", []):
-            if normalize_text(substr) in username_lower:
-                ban = True
-                break
-
-    if not ban:
-        matched = [s for s in cfg.get("BANNED_SYMBOLS", []) if s in clean_name]
-        if matched:
-            ban = True
-
-    def clean_for_match(s: str) -> str:
-        return re.sub(r'[^a-zA-Zа-яА-Я0-9]', '', (s or '').lower())
-
-    text_raw_clean = clean_for_match(text)
-    if not ban:
-        for w in cfg.get("BANNED_WORDS", []):
-            if clean_for_match(w) in text_raw_clean:
-                ban = True
-                break
+    f = MessageFeatures.of(text, user)
+    t = METRICS.lap("moderation_stage_seconds", t, (("handler", "message"), ("stage", "features")))
+
+    rules = CONFIG.rules
+
+    # Доверенным пользователям с неизменными именем/конфигом/настройками чата — только текстовые правила
+    fingerprint = identity_fingerprint(user, ov.version)
+    trusted = REPUTATION.is_trusted(msg.chat.id, user.id, fingerprint, CONFIG.version)
+
+    # Частота: флуд, волна одинаковых сообщений, новички во время рейда — O(1) на сообщение
+    raid = False
+    if ov.enabled("flood") or ov.enabled("raid"):
+        newcomer = not trusted and not REPUTATION.is_established(msg.chat.id, user.id)
+        flood = FLOOD.on_message(msg.chat.id, user.id, f, newcomer, ov.enabled("flood"), ov.enabled("raid"))
+        if flood and not trusted:
+            # бан за частоту, а не за содержание: в корпус спама и SimHash текст не попадает
+            FLOOD.queue_ban(msg.chat.id, user.id, msg.message_id, flood)
+            REPUTATION.forget(msg.chat.id, user.id)
+            METRICS.inc("moderation_verdicts_total", (("rule", flood),))
+            METRICS.lap("moderation_seconds", t_start, (("handler", "message"),))
+            return
+        raid = ov.enabled("raid") and FLOOD.in_raid(msg.chat.id)
+    METRICS.inc("moderation_path_total", (("path", "trusted" if trusted else "raid" if raid else "full"),))
+
+    rule = None  # какое правило сработало
+    avatar = NO_AVATAR
+    # полная проверка засчитывается, только если аватарка действительно проверена: не при рейде
+    # и не при AvatarCheckFailed (или отключена в чате — тогда её включение сменит ov.version)
+    avatar_ok = not ov.enabled("avatar")
+    if not trusted:
+        # 1) Проверка аватара (если не отключена в чате; во время рейда пропускаем — это самое дорогое)
+        if ov.enabled("avatar") and not raid:
+            try:
+                avatar = await avatar_check(user.id, context.bot)
+                decision = avatar_decision(avatar, ov.avatar_hard, ov.avatar_soft)
+                avatar_ok = decision == "ok"
+                t = METRICS.lap("moderation_stage_seconds", t, (("handler", "message"), ("stage", "avatar")))
+                if decision in ("known", "hard"):
+                    OUTBOUND.punish(msg.chat.id, user.id, msg.message_id)
+                    REPUTATION.forget(msg.chat.id, user.id)
+                    remember_spam_avatar(avatar.phash, user.id)
+                    OUTBOUND.notify_admin(
+                        f"БАН по аватарке ({avatar_reason(avatar, decision)}): @{user.username or user.first_name} ({user.id})"
+                    )
+                    METRICS.inc("moderation_verdicts_total", (("rule", f"avatar_{decision}"),))
+                    return
+                elif decision == "soft":
+                    OUTBOUND.notify_admin(
+                        f"ПРЕДУПРЕЖДЕНИЕ по аватарке ({avatar_reason(avatar, decision)}): @{user.username or user.first_name} ({user.id})"
+                    )
+                    METRICS.inc("moderation_verdicts_total", (("rule", "avatar_soft"),))
+            except Exception as e:
+                print("avatar check in message failed:", e)
+
+        # 2) Имя и username
+        if ov.enabled("identity"):
+            rule = cached_identity_rule(f)
+        t = METRICS.lap("moderation_stage_seconds", t, (("handler", "message"), ("stage", "identity")))
+        if rule == "emoji_edge":
+            OUTBOUND.punish(msg.chat.id, user.id, msg.message_id)
+            REPUTATION.forget(msg.chat.id, user.id)
+            METRICS.inc("moderation_verdicts_total", (("rule", rule),))
+            return
 
-    if not ban:
-        for phrase in cfg.get("PERMANENT_BLOCK_PHRASES", []):
-            if lemmatize_text(normalize_text(phrase)) in proc_text:
-                ban = True
-                break
+    # 3) Правила по тексту
+    if not rule:
+        rule = text_rule(f, rules, ov.disabled) or ov.text_rule(f)
 
-    if not ban:
-        for combo in cfg.get("COMBINED_BLOCKS", []):
-            if all(lemmatize_text(normalize_text(w)) in proc_text for w in combo):
-                ban = True
-                break
+    if not rule and ov.enabled("near_duplicate") and is_near_duplicate(f):
+        rule = "near_duplicate"
+    METRICS.lap("moderation_stage_seconds", t, (("handler", "message"), ("stage", "text_rules")))
 
-    if ban:
-        try:
-            await context.bot.delete_message(chat_id=msg.chat.id, message_id=msg.message_id)
-        except Exception:
-            pass
-        try:
-            await context.bot.ban_chat_member(chat_id=msg.chat.id, user_id=user.id)
-        except Exception:
-            pass
+    METRICS.inc("moderation_verdicts_total", (("rule", rule or "clean"),))
+    if rule:
+        OUTBOUND.punish(msg.chat.id, user.id, msg.message_id)
+        REPUTATION.forget(msg.chat.id, user.id)
         notif = (
             f"Забанен: @{user.username or user.first_name}\n"
-            f"Имя: {clean_name}\n"
+            f"Имя: {f.display_name}\n"
             f"Дата: {get_tyumen_time()}\n"
             f"Сообщение: {text}"
         )
-        await send_admin_notification(context.bot, notif)
-        add_banned_message(text)
+        OUTBOUND.notify_admin(notif)
+        if rule not in CHAT_LOCAL_RULES:
+            add_banned_message(text, msg.chat.id, user.id, rule)
+    else:
+        sample_clean_message(text)
+        # полную проверку засчитываем, только если аватарка не вызвала даже предупреждения
+        full_check = not trusted and avatar_ok
+        REPUTATION.record_clean(msg.chat.id, user.id, fingerprint, CONFIG.version, full_check)
+    METRICS.lap("moderation_seconds", t_start, (("handler", "message"),))
 
 # Новые участники
 async def on_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
     chat_id = update.effective_chat.id
+    ov = CHAT_OVERLAYS.get(chat_id)
     for u in update.message.new_chat_members:
-        if chat_id in EXCLUDE_NSFW_CHAT_IDS:
+        t = perf_counter()
+        # во время рейда аватарки не проверяем, вошедших запоминаем для FloodGuard.on_message
+        raid = FLOOD.on_join(chat_id, u.id) if ov.enabled("raid") else False
+        if not ov.enabled("avatar") or raid:
             continue
         try:
-            ratio = await avatar_skin_ratio(u.id, context.bot)
-            decision = avatar_decision(ratio)
-            if decision == "hard":
-                try:
-                    await context.bot.ban_chat_member(chat_id, u.id)
-                except Exception:
-                    pass
-                await send_admin_notification(
-                    context.bot,
-                    f"БАН при входе по аватарке (skin_ratio={ratio:.2f}): @{u.username or u.first_name} ({u.id})"
+            avatar = await avatar_check(u.id, context.bot)
+            decision = avatar_decision(avatar, ov.avatar_hard, ov.avatar_soft)
+            METRICS.lap("moderation_stage_seconds", t, (("handler", "new_member"), ("stage", "avatar")))
+            METRICS.inc("new_member_verdicts_total", (("decision", decision),))
+            if decision in ("known", "hard"):
+                OUTBOUND.punish(chat_id, u.id)
+                remember_spam_avatar(avatar.phash, u.id)
+                OUTBOUND.notify_admin(
+                    f"БАН при входе по аватарке ({avatar_reason(avatar, decision)}): @{u.username or u.first_name} ({u.id})"
                 )
             elif decision == "soft":
-                await send_admin_notification(
-                    context.bot,
-                    f"ПРЕДУПРЕЖДЕНИЕ при входе (skin_ratio={ratio:.2f}): @{u.username or u.first_name} ({u.id})"
+                OUTBOUND.notify_admin(
+                    f"ПРЕДУПРЕЖДЕНИЕ при входе ({avatar_reason(avatar, decision)}): @{u.username or u.first_name} ({u.id})"
                 )
         except Exception as e:
             print("new member avatar check error:", e)
+        METRICS.lap("moderation_seconds", t, (("handler", "new_member"),))
 
 # ===================== addspam диалог =====================
 
@@ -519,7 +2768,7 @@ async def addspam_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def addspam_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = update.message.text.strip()
     spam_type = context.user_data["addspam_type"]
-    cfg = load_config()
+    cfg = await load_config()
     if spam_type == 1:
         cfg.setdefault("BANNED_WORDS", []).append(value)
         await update.message.reply_text(f"Слово добавлено: {value}")
@@ -538,7 +2787,7 @@ async def addspam_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif spam_type == 7:
         cfg.setdefault("BANNED_USERNAME_SUBSTRINGS", []).append(value)
         await update.message.reply_text(f"Подстрока в username добавлена: {value}")
-    save_config(cfg)
+    await save_config(cfg)
     return ConversationHandler.END
 
 async def addspam_combo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -547,9 +2796,9 @@ async def addspam_combo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(words) < 2:
         await update.message.reply_text("Нужно минимум два слова через запятую.")
         return ADD_COMBO
-    cfg = load_config()
+    cfg = await load_config()
     cfg.setdefault("COMBINED_BLOCKS", []).append(words)
-    save_config(cfg)
+    await save_config(cfg)
     await update.message.reply_text(f"Комбинация добавлена: {', '.join(words)}")
     return ConversationHandler.END
 
@@ -573,42 +2822,199 @@ addspam_conv = ConversationHandler(
 async def addword_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     word = (query.data or "").replace("addword_", "")
-    cfg = load_config()
+    cfg = await load_config()
     if word and word not in cfg.get("BANNED_WORDS", []):
         cfg.setdefault("BANNED_WORDS", []).append(word)
-        save_config(cfg)
+        await save_config(cfg)
         await query.answer("Слово добавлено!")
         await query.edit_message_text(f"Слово добавлено: {word}")
     else:
         await query.answer("Уже в списке!")
 
-async def set_commands(app):
+async def set_commands(bot):
     commands = [
         BotCommand("addspam", "Добавить спам-слово/фразу"),
         BotCommand("spamlist", "Показать текущий стоп-лист"),
         BotCommand("analyzeone", "Анализировать сообщение"),
+        BotCommand("evaluate", "Оценить правила на истории"),
+        BotCommand("chatcfg", "Настройки правил чата"),
+        BotCommand("forgetavatar", "Убрать спам-аватарку"),
         BotCommand("start", "Информация о боте"),
     ]
-    await app.bot.set_my_commands(commands)
+    await bot.set_my_commands(commands)
 
 # ===================== Веб-сервер / запуск =====================
 
-async def handle_webhook(request, app):
+class UpdateDispatcher:
+    """
+    Очередь между вебхуком и PTB: вебхук только кладёт апдейт и сразу отвечает 200.
+    Апдейты шардируются по chat_id на воркеры — внутри чата порядок сохраняется,
+    разные чаты обрабатываются параллельно. Если очередь шарда не освободилась
+    за enqueue_timeout, апдейт сбрасывается (shed), вебхук отвечает 503 и Telegram
+    доставит его повторно позже.
+    """
+    def __init__(self, app, workers: int, max_queue: int, enqueue_timeout: float):
+        self.app = app
+        self.enqueue_timeout = enqueue_timeout
+        self.queues = [asyncio.Queue(max_queue) for _ in range(workers)]
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed = 0
+        self._tasks: list[asyncio.Task] = []
+
+    def _shard(self, update: Update) -> int:
+        chat = update.effective_chat
+        user = update.effective_user
+        key = chat.id if chat else (user.id if user else update.update_id)
+        return key % len(self.queues)
+
+    async def submit(self, update: Update) -> bool:
+        q = self.queues[self._shard(update)]
+        try:
+            q.put_nowait(update)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(q.put(update), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                return False
+        self.enqueued += 1
+        return True
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(q)) for q in self.queues]
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            update = await q.get()
+            try:
+                await self.app.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("process_update error:", e)
+            finally:
+                q.task_done()
+
+    def stats(self) -> dict:
+        depths = [q.qsize() for q in self.queues]
+        return {
+            "queue_depth": sum(depths),
+            "queue_depth_max": max(depths),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "shed": self.shed,
+        }
+
+    async def close(self, timeout: float = 10):
+        """Дать воркерам дообработать очередь (не дольше timeout) и остановить их."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print("UpdateDispatcher: не успели обработать", self.stats()["queue_depth"], "апдейтов")
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+DISPATCHER: UpdateDispatcher | None = None
+BOT_APP = None  # PTB Application, появляется после прогрева
+
+# Пока сервис прогревается, вебхук складывает сюда сырые апдейты (dict) и сразу отвечает 200
+_PENDING_UPDATES: deque = deque()
+# Длительность этапов старта (сек); отдаётся в /ready и /metrics
+STARTUP_TIMINGS: dict[str, float] = {}
+
+def _startup_lap(stage: str, since: float) -> float:
+    t = perf_counter()
+    STARTUP_TIMINGS[stage] = round(t - since, 4)
+    print(f"⏱ {stage}: {STARTUP_TIMINGS[stage]:.3f} с")
+    return t
+
+async def handle_webhook(request):
     data = await request.json()
-    update = Update.de_json(data, app.bot)
-    await app.process_update(update)
+    if POOL is not None:
+        if not POOL.submit(data):
+            return web.Response(status=503, text="overloaded")
+        return web.Response(text="OK")
+    if DISPATCHER is None:
+        if len(_PENDING_UPDATES) >= STARTUP_QUEUE_MAX:
+            return web.Response(status=503, text="starting")
+        _PENDING_UPDATES.append(data)
+        return web.Response(text="OK")
+    update = Update.de_json(data, BOT_APP.bot)
+    if not await DISPATCHER.submit(update):
+        return web.Response(status=503, text="overloaded")
     return web.Response(text="OK")
 
-async def init_app():
-    port  = int(os.environ.get("PORT", 8443))
-    TOKEN = os.getenv("BOT_TOKEN")
-    if not TOKEN:
-        raise RuntimeError("BOT_TOKEN не задан")
-    base = os.getenv("WEBHOOK_URL") or f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}"
-    webhook_url = f"{base}/webhook"
-    print("🔗 Webhook:", webhook_url)
-
-    app = ApplicationBuilder().token(TOKEN).build()
+async def handle_ready(request):
+    """Readiness: 200, когда прогрев закончен и апдейты обрабатываются, иначе 503."""
+    ready = POOL.is_ready() if POOL is not None else DISPATCHER is not None
+    body = {"ready": ready, "pending": len(_PENDING_UPDATES), "startup": STARTUP_TIMINGS}
+    return web.json_response(body, status=200 if ready else 503)
+
+async def handle_stats(request):
+    if POOL is not None:
+        return web.json_response({"workers": POOL.stats()})
+    updates = DISPATCHER.stats() if DISPATCHER else {"pending": len(_PENDING_UPDATES)}
+    return web.json_response({"updates": updates, "banned_writer": BANNED_WRITER.stats()})
+
+async def handle_metrics(request):
+    return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+def register_metrics():
+    """Метрики, которые уже считаются в самих компонентах, — отдаём их значения при каждом /metrics."""
+    def cache_stats():
+        lemma = normal_form.cache_info()
+        return {
+            (("cache", "avatar_user"), ("result", "hit")): AVATAR_CACHE.hits,
+            (("cache", "avatar_user"), ("result", "miss")): AVATAR_CACHE.misses,
+            (("cache", "avatar_file"), ("result", "hit")): AVATAR_FILE_CACHE.hits,
+            (("cache", "avatar_file"), ("result", "miss")): AVATAR_FILE_CACHE.misses,
+            (("cache", "identity"), ("result", "hit")): IDENTITY_CACHE.hits,
+            (("cache", "identity"), ("result", "miss")): IDENTITY_CACHE.misses,
+            (("cache", "lemma"), ("result", "hit")): lemma.hits,
+            (("cache", "lemma"), ("result", "miss")): lemma.misses,
+        }
+    METRICS.callback("cache_requests_total", "counter", cache_stats)
+    METRICS.callback("cache_entries", "gauge", lambda: {
+        (("cache", "avatar_user"),): len(AVATAR_CACHE),
+        (("cache", "avatar_file"),): len(AVATAR_FILE_CACHE),
+        (("cache", "identity"),): len(IDENTITY_CACHE),
+        (("cache", "lemma"),): normal_form.cache_info().currsize,
+    })
+    METRICS.callback("update_queue", "gauge", lambda: {
+        (("stat", k),): v for k, v in DISPATCHER.stats().items()
+    } if DISPATCHER else {(("stat", "pending"),): len(_PENDING_UPDATES)})
+    METRICS.callback("banned_writer", "gauge", lambda: {
+        (("stat", k),): v for k, v in BANNED_WRITER.stats().items()
+    })
+    METRICS.callback("outbound_calls_total", "counter", lambda: {
+        (("result", "sent"),): OUTBOUND.sent,
+        (("result", "retried"),): OUTBOUND.retried,
+        (("result", "failed"),): OUTBOUND.failed,
+    })
+    METRICS.callback("config_version", "gauge", lambda: CONFIG.version)
+    METRICS.callback("chat_overlays", "gauge", lambda: len(CHAT_OVERLAYS))
+    METRICS.callback("flood_guard", "gauge", lambda: {
+        (("stat", k),): v for k, v in FLOOD.stats().items()
+    })
+    METRICS.callback("reputation_entries", "gauge", lambda: len(REPUTATION))
+    METRICS.callback("spam_avatar_hashes", "gauge", lambda: len(SPAM_AVATARS))
+    METRICS.callback("spam_text_hashes", "gauge", lambda: len(SPAM_TEXTS))
+    METRICS.callback("startup_seconds", "gauge", lambda: {
+        (("stage", k),): v for k, v in STARTUP_TIMINGS.items()
+    })
+    METRICS.callback("ready", "gauge", lambda: int(POOL.is_ready() if POOL is not None else DISPATCHER is not None))
+    METRICS.callback("worker_pool", "gauge", lambda: {
+        (("stat", k),): v for k, v in POOL.stats().items()
+    } if POOL is not None else {})
+
+def build_bot_app(token: str):
+    app = (ApplicationBuilder().token(token).base_url(BOT_API_URL).base_file_url(BOT_API_FILE_URL)
+           .request(MeteredRequest(connection_pool_size=256)).build())
     # Команды/диалоги
     app.add_handler(addspam_conv)
     app.add_handler(CommandHandler("spamlist", spamlist))
@@ -616,6 +3022,9 @@ async def init_app():
     app.add_handler(CommandHandler("menu", menu_command))
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("analyzeone", analyzeone))
+    app.add_handler(CommandHandler("evaluate", evaluate_command))
+    app.add_handler(CommandHandler("chatcfg", chatcfg))
+    app.add_handler(CommandHandler("forgetavatar", forget_avatar))
 
     # Коллбэки кнопок выбора фраз
     app.add_handler(CallbackQueryHandler(select_phrase_callback, pattern="^(toggle_|confirm_phrases)"))
@@ -626,25 +3035,362 @@ async def init_app():
 
     # Антиспам (ставь в самый низ!)
     app.add_handler(MessageHandler(filters.ALL, delete_spam_message))
+    return app
 
+async def warmup(token: str, webhook_url: str | None, enqueue_timeout: float | None = UPDATE_ENQUEUE_TIMEOUT):
+    """
+    Всё тяжёлое после открытия порта: словари pymorphy2 (в потоке, параллельно с Mongo),
+    конфиг и правила, индексы и состояние из Mongo, инициализация бота и вебхука
+    (webhook_url=None — воркер, вебхук ставит мастер).
+    В конце обрабатываем накопленные апдейты и включаем обычный путь через DISPATCHER.
+    """
+    global DISPATCHER, BOT_APP
+    loop = asyncio.get_running_loop()
+    t0 = t = perf_counter()
+    morph_ready = loop.run_in_executor(None, get_morph)
+
+    await CONFIG.load()
+    CONFIG.start()
+    t = _startup_lap("config", t)
+    await ensure_indexes()
+    t = _startup_lap("indexes", t)
+    await load_spam_avatars()
+    await load_spam_texts()
+    await REPUTATION.load()
+    t = _startup_lap("state", t)
+    BANNED_WRITER.start()
+    CLEAN_WRITER.start()
+    TERM_STATS.start()
+    REPUTATION.start()
+
+    app = build_bot_app(token)
     await app.initialize()
-    await set_commands(app)
-    await app.bot.set_webhook(webhook_url)
+    if webhook_url:
+        await set_commands(app.bot)
+        await app.bot.set_webhook(webhook_url)
+    OUTBOUND.start(app.bot)
+    FLOOD.start()
+    BOT_APP = app
+    t = _startup_lap("bot", t)
+
+    await morph_ready
+    t = _startup_lap("morph_wait", t)
+    # Лемматизация правил ждёт словари: до их загрузки get_morph() держал бы event loop на блокировке,
+    # поэтому автоматы собираем только сейчас и в потоке (надстройки чатов маленькие — на месте)
+    await CONFIG.precompile()
+    await CHAT_OVERLAYS.refresh()
+    CHAT_OVERLAYS.start()
+    t = _startup_lap("rules", t)
+
+    dispatcher = UpdateDispatcher(app, UPDATE_WORKERS, UPDATE_QUEUE_MAX, enqueue_timeout)
+    dispatcher.start()
+    # пока DISPATCHER не выставлен, новые апдейты продолжают копиться в _PENDING_UPDATES —
+    # так порядок внутри чата не нарушается
+    drained, dropped = await drain_pending_updates(dispatcher, app.bot)
+    DISPATCHER = dispatcher
+    _startup_lap("drain", t)
+    _startup_lap("warmup", t0)
+    _startup_lap("total", T_PROCESS_START)
+    print(f"✅ Готов, накопленных апдейтов: {drained}" + (f", потеряно: {dropped}" if dropped else ""))
+
+async def drain_pending_updates(dispatcher: UpdateDispatcher, bot, attempts: int = 5) -> tuple[int, int]:
+    """
+    Передать диспетчеру апдейты, накопленные за прогрев: (передано, потеряно).
+    На них Telegram уже получил 200 и повторять не будет, поэтому в полную очередь пробуем
+    attempts раз (каждый — с ожиданием enqueue_timeout); что так и не вошло или не разобралось —
+    в лог и в startup_updates_dropped_total.
+    """
+    drained = dropped = 0
+    while _PENDING_UPDATES:
+        data = _PENDING_UPDATES.popleft()
+        try:
+            update = Update.de_json(data, bot)
+            for _ in range(attempts):
+                if await dispatcher.submit(update):
+                    drained += 1
+                    break
+            else:
+                raise RuntimeError("очередь диспетчера полна")
+        except Exception as e:
+            dropped += 1
+            METRICS.inc("startup_updates_dropped_total")
+            print(f"Накопленный апдейт {data.get('update_id')} потерян:", e)
+    return drained, dropped
+
+# ===================== Многопроцессный режим =====================
+
+def update_shard_key(data: dict) -> int:
+    """Ключ шардирования сырого апдейта: chat_id (как effective_chat у PTB), иначе id пользователя, иначе update_id."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post",
+                  "my_chat_member", "chat_member", "chat_join_request"):
+        obj = data.get(field)
+        if obj and "chat" in obj:
+            return obj["chat"]["id"]
+    query = data.get("callback_query")
+    if query:
+        msg = query.get("message")
+        return msg["chat"]["id"] if msg and "chat" in msg else query["from"]["id"]
+    for obj in data.values():
+        if isinstance(obj, dict):
+            user = obj.get("from") or obj.get("user")
+            if user:
+                return user["id"]
+    return data.get("update_id", 0)
+
+class WorkerPool:
+    """
+    Мастер многопроцессного режима: держит HTTP-порт и раскладывает сырые апдейты
+    по процессам-воркерам через multiprocessing-очереди, шардируя по chat_id —
+    чат целиком живёт в одном процессе (порядок, диалоги PTB, репутация, лимиты чата).
+    Переполненная очередь воркера -> вебхук отвечает 503, Telegram повторит позже.
+    Упавший воркер перезапускается на той же очереди.
+    """
+    def __init__(self, workers: int, token: str, max_queue: int):
+        self.token = token
+        self._ctx = multiprocessing.get_context("spawn")  # fork небезопасен для motor/потоков
+        self.queues = [self._ctx.Queue(max_queue) for _ in range(workers)]
+        self.ready = [self._ctx.Event() for _ in range(workers)]
+        self.config_generation = self._ctx.Value("q", 0)
+        self.procs: list = [None] * workers
+        self.routed = [0] * workers
+        self.shed = 0
+        self.restarts = 0
+        self._closing = False
+        self._task = None
+
+    def _spawn(self, index: int):
+        self.ready[index].clear()
+        p = self._ctx.Process(
+            target=worker_process,
+            args=(index, self.queues[index], self.ready[index], self.token, self.config_generation),
+            name=f"antispam-worker-{index}",
+        )
+        p.start()
+        self.procs[index] = p
+
+    def start(self):
+        for i in range(len(self.procs)):
+            self._spawn(i)
+
+    def watch(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self, interval: float = 2.0):
+        while not self._closing:
+            await asyncio.sleep(interval)
+            for i, p in enumerate(self.procs):
+                if p is not None and not p.is_alive() and not self._closing:
+                    print(f"Воркер {i} завершился (код {p.exitcode}), перезапускаю")
+                    self.restarts += 1
+                    self._spawn(i)
+
+    def submit(self, data: dict) -> bool:
+        i = update_shard_key(data) % len(self.queues)
+        try:
+            self.queues[i].put_nowait(data)
+        except queue.Full:
+            self.shed += 1
+            return False
+        self.routed[i] += 1
+        return True
+
+    def is_ready(self) -> bool:
+        return all(e.is_set() for e in self.ready)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.procs),
+            "workers_ready": sum(e.is_set() for e in self.ready),
+            "routed": sum(self.routed),
+            "routed_max_share": round(max(self.routed) / max(sum(self.routed), 1), 3),
+            "shed": self.shed,
+            "restarts": self.restarts,
+        }
+
+    def _stop_sync(self, timeout: float):
+        for q in self.queues:
+            try:
+                q.put(None, timeout=timeout)  # воркер дообработает очередь до None и выйдет
+            except queue.Full:
+                pass
+        deadline = monotonic() + timeout
+        for p in self.procs:
+            if p is None:
+                continue
+            p.join(max(deadline - monotonic(), 0.1))
+            if p.is_alive():
+                print(f"Воркер {p.name} не остановился, terminate")
+                p.terminate()
+
+    async def close(self, timeout: float = 20):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_sync, timeout)
+
+POOL: WorkerPool | None = None
+
+# Счётчик изменений конфига и настроек чатов, общий для воркеров (multiprocessing.Value; None — один процесс).
+# Команда меняет конфиг в одном воркере и увеличивает счётчик, остальные сверяют его перед каждым
+# апдейтом (чтение общей памяти, без Mongo) и сразу перечитывают конфиг, не дожидаясь опроса.
+_CONFIG_GENERATION = None
+_config_generation_seen = 0
+
+def bump_config_generation():
+    if _CONFIG_GENERATION is not None:
+        with _CONFIG_GENERATION.get_lock():
+            _CONFIG_GENERATION.value += 1
+
+async def sync_config_generation():
+    global _config_generation_seen
+    if _CONFIG_GENERATION is None:
+        return
+    generation = _CONFIG_GENERATION.value
+    if generation != _config_generation_seen:
+        _config_generation_seen = generation
+        await CONFIG.invalidate()
+        await CHAT_OVERLAYS.refresh()
+
+def worker_process(index: int, updates, ready, token: str, config_generation=None):
+    """Точка входа процесса-воркера. Сигналы останова ловит мастер и присылает None в очередь."""
+    global _CONFIG_GENERATION, _config_generation_seen
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _CONFIG_GENERATION = config_generation
+    if config_generation is not None:
+        _config_generation_seen = config_generation.value  # прогрев и так читает свежий конфиг
+    asyncio.run(_worker_main(index, updates, ready, token))
+
+def _next_update(updates):
+    try:
+        return updates.get(timeout=1)
+    except queue.Empty:
+        return False
 
+async def _refresh_spam_hashes():
+    """Хэши спама, найденные другими воркерами, попадают в Mongo — периодически подтягиваем их."""
+    while True:
+        await asyncio.sleep(SPAM_HASH_REFRESH_INTERVAL)
+        try:
+            await load_spam_avatars(verbose=False)
+            await load_spam_texts(verbose=False)
+        except Exception as e:
+            print("refresh spam hashes error:", e)
+
+async def _worker_main(index: int, updates, ready, token: str):
+    # без таймаута постановки: пусть переполнится очередь мастера, и он ответит Telegram 503
+    await warmup(token, None, enqueue_timeout=None)
+    refresh = asyncio.get_running_loop().create_task(_refresh_spam_hashes())
+    ready.set()
+    print(f"👷 Воркер {index} готов (pid {os.getpid()})")
+    loop = asyncio.get_running_loop()
+    parent = os.getppid()
+    while True:
+        data = await loop.run_in_executor(None, _next_update, updates)
+        if data is None:
+            break
+        try:
+            await sync_config_generation()
+        except Exception as e:
+            print("config sync error:", e)
+        if data is False:
+            if os.getppid() != parent:  # мастер умер, не дождавшись нас
+                break
+            continue
+        await DISPATCHER.submit(Update.de_json(data, BOT_APP.bot))
+    refresh.cancel()
+    await on_cleanup(None)
+    print(f"Воркер {index} остановлен, обработано: {DISPATCHER.processed}")
+
+async def warmup_master(token: str, webhook_url: str):
+    """Прогрев мастера: команды и вебхук ставит только он, затем ждём готовности всех воркеров."""
+    t0 = t = perf_counter()
+    bot = Bot(token, base_url=BOT_API_URL, base_file_url=BOT_API_FILE_URL, request=MeteredRequest())
+    async with bot:
+        await set_commands(bot)
+        await bot.set_webhook(webhook_url)
+    t = _startup_lap("bot", t)
+    await asyncio.get_running_loop().run_in_executor(None, POOL.start)
+    POOL.watch()
+    while not POOL.is_ready():
+        await asyncio.sleep(0.2)
+    _startup_lap("workers", t)
+    _startup_lap("warmup", t0)
+    _startup_lap("total", T_PROCESS_START)
+    print(f"✅ Готов, воркеров: {len(POOL.procs)}")
+
+def build_web_app():
     web_app = web.Application()
     web_app.router.add_get("/", lambda r: web.Response(text="OK"))
-    web_app.router.add_post("/webhook", lambda r: handle_webhook(r, app))
-    return web_app, port
+    web_app.router.add_get("/healthz", lambda r: web.Response(text="OK"))
+    web_app.router.add_get("/ready", handle_ready)
+    web_app.router.add_get("/stats", handle_stats)
+    web_app.router.add_get("/metrics", handle_metrics)
+    web_app.router.add_post("/webhook", handle_webhook)
+    web_app.on_cleanup.append(on_cleanup)
+    return web_app
+
+async def on_cleanup(web_app):
+    global LAG_MONITOR
+    if LAG_MONITOR is not None:
+        LAG_MONITOR.cancel()
+        LAG_MONITOR = None
+    if POOL is not None:
+        await POOL.close()
+    if DISPATCHER:
+        await DISPATCHER.close()
+    await FLOOD.close()
+    await OUTBOUND.close()
+    if _BACKGROUND_TASKS:
+        await asyncio.wait(list(_BACKGROUND_TASKS), timeout=10)
+    await BANNED_WRITER.close()
+    await CLEAN_WRITER.close()
+    await TERM_STATS.close()
+    await REPUTATION.close()
+    await STATE.close()
 
 async def main():
-    web_app, port = await init_app()
-    runner = web.AppRunner(web_app)
+    global POOL, LAG_MONITOR
+    port = int(os.environ.get("PORT", 8443))
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("BOT_TOKEN не задан")
+    base = os.getenv("WEBHOOK_URL") or f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}"
+    webhook_url = f"{base}/webhook"
+    print("🔗 Webhook:", webhook_url)
+
+    # Сначала открываем порт — Telegram и health-check хостинга получают ответ сразу
+    runner = web.AppRunner(build_web_app())
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
+    _startup_lap("bind", T_PROCESS_START)
     print(f"🚀 Running on port {port}")
-    while True:
-        await asyncio.sleep(3600)
+    register_metrics()
+    LAG_MONITOR = asyncio.get_running_loop().create_task(monitor_loop_lag())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    if WORKERS > 1:
+        POOL = WorkerPool(WORKERS, token, WORKER_QUEUE_MAX)
+        warm = loop.create_task(warmup_master(token, webhook_url))
+    else:
+        warm = loop.create_task(warmup(token, webhook_url))
+    warm.add_done_callback(lambda t: t.cancelled() or t.exception() is None or stop.set())
+    await stop.wait()
+    failed = warm.done() and not warm.cancelled() and warm.exception()
+    if not warm.done():
+        warm.cancel()
+    print("🛑 Остановка, сбрасываю буферы...")
+    await runner.cleanup()
+    if failed:
+        raise failed
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:2] == ["evaluate"]:
+        asyncio.run(evaluate_cli(sys.argv[2:]))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def run():
+    """Выполнить корутину в новом event loop (pytest-asyncio в зависимостях нет)."""
+    def _run(coro):
+        return asyncio.run(coro)
+    return _run
+
+
+@pytest.fixture
+def mongo_db():
+    """База на mongomock_motor — тот же async-интерфейс, что у motor."""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    return mongomock_motor.AsyncMongoMockClient()["antispam_test"]
+
+
+class Recorder:
+    """Подмена OUTBOUND: запоминает исходящие действия вместо вызовов Bot API."""
+    def __init__(self):
+        self.deleted, self.punished, self.notified = [], [], []
+
+    def delete(self, chat_id, message_id):
+        self.deleted.append((chat_id, message_id))
+
+    def punish(self, chat_id, user_id, message_id=None):
+        self.punished.append((chat_id, user_id, message_id))
+
+    def notify_admin(self, text):
+        self.notified.append(text)
+
+
+class NullCollection:
+    """Коллекция, в которую фоновые записи уходят в никуда."""
+    async def update_one(self, *args, **kwargs):
+        pass
+
+    async def find_one(self, *args, **kwargs):
+        return None
+
+
+# настоящие функции — до того, как фикстура их подменит
+ADD_BANNED_MESSAGE = main.add_banned_message
+AVATAR_CHECK = main.avatar_check
+
+
+class Moderation:
+    """Окружение обработчиков без Telegram и Mongo: правила, чаты, аватарки задаются в тесте."""
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.outbound = Recorder()
+        self.bot = None
+        self.banned, self.clean, self.avatars, self.spam_avatars = [], [], {}, []
+        self.config = main.ConfigSnapshot(None)
+        self.config._apply(main.default_config())
+        self.overlays = main.ChatOverlays(None, {})
+        self.reputation = main.ReputationStore(None, 1000, False, 60)
+        self.flood = main.FloodGuard(1000)
+
+        async def avatar_check(user_id, bot):
+            verdict = self.avatars.get(user_id, main.NO_AVATAR)
+            if isinstance(verdict, Exception):
+                raise verdict
+            return verdict
+
+        for name, value in (
+            ("OUTBOUND", self.outbound), ("CONFIG", self.config), ("CHAT_OVERLAYS", self.overlays),
+            ("REPUTATION", self.reputation), ("FLOOD", self.flood), ("avatar_check", avatar_check),
+            ("IDENTITY_CACHE", main.LRUCache(1000)),
+            ("add_banned_message", lambda text, chat_id=None, user_id=None, rule=None: self.banned.append((text, rule))),
+            ("sample_clean_message", self.clean.append),
+            ("remember_spam_avatar", lambda phash, user_id: self.spam_avatars.append(user_id)),
+        ):
+            monkeypatch.setattr(main, name, value)
+
+    def use_real_corpus(self):
+        """Настоящий add_banned_message: корпус и счётчики — в заглушки, SimHash — в пустой индекс теста."""
+        self.spam_texts = main.HammingIndex(main.SIMHASH_MAX_DISTANCE)
+        for name, value in (
+            ("add_banned_message", ADD_BANNED_MESSAGE), ("SPAM_TEXTS", self.spam_texts),
+            ("BANNED_WRITER", SimpleNamespace(put=lambda text, chat_id, user_id, rule: self.banned.append((text, rule)))),
+            ("TERM_STATS", SimpleNamespace(add=lambda *args, **kwargs: None)),
+            ("spam_simhash_col", NullCollection()),
+        ):
+            self.monkeypatch.setattr(main, name, value)
+
+    def use_real_avatar_check(self, bot):
+        """Настоящий avatar_check с пустыми кэшами; Telegram — переданный bot."""
+        self.bot = bot
+        for name, value in (
+            ("avatar_check", AVATAR_CHECK), ("AVATAR_CACHE", main.LRUCache(100, main.AVATAR_NSFW_TTL)),
+            ("AVATAR_FILE_CACHE", main.LRUCache(100)), ("AVATAR_FAILURES", main.LRUCache(100, main.AVATAR_RETRY_INTERVAL)),
+            ("STATE", main.MemoryStateStore()), ("avatar_col", NullCollection()),
+        ):
+            self.monkeypatch.setattr(main, name, value)
+
+    def set_config(self, **cfg):
+        self.config._apply({**main.default_config(), **cfg})
+
+    def set_chat(self, chat_id, **doc):
+        self.overlays._apply({chat_id: doc})
+
+    @staticmethod
+    def user(user_id, first_name="Иван", last_name=None, username=None):
+        return SimpleNamespace(id=user_id, first_name=first_name, last_name=last_name, username=username)
+
+    def message(self, chat_id, user, text, message_id=1):
+        msg = SimpleNamespace(text=text, from_user=user, chat=SimpleNamespace(id=chat_id), message_id=message_id)
+        update = SimpleNamespace(message=msg, channel_post=None)
+        return asyncio.run(main.delete_spam_message(update, SimpleNamespace(bot=self.bot)))
+
+    def join(self, chat_id, *users):
+        message = SimpleNamespace(new_chat_members=list(users))
+        update = SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=chat_id))
+        return asyncio.run(main.on_new_member(update, SimpleNamespace(bot=self.bot)))
+
+    def trust(self, chat_id, user):
+        """Запись репутации, при которой пользователь уже доверенный."""
+        rec = main.Reputation(main.now_ts() - main.TRUST_MIN_AGE - 1)
+        rec.count = main.TRUST_MIN_MESSAGES
+        rec.fingerprint = main.identity_fingerprint(user, self.overlays.get(chat_id).version)
+        rec.cfg_version = self.config.version
+        rec.full_checked = main.now_ts()
+        self.reputation._data.set((chat_id, user.id), rec)
+
+
+@pytest.fixture
+def moderation(monkeypatch):
+    return Moderation(monkeypatch)
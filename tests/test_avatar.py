@@ -0,0 +1,133 @@
+import asyncio
+import random
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image
+
+import main
+
+
+def reference_skin_ratio(img: Image.Image) -> float:
+    """Исходная попиксельная реализация — эталон для векторизованной."""
+    small = img.resize((256, 256)).convert("YCbCr")
+    data = small.tobytes()  # Y, Cb, Cr подряд
+    skin = sum(1 for cb, cr in zip(data[1::3], data[2::3]) if 80 <= cb <= 135 and 135 <= cr <= 180)
+    return skin / max(small.width * small.height, 1)
+
+
+def noisy_image(rnd: random.Random, size: int) -> Image.Image:
+    img = Image.effect_noise((size, size), 80).convert("RGB")
+    for _ in range(8):
+        x, y = rnd.randrange(size // 2), rnd.randrange(size // 2)
+        color = rnd.choice([(224, 172, 140), (198, 134, 66), (40, 90, 200), (250, 220, 200)])
+        img.paste(color, (x, y, x + size // 3, y + size // 3))
+    return img
+
+
+def test_skin_ratio_matches_reference():
+    rnd = random.Random(5)
+    for size in (64, 256, 640, 1280):
+        img = noisy_image(rnd, size)
+        assert main._skin_ratio(img) == reference_skin_ratio(img)
+
+
+def test_full_decode_matches_reference_for_large_jpeg():
+    img = noisy_image(random.Random(7), 1280)
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    buf.seek(0)
+    decoded = Image.open(BytesIO(buf.getvalue())).convert("RGB")
+    assert main._analyze_avatar_sync(buf).ratio == reference_skin_ratio(decoded)
+
+
+def test_avatar_decision_thresholds():
+    assert main.avatar_decision(main.AvatarVerdict(0.9, None), 0.58, 0.42) == "hard"
+    assert main.avatar_decision(main.AvatarVerdict(0.58, None), 0.58, 0.42) == "hard"
+    assert main.avatar_decision(main.AvatarVerdict(0.5, None), 0.58, 0.42) == "soft"
+    assert main.avatar_decision(main.AvatarVerdict(0.1, None), 0.58, 0.42) == "ok"
+    assert main.avatar_decision(main.NO_AVATAR, 0.58, 0.42) == "ok"
+
+
+def jpeg_bytes(seed: int) -> bytes:
+    buf = BytesIO()
+    noisy_image(random.Random(seed), 128).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+class PhotoBot:
+    """У пользователя аватарка photos[user_id] (file_unique_id); скачивание можно придержать через gate."""
+
+    def __init__(self, photos: dict, gate: asyncio.Event | None = None):
+        self.photos = photos
+        self.gate = gate
+        self.lookups = 0
+        self.downloads = 0
+        self.active = self.max_active = 0
+
+    async def get_user_profile_photos(self, user_id, limit=1):
+        self.lookups += 1
+        uid = self.photos[user_id]
+        return SimpleNamespace(total_count=1, photos=[[SimpleNamespace(file_id=f"f-{uid}", file_unique_id=uid)]])
+
+    async def get_file(self, file_id):
+        bot = self
+
+        async def download_to_memory(out):
+            bot.downloads += 1
+            bot.active += 1
+            bot.max_active = max(bot.max_active, bot.active)
+            if bot.gate is not None:
+                await bot.gate.wait()
+            bot.active -= 1
+            out.write(jpeg_bytes(len(file_id)))
+
+        return SimpleNamespace(download_to_memory=download_to_memory)
+
+
+def test_same_file_is_downloaded_once_and_remembered_in_mongo(moderation, mongo_db, run, monkeypatch):
+    bot = PhotoBot({1: "same", 2: "same", 3: "same"})
+    moderation.use_real_avatar_check(bot)
+    monkeypatch.setattr(main, "avatar_col", mongo_db["avatar_verdicts"])
+
+    first = run(main.avatar_check(1, bot))
+    assert run(main.avatar_check(2, bot)) == first  # другой пользователь, тот же файл — без скачивания
+    assert run(main.avatar_check(1, bot)) == first  # привязка user_id закэширована — без запроса в Telegram
+    assert (bot.lookups, bot.downloads) == (2, 1)
+
+    # после перезапуска (пустые кэши в памяти) вердикт берётся из Mongo
+    monkeypatch.setattr(main, "AVATAR_CACHE", main.LRUCache(100, main.AVATAR_NSFW_TTL))
+    monkeypatch.setattr(main, "AVATAR_FILE_CACHE", main.LRUCache(100))
+    assert run(main.avatar_check(3, bot)) == first
+    assert bot.downloads == 1
+
+
+def test_concurrent_checks_share_one_fetch(moderation, run):
+    async def scenario():
+        bot = PhotoBot({1: "a"}, gate=asyncio.Event())
+        moderation.use_real_avatar_check(bot)
+        waiters = [asyncio.ensure_future(main.avatar_check(1, bot)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()  # отмена одного ждущего не отменяет общую проверку
+        bot.gate.set()
+        results = await asyncio.gather(*waiters[1:])
+        assert len(set(results)) == 1
+        assert (bot.lookups, bot.downloads) == (1, 1)
+        assert main._AVATAR_INFLIGHT == {}
+
+    run(scenario())
+
+
+def test_parallel_downloads_are_capped(moderation, run, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(main, "_AVATAR_DOWNLOADS", asyncio.Semaphore(2))
+        bot = PhotoBot({uid: f"file{uid}" for uid in range(6)}, gate=asyncio.Event())
+        moderation.use_real_avatar_check(bot)
+        checks = asyncio.gather(*(main.avatar_check(uid, bot) for uid in range(6)))
+        await asyncio.sleep(0.01)
+        assert bot.active == 2
+        bot.gate.set()
+        await checks
+        assert bot.downloads == 6 and bot.max_active == 2
+
+    run(scenario())
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import main
+
+
+class RecordingCollection:
+    name = "banned_messages"
+
+    def __init__(self, fail_times=0):
+        self.fail_times = fail_times
+        self.batches = []
+
+    async def bulk_write(self, ops, ordered=True):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise AutoReconnect("primary stepped down")
+        self.batches.append(ops)
+
+
+def test_repeats_are_merged_and_failed_batch_is_retried(run):
+    col = RecordingCollection(fail_times=1)
+    corpus = main.BannedCorpus(col, batch_size=10, interval=60, max_pending=100)
+    corpus.put("Заходи в казино", -100, 1, "word")
+    corpus.put("заходи  в  КАЗИНО", -100, 2, "phrase")
+    corpus.put("другой спам", -100, 3, "word")
+
+    assert run(corpus.flush()) is False
+    assert corpus.stats() == {"queued": 2, "written": 0, "dropped": 0, "failed": 0, "retried": 1}
+    corpus.put("другой спам", -100, 4, "word")  # пришёл, пока Mongo была недоступна
+    assert run(corpus.flush()) is True
+    assert corpus.stats()["queued"] == 0
+
+    ops = [op for batch in col.batches for op in batch]
+    assert len(ops) == 3
+    day = f"{datetime.utcnow():%Y-%m-%d}"
+    casino = next(op for op in ops if op._doc["$setOnInsert"]["text"] == "Заходи в казино")
+    assert casino._doc["$inc"] == {"hits": 2, f"days.{day}.word": 1, f"days.{day}.phrase": 1}
+    assert casino._doc["$set"]["rule"] == "phrase"
+    assert sum(op._doc["$inc"]["hits"] for op in ops) == 4
+
+
+def test_close_counts_unwritten_as_dropped(run):
+    corpus = main.BannedCorpus(RecordingCollection(fail_times=10), batch_size=10, interval=60, max_pending=100)
+    corpus.put("спам", rule="word")
+    run(corpus.close())
+    assert corpus.stats()["dropped"] == 1 and corpus.stats()["queued"] == 0
+
+
+def test_rule_stats_counts_only_bans_inside_window(run, mongo_db):
+    col = mongo_db["banned_messages"]
+    corpus = main.BannedCorpus(col, batch_size=10, interval=60, max_pending=100)
+    now = datetime.utcnow()
+    day = lambda n: f"{now - timedelta(days=n):%Y-%m-%d}"  # noqa: E731
+
+    async def scenario():
+        await col.insert_many([
+            # сотни старых банов по word, последний — сегодня по phrase
+            {"_id": "a", "time": now, "hits": 301, "rule": "phrase",
+             "days": {day(40): {"word": 300}, day(0): {"phrase": 1}}},
+            {"_id": "b", "time": now - timedelta(days=2), "hits": 3, "rule": "word",
+             "days": {day(3): {"word": 1}, day(2): {"word": 2}}},
+            {"_id": "c", "time": now - timedelta(days=1), "hits": 2, "rule": "combo"},  # без days
+            {"_id": "d", "time": now - timedelta(days=60), "hits": 5, "rule": "word",
+             "days": {day(60): {"word": 5}}},
+        ])
+        return await corpus.rule_stats(7)
+
+    rows = run(scenario())
+    assert sorted(rows) == [("combo", 1, 2), ("phrase", 1, 1), ("word", 1, 3)]
+
+
+class IndexedCollection:
+    """Коллекция с одним индексом по time — как в Mongo после прошлых запусков."""
+    name = "banned_messages"
+
+    def __init__(self, ttl):
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        if ttl is not None:
+            self.indexes["time_1"] = {"key": [("time", 1)], "expireAfterSeconds": ttl}
+        self.calls = []
+        self.database = self
+
+    async def index_information(self):
+        return {name: {k: v for k, v in info.items() if v is not None} for name, info in self.indexes.items()}
+
+    async def create_index(self, field, **kwargs):
+        if "time_1" in self.indexes and self.indexes["time_1"].get("expireAfterSeconds") != kwargs.get("expireAfterSeconds"):
+            raise OperationFailure("IndexOptionsConflict", code=85)
+        self.calls.append(("create", kwargs.get("expireAfterSeconds")))
+        self.indexes["time_1"] = {"key": [(field, 1)], "expireAfterSeconds": kwargs.get("expireAfterSeconds")}
+
+    async def drop_index(self, keys):
+        self.calls.append(("drop",))
+        del self.indexes["time_1"]
+
+    async def command(self, name, coll, index):
+        self.calls.append((name, index["expireAfterSeconds"]))
+        self.indexes["time_1"]["expireAfterSeconds"] = index["expireAfterSeconds"]
+
+
+def test_ttl_index_changes_are_applied_without_conflict(run):
+    col = IndexedCollection(ttl=3600)
+    run(main.ensure_ttl_index(col, "time", 3600))
+    assert col.calls == []
+    run(main.ensure_ttl_index(col, "time", 7200))
+    assert col.calls == [("collMod", 7200)]
+    run(main.ensure_ttl_index(col, "time", None))
+    assert col.calls[1:] == [("drop",), ("create", None)]
+    run(main.ensure_ttl_index(col, "time", 60))
+    assert col.calls[3:] == [("drop",), ("create", 60)]
+    assert col.indexes["time_1"]["expireAfterSeconds"] == 60
+
+
+def test_ttl_index_is_created_when_missing(run, mongo_db):
+    col = mongo_db["clean_sample"]
+    run(main.ensure_ttl_index(col, "time", 3600))
+    info = run(col.index_information())
+    assert any(i["key"] == [("time", 1)] and i.get("expireAfterSeconds") == 3600 for i in info.values())
@@ -0,0 +1,81 @@
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import main
+
+
+class FlakyCollection:
+    """insert_many, который падает заданное число раз, потом пишет."""
+    name = "flaky"
+
+    def __init__(self, failures: int = 0, error=None):
+        self.failures = failures
+        self.error = error or AutoReconnect("connection reset")
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        self.docs.extend(docs)
+
+
+def test_failed_batch_is_requeued_and_written_later(run):
+    col = FlakyCollection(failures=1)
+    writer = main.BatchWriter(col, batch_size=10, interval=60, max_queue=100)
+    for i in range(15):
+        writer.put({"i": i})
+
+    async def scenario():
+        assert await writer.flush() is False
+        assert writer.stats()["queued"] == 15
+        assert await writer.flush() is True
+
+    run(scenario())
+    assert [d["i"] for d in col.docs] == list(range(15))  # порядок сохранён
+    assert writer.stats() == {"queued": 0, "written": 15, "dropped": 0, "failed": 0, "retried": 1}
+
+
+def test_requeue_respects_queue_limit(run):
+    writer = main.BatchWriter(None, batch_size=5, interval=60, max_queue=8)
+
+    class FillingCollection(FlakyCollection):
+        async def insert_many(self, docs, ordered=True):
+            # пока пачка в полёте, в очередь приходят новые документы
+            for _ in range(3):
+                writer.put({"i": "new"})
+            raise AutoReconnect("timeout")
+
+    writer.col = FillingCollection()
+    for i in range(8):
+        writer.put({"i": i})
+    assert run(writer.flush()) is False
+    # места хватило на два документа пачки: они снова впереди, остальные три — в dropped
+    assert [d["i"] for d in writer._buf] == [0, 1, 5, 6, 7, "new", "new", "new"]
+    assert writer.dropped == 3
+
+
+def test_document_errors_are_counted_not_retried(run):
+    details = {"writeErrors": [
+        {"index": 0, "code": 11000, "errmsg": "duplicate key"},
+        {"index": 1, "code": 121, "errmsg": "validation failed"},
+    ]}
+    col = FlakyCollection(failures=1, error=BulkWriteError(details))
+    writer = main.BatchWriter(col, batch_size=10, interval=60, max_queue=100)
+    for i in range(4):
+        writer.put({"i": i})
+
+    assert run(writer.flush()) is True
+    stats = writer.stats()
+    assert stats["queued"] == 0
+    assert stats["written"] == 3  # дубликат уже записан раньше
+    assert stats["failed"] == 1
+
+
+def test_close_counts_unwritten_documents(run):
+    col = FlakyCollection(failures=10)
+    writer = main.BatchWriter(col, batch_size=10, interval=60, max_queue=100)
+    for i in range(3):
+        writer.put({"i": i})
+    run(writer.close())
+    assert writer.stats()["queued"] == 0
+    assert writer.dropped == 3
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def test_chat_rule_bans_stay_out_of_global_corpus(moderation):
+    moderation.set_chat(-100, words=["крипта"])
+    moderation.message(-100, moderation.user(1), "продам крипту дёшево крипта")
+    assert moderation.outbound.punished == [(-100, 1, 1)]
+    assert moderation.banned == []
+    moderation.set_config(BANNED_WORDS=["казино"])
+    moderation.message(-100, moderation.user(2), "лучшее казино")
+    assert moderation.banned == [("лучшее казино", "word")]
+
+
+def test_chat_settings_change_resets_trust(moderation):
+    user = moderation.user(7, "💎Анна💎")
+    moderation.trust(-100, user)
+    moderation.message(-100, user, "привет")
+    assert moderation.outbound.punished == []
+    moderation.set_chat(-100, words=["спам"])
+    moderation.message(-100, user, "привет")  # доверие сброшено — имя снова проверяется
+    assert moderation.outbound.punished == [(-100, 7, 1)]
+
+
+def test_overlay_version_is_stable_and_zero_without_settings():
+    assert main.ChatOverlay({}).version == 0
+    a = main.ChatOverlay({"words": ["x"], "disabled": ["avatar"]})
+    b = main.ChatOverlay({"disabled": ["avatar"], "words": ["x"]})
+    assert a.version == b.version != 0
+    assert main.ChatOverlay({"words": ["y"]}).version != a.version
+
+
+@pytest.mark.parametrize("hard, soft, ok", [
+    (0.7, 0.4, True), (0.5, 0.5, True), (0.4, 0.7, False), (1.5, 0.4, False),
+    (0.7, -0.1, False), (float("nan"), 0.4, False), (float("inf"), 0.4, False),
+])
+def test_avatar_threshold_validation(hard, soft, ok):
+    assert main.valid_avatar_thresholds(hard, soft) is ok
+    ov = main.ChatOverlay({"avatar_hard": hard, "avatar_soft": soft})
+    expected = (hard, soft) if ok else (main.AVATAR_HARD_RATIO, main.AVATAR_SOFT_RATIO)
+    assert (ov.avatar_hard, ov.avatar_soft) == expected
+
+
+def test_chatcfg_rejects_invalid_avatar_thresholds(run, monkeypatch):
+    replies, writes = [], []
+
+    class Col:
+        async def update_one(self, *args, **kwargs):
+            writes.append(args)
+
+    monkeypatch.setattr(main, "chat_config_col", Col())
+    message = SimpleNamespace(from_user=SimpleNamespace(id=main.ADMIN_CHAT_ID))
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message.reply_text = reply_text
+    for args in (["-100", "avatar", "nan", "0.4"], ["-100", "avatar", "0.3", "0.6"], ["-100", "avatar", "2", "0.4"]):
+        update = SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=main.ADMIN_CHAT_ID))
+        run(main.chatcfg(update, SimpleNamespace(args=args)))
+    assert writes == []
+    assert replies == [main.CHATCFG_USAGE] * 3
+
+
+def test_chat_avatar_thresholds_apply(moderation):
+    moderation.set_chat(-100, avatar_hard=0.95, avatar_soft=0.9)
+    moderation.avatars[1] = main.AvatarVerdict(0.9, None)
+    moderation.message(-100, moderation.user(1), "привет")
+    assert moderation.outbound.punished == []
+    assert "ПРЕДУПРЕЖДЕНИЕ" in moderation.outbound.notified[0]
+
+
+def test_disabled_family_is_not_applied(moderation):
+    moderation.set_config(BANNED_WORDS=["казино"])
+    moderation.set_chat(-100, disabled=["word", "identity"])
+    moderation.message(-100, moderation.user(1, "🔥Маша🔥"), "Лучшее казино тут")
+    assert moderation.outbound.punished == []
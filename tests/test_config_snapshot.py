@@ -0,0 +1,97 @@
+import asyncio
+
+import main
+
+
+def test_invalidate_reads_current_document(run, mongo_db):
+    col = mongo_db["config"]
+
+    async def scenario():
+        snap = main.ConfigSnapshot(col)
+        await snap.invalidate()
+        assert snap.cfg == main.default_config()
+        first = snap.version
+
+        await col.insert_one({"_id": "main", "BANNED_WORDS": ["казино"], "version": 1})
+        await snap.invalidate()
+        assert snap.cfg["BANNED_WORDS"] == ["казино"]
+        assert snap.version == first + 1
+        assert snap.rules.words.first("заходиказино") >= 0
+
+        # тот же документ — версия не растёт, скомпилированные правила переиспользуются
+        rules = snap.rules
+        await snap.invalidate()
+        assert snap.version == first + 1
+        assert snap.rules is rules
+
+    run(scenario())
+
+
+def test_poll_fallback_picks_up_version_change(run, mongo_db, monkeypatch):
+    col = mongo_db["config"]
+    monkeypatch.setattr(main, "CONFIG_POLL_INTERVAL", 0.01)
+
+    async def scenario():
+        await col.insert_one({"_id": "main", "BANNED_WORDS": ["казино"], "version": 1})
+        snap = main.ConfigSnapshot(col)
+        await snap.invalidate()
+        snap.start()  # change stream в mongomock недоступен — работает опрос version
+        try:
+            await col.update_one({"_id": "main"}, {"$set": {"BANNED_WORDS": ["ставки"]}, "$inc": {"version": 1}})
+            for _ in range(100):
+                if snap.cfg["BANNED_WORDS"] == ["ставки"]:
+                    break
+                await asyncio.sleep(0.01)
+            assert snap.cfg["BANNED_WORDS"] == ["ставки"]
+            assert snap.db_version == 2
+        finally:
+            snap._task.cancel()
+
+    run(scenario())
+
+
+def test_invalidate_serves_old_rules_until_new_ones_are_built(run, mongo_db, monkeypatch):
+    col = mongo_db["config"]
+    real = main.CompiledRules
+    seen = []
+
+    async def scenario():
+        snap = main.ConfigSnapshot(col)
+        await col.insert_one({"_id": "main", "BANNED_WORDS": ["казино"], "version": 1})
+        await snap.load()
+        old_rules, old_version = snap.rules, snap.version
+
+        def slow_compile(cfg):
+            # сборка идёт в потоке — обработчики в это время видят прежний снимок целиком
+            seen.append((snap.cfg["BANNED_WORDS"], snap._rules is old_rules, snap.version))
+            return real(cfg)
+
+        monkeypatch.setattr(main, "CompiledRules", slow_compile)
+        await col.update_one({"_id": "main"}, {"$set": {"BANNED_WORDS": ["ставки"]}, "$inc": {"version": 1}})
+        await snap.invalidate()
+        assert seen == [(["казино"], True, old_version)]
+        assert snap.cfg["BANNED_WORDS"] == ["ставки"] and snap.version == old_version + 1
+        assert snap._rules is not None and snap.rules.words.first("ставки") >= 0
+
+    run(scenario())
+
+
+def test_stale_reload_is_discarded(run, mongo_db, monkeypatch):
+    snap = main.ConfigSnapshot(mongo_db["config"])
+    real = main.CompiledRules
+    newer = {"_id": "main", "BANNED_WORDS": ["ставки"], "version": 3}
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+
+        def compile_then_newer(cfg):
+            if cfg["BANNED_WORDS"] == ["казино"]:
+                # пока собиралась версия 2, пришла версия 3
+                asyncio.run_coroutine_threadsafe(snap._reload(newer), loop).result()
+            return real(cfg)
+
+        monkeypatch.setattr(main, "CompiledRules", compile_then_newer)
+        await snap._reload({"_id": "main", "BANNED_WORDS": ["казино"], "version": 2})
+        assert snap.cfg["BANNED_WORDS"] == ["ставки"] and snap.db_version == 3
+
+    run(scenario())
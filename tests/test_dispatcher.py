@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def update(update_id, chat_id=None, user_id=None):
+    chat = SimpleNamespace(id=chat_id) if chat_id is not None else None
+    user = SimpleNamespace(id=user_id) if user_id is not None else None
+    return SimpleNamespace(update_id=update_id, effective_chat=chat, effective_user=user)
+
+
+class App:
+    """process_update записывает порядок; апдейт с id из blocked ждёт release."""
+
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.release = asyncio.Event()
+        self.done = []
+
+    async def process_update(self, u):
+        if u.update_id in self.blocked:
+            await self.release.wait()
+        if u.update_id < 0:
+            raise RuntimeError("boom")
+        self.done.append(u.update_id)
+
+
+def test_shard_by_chat_then_user_then_update_id():
+    d = main.UpdateDispatcher(None, 4, 10, 1)
+    assert d._shard(update(1, chat_id=-102, user_id=7)) == -102 % 4
+    assert d._shard(update(1, user_id=7)) == 7 % 4
+    assert d._shard(update(9)) == 9 % 4
+
+
+def test_order_within_chat_and_chats_in_parallel(run):
+    async def scenario():
+        app = App(blocked={1})
+        d = main.UpdateDispatcher(app, 2, 10, 1)
+        d.start()
+        # чат 0 (шард 0) застрял на первом апдейте, чат 1 (шард 1) не ждёт его
+        for uid, chat in ((1, 0), (2, 0), (3, 1), (4, 1)):
+            assert await d.submit(update(uid, chat_id=chat))
+        for _ in range(100):
+            if app.done == [3, 4]:
+                break
+            await asyncio.sleep(0)
+        assert app.done == [3, 4]
+        app.release.set()
+        await d.close()
+        assert app.done == [3, 4, 1, 2]
+        assert d.stats()["processed"] == 4 and d.stats()["queue_depth"] == 0
+
+    run(scenario())
+
+
+def test_full_shard_sheds_after_timeout(run):
+    async def scenario():
+        d = main.UpdateDispatcher(App(), 1, 1, 0.01)
+        assert await d.submit(update(1, chat_id=5))
+        assert not await d.submit(update(2, chat_id=5))  # воркеры не запущены — очередь не освобождается
+        assert d.stats()["shed"] == 1 and d.stats()["enqueued"] == 1
+
+    run(scenario())
+
+
+def test_failed_update_does_not_stop_the_worker(run):
+    async def scenario():
+        app = App()
+        d = main.UpdateDispatcher(app, 1, 10, 1)
+        d.start()
+        for uid in (-1, 2):
+            await d.submit(update(uid, chat_id=5))
+        await d.close()
+        assert app.done == [2]
+        assert d.stats()["failed"] == 1 and d.stats()["processed"] == 1
+
+    run(scenario())
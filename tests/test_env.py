@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_empty_bot_api_url_falls_back_to_telegram():
+    env = {**os.environ, "BOT_API_URL": "", "BOT_API_FILE_URL": ""}
+    out = subprocess.run(
+        [sys.executable, "-c", "import main; print(main.BOT_API_URL, main.BOT_API_FILE_URL)"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout.split()[-2:]
+    assert out == ["https://api.telegram.org/bot", "https://api.telegram.org/file/bot"]
@@ -0,0 +1,39 @@
+import asyncio
+
+import main
+
+ITEMS = [
+    ("spam", "Лучшее казино тут"),
+    ("spam", "заработок из дома, пишите"),
+    ("clean", "в казино не пойду, лучше в кино"),
+    ("clean", "во сколько завтра встреча?"),
+]
+
+
+def config():
+    return {**main.default_config(), "BANNED_WORDS": ["казино"]}
+
+
+def test_evaluate_rules_counts_hits_per_corpus(run):
+    result = run(main.evaluate_rules(config(), ITEMS, workers=1))
+    assert result["total"] == {"spam": 2, "clean": 2}
+    assert result["caught"] == {"spam": 1, "clean": 1}
+    assert result["hits"] == {("word", "spam"): 1, ("word", "clean"): 1}
+    assert result["examples"] == {("word", 0): "в казино не пойду, лучше в кино"}
+
+
+def test_process_pool_matches_local_run_and_shuts_down_off_loop(run, monkeypatch):
+    monkeypatch.setattr(main, "EVAL_CHUNK", 1)
+    shutdowns = []
+    real_shutdown = main.ProcessPoolExecutor.shutdown
+
+    def shutdown(pool, *args, **kwargs):
+        shutdowns.append(asyncio._get_running_loop())
+        return real_shutdown(pool, *args, **kwargs)
+
+    monkeypatch.setattr(main.ProcessPoolExecutor, "shutdown", shutdown)
+    local = run(main.evaluate_rules(config(), ITEMS, workers=1))
+    pooled = run(main.evaluate_rules(config(), ITEMS, workers=2))
+    for key in ("total", "caught", "hits", "patterns", "examples"):
+        assert pooled[key] == local[key]
+    assert shutdowns == [None]  # вызван в потоке, а не на event loop
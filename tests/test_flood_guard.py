@@ -0,0 +1,118 @@
+from time import monotonic
+
+import main
+
+WAVE = "вступайте в наш закрытый канал с сигналами"
+
+
+def established(moderation, chat_id, user):
+    moderation.reputation.record_clean(chat_id, user.id, 0, -1, False)
+    moderation.reputation._data.get((chat_id, user.id)).first_seen -= main.TRUST_MIN_AGE + 1
+
+
+def test_flood_family_is_off_and_raid_on_by_default():
+    assert not main.ChatOverlay({}).enabled("flood")
+    assert main.ChatOverlay({"enabled": ["flood"]}).enabled("flood")
+    assert not main.ChatOverlay({"enabled": ["flood"], "disabled": ["flood"]}).enabled("flood")
+    assert main.ChatOverlay({}).enabled("raid")
+
+
+def test_sliding_counter_window():
+    c = main.SlidingCounter(window=60, n=6)
+    assert c.add(0) == 1
+    assert c.add(15, 2) == 3
+    assert c.count(59) == 3
+    assert c.add(61) == 3  # корзина [0, 10) вышла из окна
+    assert c.count(75) == 1  # и [10, 20) тоже
+    assert c.count(1000) == 0  # долгий простой обнуляет всё сразу
+    assert c.add(1000) == 1
+
+
+def join_wave(moderation, chat_id, users):
+    for uid in users:
+        moderation.join(chat_id, moderation.user(uid))
+
+
+def test_join_wave_starts_raid_with_flood_disabled(moderation, monkeypatch):
+    monkeypatch.setattr(main, "RAID_JOIN_THRESHOLD", 3)
+    join_wave(moderation, -100, (1, 2))
+    assert not moderation.flood.in_raid(-100)
+    join_wave(moderation, -100, (3, 4))
+    assert moderation.flood.in_raid(-100)
+    assert any("Рейд" in n for n in moderation.outbound.notified)
+    # по умолчанию включён только raid: вошедших во время рейда банит повтор одного текста
+    for uid in (3, 4):
+        moderation.message(-100, moderation.user(uid), WAVE, message_id=uid)
+    assert moderation.outbound.deleted == [(-100, 4)]
+    assert moderation.flood.stats()["bans_pending"] == 1
+
+
+def test_no_per_user_flood_ban_without_flood_family(moderation, monkeypatch):
+    monkeypatch.setattr(main, "FLOOD_USER_MESSAGES", 3)
+    user = moderation.user(1)
+    for mid in range(1, 6):
+        moderation.message(-100, user, f"сообщение номер {mid}", message_id=mid)
+    assert moderation.outbound.deleted == []
+    moderation.set_chat(-200, enabled=["flood"])
+    for mid in range(1, 4):
+        moderation.message(-200, user, f"сообщение номер {mid}", message_id=mid)
+    assert moderation.outbound.deleted == [(-200, 3)]
+
+
+def test_raid_family_disabled_ignores_join_wave(moderation, monkeypatch):
+    monkeypatch.setattr(main, "RAID_JOIN_THRESHOLD", 3)
+    moderation.set_chat(-100, disabled=["raid"])
+    join_wave(moderation, -100, (1, 2, 3, 4))
+    assert not moderation.flood.in_raid(-100)
+
+
+def test_repeat_wave_of_newcomers_bans_without_feeding_corpus(moderation):
+    moderation.set_chat(-100, enabled=["flood"])
+    for uid in (1, 2):
+        moderation.message(-100, moderation.user(uid), WAVE, message_id=uid)
+    assert moderation.outbound.deleted == [] and not moderation.flood.in_raid(-100)
+    moderation.message(-100, moderation.user(3), WAVE, message_id=3)
+    assert moderation.outbound.deleted == [(-100, 3)]
+    assert moderation.flood.in_raid(-100)
+    assert moderation.flood.stats()["raids_active"] == 1
+    assert moderation.banned == []  # частотный бан — не сигнал для корпуса
+
+
+def test_established_members_do_not_start_a_wave(moderation):
+    moderation.set_chat(-100, enabled=["flood"])
+    for uid in (1, 2, 3, 4):
+        user = moderation.user(uid)
+        established(moderation, -100, user)
+        moderation.message(-100, user, WAVE, message_id=uid)
+    assert moderation.outbound.deleted == [] and moderation.outbound.punished == []
+    assert not moderation.flood.in_raid(-100)
+
+
+def test_one_newcomer_repeating_is_not_a_wave(moderation):
+    moderation.set_chat(-100, enabled=["flood"])
+    for mid in range(1, 5):
+        moderation.message(-100, moderation.user(1), WAVE, message_id=mid)
+    assert moderation.outbound.deleted == [] and not moderation.flood.in_raid(-100)
+
+
+def test_wave_ignored_when_flood_disabled(moderation):
+    for uid in (1, 2, 3, 4):
+        moderation.message(-100, moderation.user(uid), WAVE, message_id=uid)
+    assert moderation.outbound.deleted == []
+
+
+def full_checked(moderation, chat_id, user_id):
+    return moderation.reputation._data.get((chat_id, user_id)).full_checked
+
+
+def test_skipped_avatar_check_during_raid_is_not_a_full_check(moderation):
+    moderation.set_chat(-100, enabled=["flood"])
+    moderation.flood.raid_until.set(-100, monotonic() + 600)
+    moderation.message(-100, moderation.user(1), "привет всем")
+    assert full_checked(moderation, -100, 1) == 0.0
+
+
+def test_avatar_disabled_in_chat_counts_as_full_check(moderation):
+    moderation.set_chat(-100, disabled=["avatar"])
+    moderation.message(-100, moderation.user(1), "привет всем")
+    assert full_checked(moderation, -100, 1) > 0
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+import main
+
+
+def test_hamming_index_finds_within_distance_only():
+    rnd = random.Random(3)
+    index = main.HammingIndex(max_distance=6)
+    base = [rnd.getrandbits(64) for _ in range(500)]
+    for h in base:
+        index.add(h)
+    target = base[42]
+    near = target ^ (1 << 1) ^ (1 << 20) ^ (1 << 40) ^ (1 << 63)  # 4 разряда
+    assert index.find(near) == (4, target)
+    far = target ^ sum(1 << i for i in range(0, 64, 8))  # 8 разрядов
+    found = index.find(far)
+    assert found is None or found[1] != target
+    assert index.find(target) == (0, target)
+    assert len(index) == 500
+
+
+def test_hamming_index_matches_brute_force():
+    rnd = random.Random(11)
+    index = main.HammingIndex(max_distance=5)
+    items = [rnd.getrandbits(64) for _ in range(300)]
+    for h in items:
+        index.add(h)
+    for _ in range(300):
+        q = items[rnd.randrange(len(items))] ^ sum(1 << rnd.randrange(64) for _ in range(rnd.randint(0, 8)))
+        best = min(((q ^ h).bit_count(), h) for h in items)
+        got = index.find(q)
+        if best[0] <= 5:
+            assert got is not None and got[0] == best[0]
+        else:
+            assert got is None
+
+
+SPAM = (
+    "Внимание всем участникам чата! Заходите в наш закрытый канал, там каждый день раздают бесплатные сигналы "
+    "по крипте и ставкам на спорт, уже более пяти тысяч человек заработали первые деньги без вложений и риска, "
+    "пишите администратору в личные сообщения прямо сейчас, количество мест в группе строго ограничено"
+)
+EDITS = [("каждый день", "ежедневно"), ("бесплатные", "платные"), ("закрытый", "секретный"), ("пяти", "шести")]
+
+
+def test_simhash_near_duplicates_and_short_texts():
+    a = main.text_simhash(SPAM)
+    other = main.text_simhash(
+        "Кто-нибудь знает, во сколько завтра открывается библиотека на центральной площади города, "
+        "хочу взять пару книг по истории и заодно вернуть старые, которые брал ещё весной"
+    )
+    for old, new in EDITS:
+        assert (a ^ main.text_simhash(SPAM.replace(old, new))).bit_count() <= main.SIMHASH_MAX_DISTANCE
+    assert (a ^ other).bit_count() > main.SIMHASH_MAX_DISTANCE
+    assert main.text_simhash("коротко и ясно") is None
+
+
+@pytest.fixture
+def spam_texts(monkeypatch):
+    writes = []
+
+    class Col:
+        async def update_one(self, flt, update, upsert=False):
+            writes.append((flt["_id"], update))
+
+    index = main.HammingIndex(main.SIMHASH_MAX_DISTANCE)
+    monkeypatch.setattr(main, "SPAM_TEXTS", index)
+    monkeypatch.setattr(main, "spam_simhash_col", Col())
+    return index, writes
+
+
+def test_near_duplicate_bans_do_not_grow_index(run, spam_texts):
+    index, writes = spam_texts
+
+    async def scenario():
+        main.remember_spam_text(SPAM)
+        for old, new in EDITS:
+            main.remember_spam_text(SPAM.replace(old, new))
+        await main.asyncio.sleep(0)
+
+    run(scenario())
+    assert len(index) == 1
+    anchor = format(main.text_simhash(SPAM), "016x")
+    assert {w[0] for w in writes} == {anchor}
+    assert all("$set" in update for _, update in writes[1:])  # у исходного хэша продлевается time
+
+
+def test_chain_of_near_duplicates_does_not_drift(run, spam_texts):
+    index, _ = spam_texts
+    chain = [SPAM]
+    for old, new in EDITS:
+        chain.append(chain[-1].replace(old, new))
+    far = main.text_simhash(chain[3])
+    assert (far ^ main.text_simhash(SPAM)).bit_count() > main.SIMHASH_MAX_DISTANCE
+
+    async def scenario():
+        for text in chain[:3]:  # каждый в пределах расстояния от исходного
+            main.remember_spam_text(text)
+        await main.asyncio.sleep(0)
+
+    run(scenario())
+    # конец цепочки уже далёк от исходного текста — индекс не «дополз» до него через промежуточные баны
+    assert index.find(far) is None
@@ -0,0 +1,15 @@
+import random
+
+import loadtest
+
+
+def test_join_spam_expects_ban_on_the_first_message():
+    gen = loadtest.UpdateGenerator(random.Random(3), chats=4, users=50, spam=0, emoji=0, joins=1, join_spam=1)
+    for _ in range(5):
+        kind, join, expect = gen.next()
+        member = join["message"]["new_chat_members"][0]
+        assert kind == "join_spam" and expect is None  # при входе имя не проверяется
+        kind, post, expect = gen.next()
+        msg = post["message"]
+        assert kind == "join_spam" and msg["from"] == member and msg["text"]
+        assert expect == ("delete", msg["chat"]["id"], msg["message_id"])
@@ -0,0 +1,35 @@
+import main
+
+
+def test_eviction_order_and_counters():
+    cache = main.LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a — теперь самый свежий
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.items() == [("a", 1), ("c", 3)]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main, "now_ts", lambda: now[0])
+    cache = main.LRUCache(10, ttl=5)
+    cache.set("old", 1)
+    now[0] += 3
+    cache.set("new", 2)
+    now[0] += 3
+    assert cache.items() == [("new", 2)]
+    assert cache.get("old", "missing") == "missing"
+    assert len(cache) == 1
+
+
+def test_items_does_not_touch_recency():
+    cache = main.LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.items()
+    cache.set("c", 3)
+    assert cache.get("a") is None
+    assert cache.pop("b") == 2 and cache.pop("b", "gone") == "gone"
@@ -0,0 +1,53 @@
+import pytest
+
+import main
+
+
+def test_text_features_are_eager_identity_is_lazy():
+    f = main.MessageFeatures("Заходи в Казино", "💎Анна💎", None, "casino_bot")
+    assert f.proc_text and f.cleaned == main.clean_for_match("Заходи в Казино")
+    with pytest.raises(AttributeError):
+        object.__getattribute__(f, "display_name")
+    with pytest.raises(AttributeError):
+        object.__getattribute__(f, "words")
+    assert f.emoji_edges is True
+    assert f.display_name == "💎Анна💎"
+    assert f.username_normalized == main.normalize_text("casino_bot")
+    assert f.words == ("заходи", "в", "казино")
+
+
+def test_features_are_immutable_and_unknown_attrs_fail():
+    f = main.MessageFeatures("текст")
+    with pytest.raises(AttributeError):
+        f.text = "другой"
+    with pytest.raises(AttributeError):
+        f.display_name = "x"
+    with pytest.raises(AttributeError):
+        f.no_such_field
+
+
+def test_trusted_author_skips_identity_features(moderation, monkeypatch):
+    calls = []
+    real = main.display_name
+    monkeypatch.setattr(main, "display_name", lambda *a: calls.append(a) or real(*a))
+    user = moderation.user(7, "💎Анна💎")
+    moderation.trust(-100, user)
+    moderation.message(-100, user, "обычное сообщение")
+    assert calls == []
+    assert moderation.outbound.punished == []
+    moderation.message(-100, moderation.user(8, "💎Анна💎"), "обычное сообщение")
+    assert calls and moderation.outbound.punished == [(-100, 8, 1)]
+
+
+def test_emoji_only_message_skips_feature_extraction(moderation, monkeypatch):
+    monkeypatch.setattr(main.MessageFeatures, "of", None)  # вызов упал бы с TypeError
+    moderation.message(-100, moderation.user(7), "🔥🔥🔥", message_id=5)
+    assert moderation.outbound.deleted == [(-100, 5)]
+
+
+def test_join_does_not_apply_name_rules(moderation):
+    moderation.set_config(BANNED_NAME_SUBSTRINGS=["казино"])
+    moderation.join(-100, moderation.user(9, "Казино Вулкан"))
+    assert moderation.outbound.punished == []
+    moderation.message(-100, moderation.user(9, "Казино Вулкан"), "привет")
+    assert moderation.outbound.punished == [(-100, 9, 1)]
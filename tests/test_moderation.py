@@ -0,0 +1,72 @@
+import main
+
+SPAM = ("Всем привет! Ищу людей в команду, работа из дома по два часа в день, "
+        "доход от пятидесяти тысяч в неделю, обучение бесплатное, пишите в личные сообщения")
+QUESTION = ("Подскажите пожалуйста, кто-нибудь знает, во сколько завтра начинается "
+            "собрание жильцов во дворе у третьего подъезда")
+
+
+def test_banned_word_bans_notifies_and_records(moderation):
+    moderation.set_config(BANNED_WORDS=["казино"])
+    moderation.reputation.record_clean(-100, 1, 0, -1, False)
+    moderation.message(-100, moderation.user(1, username="vasya"), "Лучшее казино тут", message_id=7)
+    assert moderation.outbound.punished == [(-100, 1, 7)]
+    assert "Забанен: @vasya" in moderation.outbound.notified[0]
+    assert moderation.banned == [("Лучшее казино тут", "word")]
+    assert moderation.reputation._data.get((-100, 1)) is None
+
+
+def test_near_duplicate_of_known_spam(moderation):
+    moderation.use_real_corpus()
+    moderation.spam_texts.add(main.text_simhash(SPAM))
+    edited = SPAM.replace("по два часа", "по 2 часа").replace("Всем привет!", "Привет всем!")
+    moderation.message(-100, moderation.user(1), edited)
+    assert moderation.outbound.punished == [(-100, 1, 1)]
+    assert moderation.banned == [(edited, "near_duplicate")]
+
+
+def test_content_ban_feeds_near_duplicate_index(moderation):
+    moderation.use_real_corpus()
+    moderation.set_config(BANNED_WORDS=["пятидесяти"])
+    moderation.message(-100, moderation.user(1), SPAM)
+    assert len(moderation.spam_texts) == 1
+    edited = SPAM.replace("пятидесяти тысяч", "50 тысяч")  # слово обошли, текст почти тот же
+    moderation.message(-100, moderation.user(2), edited, message_id=2)
+    assert moderation.outbound.punished[-1] == (-100, 2, 2)
+    assert moderation.banned[-1] == (edited, "near_duplicate")
+
+
+def test_name_ban_does_not_poison_near_duplicate_index(moderation):
+    moderation.use_real_corpus()
+    moderation.set_config(BANNED_NAME_SUBSTRINGS=["заработок"])
+    moderation.message(-100, moderation.user(1, "Быстрый заработок"), QUESTION)
+    assert moderation.outbound.punished == [(-100, 1, 1)]
+    assert moderation.banned == [(QUESTION, "name_substring")]
+    assert len(moderation.spam_texts) == 0
+    moderation.message(-100, moderation.user(2, "Мария"), QUESTION, message_id=2)
+    assert moderation.outbound.punished == [(-100, 1, 1)]
+
+
+def test_identity_cache_follows_name_and_config_changes(moderation, monkeypatch):
+    calls = []
+    real = main.identity_rule
+    monkeypatch.setattr(main, "identity_rule", lambda f, rules: calls.append(f.first_name) or real(f, rules))
+    moderation.set_config(BANNED_NAME_SUBSTRINGS=["казино"])
+
+    assert main.cached_identity_rule(main.MessageFeatures("привет", "Маша")) is None
+    assert main.cached_identity_rule(main.MessageFeatures("ещё раз", "Маша")) is None
+    assert calls == ["Маша"]  # то же имя — из кэша
+    # сменил имя — старый вердикт не используется
+    assert main.cached_identity_rule(main.MessageFeatures("привет", "Маша Казино")) == "name_substring"
+    # сменился конфиг — имя проверяется заново
+    moderation.set_config(BANNED_NAME_SUBSTRINGS=["маша"])
+    assert main.cached_identity_rule(main.MessageFeatures("привет", "Маша")) == "name_substring"
+    assert calls == ["Маша", "Маша Казино", "Маша"]
+
+
+def test_renamed_user_is_banned_on_next_message(moderation):
+    moderation.set_config(BANNED_NAME_SUBSTRINGS=["казино"])
+    moderation.message(-100, moderation.user(1, "Маша"), "привет")
+    assert moderation.outbound.punished == []
+    moderation.message(-100, moderation.user(1, "Маша Казино"), "привет", message_id=2)
+    assert moderation.outbound.punished == [(-100, 1, 2)]
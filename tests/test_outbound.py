@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import main
+
+
+class Clock:
+    def __init__(self, t=1000.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(main, "monotonic", c)
+    return c
+
+
+def test_token_bucket_burst_then_reserves_wait(clock):
+    bucket = main.TokenBucket(rate=2, capacity=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # токены резервируются: каждый следующий ждёт на 1/rate дольше
+    assert bucket.take() == pytest.approx(0.5)
+    assert bucket.take() == pytest.approx(1.0)
+    clock.t += 1.0
+    assert bucket.take() == pytest.approx(0.5)
+
+
+def test_token_bucket_refill_is_capped(clock):
+    bucket = main.TokenBucket(rate=10)
+    assert bucket.capacity == 10
+    bucket.take()
+    clock.t += 3600
+    assert [bucket.take() for _ in range(10)] == [0.0] * 10
+    assert bucket.take() > 0
+
+
+class FlakyBot:
+    """Первые вызовы падают заданными ошибками, дальше — успех; все вызовы записываются."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __getattr__(self, method):
+        async def call(**kwargs):
+            self.calls.append((method, kwargs))
+            if self.errors:
+                raise self.errors.pop(0)
+            return True
+        return call
+
+
+@pytest.fixture
+def sleeps(clock, monkeypatch):
+    """asyncio.sleep не ждёт, а двигает часы и запоминает паузу."""
+    waits = []
+
+    async def sleep(delay, result=None):
+        waits.append(delay)
+        clock.t += delay
+        return result
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return waits
+
+
+def scheduler(bot, max_attempts=3):
+    s = main.OutboundScheduler(global_rate=1000, chat_rate=1000, max_attempts=max_attempts, digest_interval=60)
+    s.bot = bot
+    return s
+
+
+def test_retry_after_pauses_the_chat(run, sleeps):
+    s = scheduler(FlakyBot(RetryAfter(5)))
+    assert run(s.call(-100, "ban_chat_member", chat_id=-100, user_id=1)) is True
+    assert sleeps == [pytest.approx(5)]
+    assert (s.sent, s.retried, s.failed) == (1, 1, 0)
+
+
+def test_network_errors_back_off_then_give_up(run, sleeps):
+    s = scheduler(FlakyBot(NetworkError("x"), NetworkError("x")))
+    assert run(s.call(-100, "delete_message", chat_id=-100, message_id=1)) is True
+    assert sleeps == [1, 2]
+    s = scheduler(FlakyBot(*[NetworkError("x")] * 3), max_attempts=3)
+    assert run(s.call(-100, "delete_message", chat_id=-100, message_id=1)) is None
+    assert (s.sent, s.retried, s.failed) == (0, 3, 1)
+
+
+def test_bad_request_is_not_retried(run, sleeps):
+    bot = FlakyBot(BadRequest("Message to delete not found"))
+    s = scheduler(bot)
+    assert run(s.call(-100, "delete_message", chat_id=-100, message_id=1)) is None
+    assert len(bot.calls) == 1 and s.failed == 1 and sleeps == []
+
+
+def test_digest_joins_notifications_and_splits_long_ones(run, sleeps, monkeypatch):
+    monkeypatch.setattr(main.OutboundScheduler, "MAX_MESSAGE_LEN", 10)
+    bot = FlakyBot()
+    s = scheduler(bot)
+    for text in ("a", "b", "c" * 8, "d" * 20):
+        s.notify_admin(text)
+    run(s.flush_digest())
+    sent = [kwargs["text"] for method, kwargs in bot.calls]
+    assert sent == ["a\n\nb", "c" * 8, "d" * 10]
+    assert all(method == "send_message" and kwargs["chat_id"] == main.ADMIN_CHAT_ID for method, kwargs in bot.calls)
+    run(s.flush_digest())  # пустая сводка не отправляется
+    assert len(bot.calls) == 3
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import TimedOut
+
+import main
+
+
+class FailingBot:
+    """Аватарка есть, но скачать её не получается."""
+
+    def __init__(self):
+        self.downloads = 0
+
+    async def get_user_profile_photos(self, user_id, limit=1):
+        photo = SimpleNamespace(file_id=f"file{user_id}", file_unique_id=f"uniq{user_id}")
+        return SimpleNamespace(total_count=1, photos=[[photo]])
+
+    async def get_file(self, file_id):
+        self.downloads += 1
+        raise TimedOut()
+
+
+def full_checked(moderation, chat_id, user_id):
+    return moderation.reputation._data.get((chat_id, user_id)).full_checked
+
+
+def test_clean_message_builds_reputation(moderation):
+    user = moderation.user(1)
+    moderation.message(-100, user, "Кто-нибудь знает, во сколько завтра встреча?")
+    assert moderation.outbound.punished == [] and moderation.outbound.deleted == []
+    assert moderation.clean == ["Кто-нибудь знает, во сколько завтра встреча?"]
+    rec = moderation.reputation._data.get((-100, 1))
+    assert rec.count == 1 and rec.full_checked > 0
+
+
+def test_soft_avatar_warns_and_does_not_count_as_full_check(moderation):
+    moderation.avatars[1] = main.AvatarVerdict(0.5, None)
+    moderation.message(-100, moderation.user(1), "привет")
+    assert moderation.outbound.punished == []
+    assert "ПРЕДУПРЕЖДЕНИЕ" in moderation.outbound.notified[0]
+    assert full_checked(moderation, -100, 1) == 0.0
+
+
+def test_failed_avatar_download_is_not_a_full_check(moderation):
+    moderation.use_real_avatar_check(FailingBot())
+    moderation.message(-100, moderation.user(1), "привет всем")
+    assert moderation.outbound.punished == []
+    assert full_checked(moderation, -100, 1) == 0.0
+    assert main.AVATAR_CACHE.get(1) is None
+
+
+def test_avatar_failure_is_retried_after_interval(moderation, monkeypatch):
+    bot = FailingBot()
+    moderation.use_real_avatar_check(bot)
+    clock = [1000.0]
+    monkeypatch.setattr(main, "now_ts", lambda: clock[0])
+
+    async def check():
+        with pytest.raises(main.AvatarCheckFailed):
+            await main.avatar_check(1, bot)
+
+    main.asyncio.run(check())
+    assert bot.downloads == 1
+    main.asyncio.run(check())
+    assert bot.downloads == 1  # до истечения интервала Telegram не дёргаем
+    clock[0] += main.AVATAR_RETRY_INTERVAL + 1
+    main.asyncio.run(check())
+    assert bot.downloads == 2
+
+
+def test_trusted_user_still_gets_text_rules(moderation):
+    moderation.set_config(BANNED_WORDS=["казино"])
+    user = moderation.user(1, "🔥Маша🔥")
+    moderation.trust(-100, user)
+    moderation.message(-100, user, "просто привет")
+    assert moderation.outbound.punished == []
+    moderation.message(-100, user, "Лучшее казино тут", message_id=2)
+    assert moderation.outbound.punished == [(-100, 1, 2)]
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+import main
+
+
+def random_text(rnd, alphabet, n):
+    return "".join(rnd.choice(alphabet) for _ in range(n))
+
+
+def test_aho_corasick_matches_naive_substring_search():
+    rnd = random.Random(1)
+    for _ in range(300):
+        patterns = [random_text(rnd, "абв", rnd.randint(1, 4)) for _ in range(rnd.randint(1, 8))]
+        ac = main.AhoCorasick(patterns)
+        text = random_text(rnd, "абвг", rnd.randint(0, 30))
+        expected = {i for i, p in enumerate(patterns) if p in text}
+        assert ac.find_all(text) == expected
+        idx = ac.first(text)
+        assert (idx >= 0) == bool(expected)
+        if idx >= 0:
+            assert patterns[idx] in text
+
+
+def test_aho_corasick_edge_cases():
+    assert not main.AhoCorasick([])
+    assert main.AhoCorasick([]).first("что угодно") == -1
+    # "" — подстрока любого текста, как и в исходном `w in text`
+    ac = main.AhoCorasick(["казино", ""])
+    assert ac.first("") == 1 and ac.find_all("казино") == {0, 1}
+    assert main.AhoCorasick(["he", "she", "hers"]).find_all("ushers") == {0, 1, 2}
+
+
+def test_combo_matches_naive_all_words():
+    rnd = random.Random(2)
+    words = ["крипта", "доход", "пассивный", "быстро", "работа"]
+    for _ in range(200):
+        combos = [rnd.sample(words, rnd.randint(1, 3)) for _ in range(rnd.randint(1, 4))]
+        rules = main.CompiledRules({"COMBINED_BLOCKS": combos})
+        text = " ".join(rnd.sample(words, rnd.randint(0, 5)))
+        proc = main.MessageFeatures(text).proc_text
+        hits = [cid for cid, combo in enumerate(rules.combos) if all(w in proc for w in combo)]
+        cid = rules.match_combo(proc)
+        assert (cid >= 0) == bool(hits)
+        if cid >= 0:
+            assert cid in hits
+
+
+def test_empty_combo_matches_everything():
+    rules = main.CompiledRules({"COMBINED_BLOCKS": [["казино", "бонус"], []]})
+    assert rules.match_combo("обычный текст") == 1
+
+
+@pytest.fixture
+def rules():
+    return main.CompiledRules({
+        "BANNED_WORDS": ["казино"],
+        "PERMANENT_BLOCK_PHRASES": ["пассивный доход"],
+        "COMBINED_BLOCKS": [["работа", "удалённо"]],
+        "BANNED_SYMBOLS": ["卐"],
+        "BANNED_NAME_SUBSTRINGS": ["заработок"],
+        "BANNED_USERNAME_SUBSTRINGS": ["crypto"],
+        "BANNED_FULL_NAMES": ["Анна Крипто"],
+    })
+
+
+@pytest.mark.parametrize("text, rule", [
+    ("Лучшее КАЗИНО тут", "word"),
+    ("к.а.з.и.н.о", "word"),
+    ("Пассивного дохода много не бывает", "phrase"),
+    ("Работа удалённо на дому", "combo"),
+    ("Просто привет", None),
+])
+def test_text_rule(rules, text, rule):
+    assert main.text_rule(main.MessageFeatures(text), rules) == rule
+
+
+def test_text_rule_skips_disabled_families(rules):
+    f = main.MessageFeatures("казино и пассивный доход")
+    assert main.text_rule(f, rules) == "word"
+    assert main.text_rule(f, rules, frozenset({"word"})) == "phrase"
+    assert main.text_rule(f, rules, frozenset({"word", "phrase"})) is None
+
+
+@pytest.mark.parametrize("first, last, username, rule", [
+    ("🔥Маша🔥", None, None, "emoji_edge"),
+    ("Маша💋", None, None, "kiss_emoji"),
+    ("Быстрый заработок", None, None, "name_substring"),
+    ("Анна Крипто", None, None, "full_name"),
+    ("Маша", None, "best_crypto_2024", "username_substring"),
+    ("Маша 卐", None, None, "symbol"),
+    ("Маша", "Иванова", "masha", None),
+])
+def test_identity_rule(rules, first, last, username, rule):
+    assert main.identity_rule(main.MessageFeatures("", first, last, username), rules) == rule
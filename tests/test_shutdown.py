@@ -0,0 +1,27 @@
+import asyncio
+from time import perf_counter
+
+import main
+
+
+def test_cleanup_does_not_wait_for_lag_monitor(run, monkeypatch):
+    monkeypatch.setattr(main, "POOL", None)
+    monkeypatch.setattr(main, "DISPATCHER", None)
+
+    async def scenario():
+        main.LAG_MONITOR = asyncio.get_running_loop().create_task(main.monitor_loop_lag(0.01))
+        done = asyncio.Event()
+
+        async def short():
+            await asyncio.sleep(0.05)
+            done.set()
+        main.spawn(short())
+        await asyncio.sleep(0.03)
+        t = perf_counter()
+        await main.on_cleanup(None)
+        # фоновые задачи дождались, бесконечный монитор — отменён, а не ждали 10 с
+        assert done.is_set()
+        assert perf_counter() - t < 2
+        assert main.LAG_MONITOR is None
+
+    run(scenario())
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+PHASH = 0xF0F0_1234_5678_9ABC
+
+
+def test_hamming_index_discard_and_near():
+    index = main.HammingIndex(4)
+    index.add(PHASH)
+    index.add(PHASH ^ 0b11)
+    index.add(PHASH ^ (0xFF << 40))
+    assert index.near(PHASH) == sorted([PHASH, PHASH ^ 0b11])
+    index.discard(PHASH)
+    index.discard(PHASH)  # повторно — без ошибки
+    assert PHASH not in index and len(index) == 2
+    assert index.find(PHASH) == (2, PHASH ^ 0b11)
+
+
+def test_text_and_name_bans_do_not_remember_avatar(moderation):
+    moderation.set_config(BANNED_WORDS=["казино"])
+    moderation.avatars[1] = moderation.avatars[2] = main.AvatarVerdict(0.1, PHASH)
+    moderation.message(-100, moderation.user(1), "Лучшее казино тут")
+    moderation.message(-100, moderation.user(2, "🔥Маша🔥"), "привет", message_id=2)
+    assert [p[1] for p in moderation.outbound.punished] == [1, 2]
+    assert moderation.spam_avatars == []
+
+
+def test_hard_avatar_bans_before_text_rules_and_is_remembered(moderation):
+    moderation.avatars[1] = main.AvatarVerdict(0.9, PHASH)
+    moderation.message(-100, moderation.user(1), "привет")
+    assert moderation.outbound.punished == [(-100, 1, 1)]
+    assert "БАН по аватарке" in moderation.outbound.notified[0]
+    assert f"pHash {PHASH:016x}" in moderation.outbound.notified[0]
+    assert moderation.banned == [] and moderation.clean == []
+    assert moderation.spam_avatars == [1]
+
+
+def test_known_avatar_extends_ttl_instead_of_growing_index(run, mongo_db, monkeypatch):
+    col = mongo_db["spam_avatars"]
+    monkeypatch.setattr(main, "spam_avatars_col", col)
+    monkeypatch.setattr(main, "SPAM_AVATARS", main.HammingIndex(main.AVATAR_HASH_DISTANCE))
+
+    async def scenario():
+        main.remember_spam_avatar(PHASH, 1)
+        await asyncio.gather(*main._BACKGROUND_TASKS)
+        first = (await col.find_one({"_id": f"{PHASH:016x}"}))["time"]
+        main.remember_spam_avatar(PHASH ^ 0b101, 2)
+        await asyncio.gather(*main._BACKGROUND_TASKS)
+        return first, [doc async for doc in col.find()]
+
+    first, docs = run(scenario())
+    assert len(main.SPAM_AVATARS) == 1
+    assert [d["_id"] for d in docs] == [f"{PHASH:016x}"]
+    assert docs[0]["time"] >= first
+
+
+def test_forget_avatar_removes_from_index_and_mongo(run, mongo_db, monkeypatch):
+    col = mongo_db["spam_avatars"]
+    monkeypatch.setattr(main, "spam_avatars_col", col)
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(from_user=SimpleNamespace(id=main.ADMIN_CHAT_ID), reply_text=reply_text)
+
+    async def scenario():
+        other = PHASH ^ (0xFFFF << 32)
+        await col.insert_many([{"_id": f"{PHASH:016x}"}, {"_id": f"{other:016x}"}])
+        await main.load_spam_avatars(verbose=False)
+        assert len(main.SPAM_AVATARS) == 2
+        # из уведомления о бане берут pHash забаненной аватарки — он рядом с сохранённым
+        await main.forget_avatar(SimpleNamespace(message=message), SimpleNamespace(args=[f"{PHASH ^ 1:x}"]))
+        assert len(main.SPAM_AVATARS) == 1 and main.SPAM_AVATARS.find(PHASH) is None
+        assert [d["_id"] async for d in col.find()] == [f"{other:016x}"]
+        await main.load_spam_avatars(verbose=False)  # пересборка в воркерах не возвращает удалённое
+        assert len(main.SPAM_AVATARS) == 1
+        await main.forget_avatar(SimpleNamespace(message=message), SimpleNamespace(args=["zz"]))
+
+    monkeypatch.setattr(main, "SPAM_AVATARS", main.SPAM_AVATARS)  # load_spam_avatars подменяет глобал
+    run(scenario())
+    assert replies[0].startswith("Удалено хэшей: 1")
+    assert replies[1].startswith("Использование")
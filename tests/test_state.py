@@ -0,0 +1,82 @@
+import multiprocessing
+
+import bson
+import pytest
+
+import main
+
+BIG_PHASH = (1 << 64) - 12345  # старший бит выставлен — за пределами int64
+
+
+def test_avatar_verdict_state_roundtrip_fits_bson():
+    verdict = main.AvatarVerdict(0.37, BIG_PHASH)
+    value = main.verdict_to_state(verdict)
+    bson.encode({"value": value})  # list(verdict) здесь падал с OverflowError
+    assert main.verdict_from_state(value) == verdict
+    assert main.verdict_from_state(main.verdict_to_state(main.NO_AVATAR)) == main.NO_AVATAR
+    with pytest.raises(OverflowError):
+        bson.encode({"value": list(verdict)})
+
+
+@pytest.mark.parametrize("make", [
+    lambda tmp_path: main.MemoryStateStore(),
+    lambda tmp_path: main.SqliteStateStore(str(tmp_path / "state.sqlite3")),
+])
+def test_state_store_set_get_delete(run, tmp_path, make):
+    store = make(tmp_path)
+
+    async def scenario():
+        await store.set("avatar:1", main.verdict_to_state(main.AvatarVerdict(0.5, BIG_PHASH)), ttl=60)
+        assert main.verdict_from_state(await store.get("avatar:1")).phash == BIG_PHASH
+        await store.set("gone", 1, ttl=-1)
+        assert await store.get("gone") is None
+        await store.delete("avatar:1")
+        assert await store.get("avatar:1") is None
+        await store.close()
+
+    run(scenario())
+
+
+def test_mongo_state_store(run, mongo_db):
+    store = main.MongoStateStore(mongo_db["state"])
+
+    async def scenario():
+        await store.set("k", ["a", None], ttl=60)
+        assert await store.get("k") == ["a", None]
+        await store.delete("k")
+        assert await store.get("k") is None
+
+    run(scenario())
+
+
+def test_state_store_is_abstract():
+    with pytest.raises(TypeError):
+        main.StateStore()
+
+
+def test_config_generation_triggers_reload(run, monkeypatch):
+    calls = []
+
+    class Reloadable:
+        def __init__(self, name):
+            self.name = name
+
+        async def invalidate(self):
+            calls.append(self.name)
+
+        async def refresh(self):
+            calls.append(self.name)
+
+    generation = multiprocessing.get_context("spawn").Value("q", 0)
+    monkeypatch.setattr(main, "_CONFIG_GENERATION", generation)
+    monkeypatch.setattr(main, "_config_generation_seen", 0)
+    monkeypatch.setattr(main, "CONFIG", Reloadable("config"))
+    monkeypatch.setattr(main, "CHAT_OVERLAYS", Reloadable("overlays"))
+
+    run(main.sync_config_generation())
+    assert calls == []  # ничего не менялось — в Mongo не ходим
+    main.bump_config_generation()  # /addspam в другом воркере
+    run(main.sync_config_generation())
+    assert calls == ["config", "overlays"]
+    run(main.sync_config_generation())
+    assert calls == ["config", "overlays"]
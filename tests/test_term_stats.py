@@ -0,0 +1,72 @@
+from datetime import datetime
+
+from pymongo.errors import AutoReconnect
+
+import main
+
+
+class CounterCollection:
+    """Коллекция term_stats в памяти: применяет $inc из UpdateOne; может упасть на заданном вызове."""
+    name = "term_stats"
+
+    def __init__(self, fail_on: set[int] = frozenset()):
+        self.n: dict[str, int] = {}
+        self.calls = 0
+        self.fail_on = set(fail_on)
+
+    async def bulk_write(self, ops, ordered=True):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise AutoReconnect("network")
+        for op in ops:
+            _id = op._filter["_id"]
+            self.n[_id] = self.n.get(_id, 0) + op._doc["$inc"]["n"]
+
+    async def delete_many(self, flt):
+        prefix = flt["corpus"] + ":"
+        self.n = {k: v for k, v in self.n.items() if not k.startswith(prefix)}
+
+
+DAY = datetime(2026, 10, 1)
+
+
+def test_failed_flush_keeps_counts(run):
+    col = CounterCollection(fail_on={1})
+    stats = main.TermStats(col, interval=60, max_pending=1000)
+    stats.add("spam", "быстрый заработок онлайн", DAY)
+    run(stats.flush())
+    assert col.n == {}
+    stats.add("spam", "быстрый заработок онлайн", DAY)  # пришло, пока база была недоступна
+    run(stats.flush())
+    assert col.n["spam:2026-10-01:заработок"] == 2
+    assert col.n["spam:2026-10-01:"] == 2
+    assert stats._pending == {}
+
+
+def test_partial_flush_requeues_only_unwritten_chunks(run):
+    col = CounterCollection(fail_on={2})
+    stats = main.TermStats(col, interval=60, max_pending=10000)
+    for i in range(1500):
+        stats._inc(("spam", DAY, f"term{i}"), 1)
+    run(stats.flush())
+    assert len(col.n) == 1000  # первая пачка записана
+    assert len(stats._pending) == 500  # вторая вернулась
+    run(stats.flush())
+    assert len(col.n) == 1500 and set(col.n.values()) == {1}
+
+
+def test_rebuild_does_not_double_count_pending(run, mongo_db):
+    source = mongo_db["banned_messages"]
+    col = CounterCollection()
+    stats = main.TermStats(col, interval=60, max_pending=1000)
+
+    async def scenario():
+        await source.insert_one({"text": "крипта заработок", "time": DAY, "hits": 3})
+        # счётчик того же бана ещё не сброшен к моменту пересчёта
+        stats.add("spam", "крипта заработок", DAY)
+        stats.add("clean", "привет всем", DAY)
+        assert await stats.rebuild_spam(source) == 1
+
+    run(scenario())
+    assert col.n["spam:2026-10-01:заработок"] == 3
+    assert col.n["clean:2026-10-01:привет"] == 1  # чистый корпус не трогаем
@@ -0,0 +1,64 @@
+import main
+
+
+def test_precompile_installs_rules_off_loop(run):
+    snap = main.ConfigSnapshot(None)
+    snap.cfg = {**main.default_config(), "BANNED_WORDS": ["казино"]}
+    run(snap.precompile())
+    assert snap._rules is not None
+    assert snap.rules.words.first("казино") >= 0
+
+
+def test_precompile_discards_stale_result(run, monkeypatch):
+    snap = main.ConfigSnapshot(None)
+    real = main.CompiledRules
+
+    def slow_compile(cfg):
+        snap.cfg = {**main.default_config(), "BANNED_WORDS": ["ставки"]}  # конфиг сменился во время сборки
+        return real(cfg)
+
+    monkeypatch.setattr(main, "CompiledRules", slow_compile)
+    run(snap.precompile())
+    assert snap._rules is None
+
+
+class BusyDispatcher:
+    """submit отказывает первые refusals раз (очередь полна), потом принимает."""
+
+    def __init__(self, refusals: int):
+        self.refusals = refusals
+        self.accepted = []
+
+    async def submit(self, update):
+        if self.refusals:
+            self.refusals -= 1
+            return False
+        self.accepted.append(update.update_id)
+        return True
+
+
+def raw_update(update_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": -1, "type": "supergroup"},
+        "from": {"id": 5, "is_bot": False, "first_name": "A"}, "text": "hi",
+    }}
+
+
+def test_drain_retries_full_queue_and_counts_drops(run, monkeypatch):
+    pending = main.deque([raw_update(1), raw_update(2), {"update_id": 3, "message": {"bad": True}}])
+    monkeypatch.setattr(main, "_PENDING_UPDATES", pending)
+    dispatcher = BusyDispatcher(refusals=3)
+    before = main.METRICS._counters.get(("startup_updates_dropped_total", ()), 0)
+
+    drained, dropped = run(main.drain_pending_updates(dispatcher, None, attempts=5))
+    assert (drained, dropped) == (2, 1)  # битый апдейт не валит прогрев
+    assert dispatcher.accepted == [1, 2]
+    assert main.METRICS._counters[("startup_updates_dropped_total", ())] == before + 1
+
+
+def test_drain_gives_up_after_attempts(run, monkeypatch):
+    monkeypatch.setattr(main, "_PENDING_UPDATES", main.deque([raw_update(1), raw_update(2)]))
+    dispatcher = BusyDispatcher(refusals=3)
+    drained, dropped = run(main.drain_pending_updates(dispatcher, None, attempts=2))
+    assert (drained, dropped) == (1, 1)
+    assert dispatcher.accepted == [2]
@@ -0,0 +1,47 @@
+import pytest
+from telegram import Update
+
+import main
+
+
+def message(update_id, chat_id, user_id=5):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "supergroup"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "A"}, "text": "hi",
+    }}
+
+
+@pytest.mark.parametrize("data, key", [
+    (message(1, -100), -100),
+    ({"update_id": 2, "chat_member": {"chat": {"id": -200}, "from": {"id": 5}}}, -200),
+    ({"update_id": 3, "callback_query": {"id": "q", "from": {"id": 7}, "message": {"chat": {"id": -300}}}}, -300),
+    ({"update_id": 4, "callback_query": {"id": "q", "from": {"id": 7}}}, 7),
+    ({"update_id": 5, "inline_query": {"id": "q", "from": {"id": 8}, "query": ""}}, 8),
+    ({"update_id": 6, "poll": {"id": "p"}}, 6),
+])
+def test_update_shard_key(data, key):
+    assert main.update_shard_key(data) == key
+
+
+def test_shard_key_matches_in_process_dispatcher():
+    # мастер по сырому апдейту и UpdateDispatcher воркера по Update выбирают чат одинаково
+    data = message(1, -1001234)
+    update = Update.de_json(data, None)
+    assert main.update_shard_key(data) == update.effective_chat.id
+
+
+def test_chat_always_goes_to_the_same_worker():
+    pool = main.WorkerPool(3, "token", 10)
+    for update_id, chat_id in enumerate((-100, -101, -100, -102, -100), 1):
+        assert pool.submit(message(update_id, chat_id))
+    shard = -100 % 3
+    got = [pool.queues[shard].get(timeout=1)["update_id"] for _ in range(pool.routed[shard])]
+    assert got == [1, 3, 5]  # порядок внутри чата сохраняется
+    assert pool.routed == [1, 1, 3] and pool.stats()["routed"] == 5
+
+
+def test_full_worker_queue_sheds():
+    pool = main.WorkerPool(1, "token", 1)
+    assert pool.submit(message(1, -100))
+    assert not pool.submit(message(2, -100))
+    assert pool.stats()["shed"] == 1 and pool.routed == [1]
@@ -0,0 +1,84 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect
+
+import main
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+def test_batch_size_wakes_background_flush(run, mongo_db):
+    col = mongo_db["clean_sample"]
+    writer = main.BatchWriter(col, batch_size=5, interval=60, max_queue=100)
+
+    async def scenario():
+        writer.start()
+        for i in range(5):
+            writer.put({"text": f"t{i}"})
+        # интервал — минута, записать должна пачка по размеру
+        assert await wait_for(lambda: writer.written == 5)
+        assert await col.count_documents({}) == 5
+        await writer.close()
+
+    run(scenario())
+
+
+def test_interval_flush_and_close(run, mongo_db):
+    col = mongo_db["clean_sample"]
+    writer = main.BatchWriter(col, batch_size=100, interval=0.05, max_queue=100)
+
+    async def scenario():
+        writer.start()
+        writer.put({"text": "a"})
+        assert await wait_for(lambda: writer.written == 1)
+        writer.put({"text": "b"})
+        await writer.close()  # остаток дописывается при остановке
+        assert writer._task is None
+        assert await col.count_documents({}) == 2
+
+    run(scenario())
+
+
+def test_bounded_queue_drops_and_counts(run, mongo_db):
+    writer = main.BatchWriter(mongo_db["clean_sample"], batch_size=100, interval=60, max_queue=3)
+    assert [writer.put({"i": i}) for i in range(5)] == [True, True, True, False, False]
+    assert writer.stats()["dropped"] == 2
+    run(writer.flush())
+    assert writer.stats()["written"] == 3
+
+
+def test_background_loop_survives_write_errors(run):
+    class Outage:
+        name = "outage"
+
+        def __init__(self):
+            self.down = True
+            self.docs = []
+
+        async def insert_many(self, docs, ordered=True):
+            if self.down:
+                raise AutoReconnect("primary stepped down")
+            self.docs.extend(docs)
+
+    col = Outage()
+    writer = main.BatchWriter(col, batch_size=100, interval=0.02, max_queue=100)
+
+    async def scenario():
+        writer.start()
+        for i in range(3):
+            writer.put({"i": i})
+        assert await wait_for(lambda: writer.retried >= 2)
+        assert writer.stats()["queued"] == 3  # ничего не потеряно, пока база недоступна
+        col.down = False
+        assert await wait_for(lambda: writer.written == 3)
+        await writer.close()
+
+    run(scenario())
+    assert [d["i"] for d in col.docs] == [0, 1, 2]
+    assert writer.failed == 0 and writer.dropped == 0